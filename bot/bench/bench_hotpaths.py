@@ -0,0 +1,379 @@
+"""on_message / list_quotes / daily_quote / save_config のベンチマーク
+
+使い方 (bot/ ディレクトリで):
+    python bench/bench_hotpaths.py --sizes 10,1000,10000,100000 --output result.json
+    python bench/bench_hotpaths.py --compare old.json result.json
+
+Discordには接続せず、軽量な偽の Message / Context / チャンネルでハンドラーを直接呼ぶ。
+結果はJSONで保存し、--compare で2つの結果を比較できる。
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+HIRAGANA = [chr(c) for c in range(0x3041, 0x3097)]
+KATAKANA = [chr(c) for c in range(0x30A1, 0x30FB)]
+KANJI = list('今日明天気元嬉楽悲怒愛恋夢空海山川花鳥風月猫犬食飲寝起走歩話聞見言思知')
+CHARS = HIRAGANA + KATAKANA + KANJI
+
+
+def japanese_text(rng, min_len, max_len):
+    return ''.join(rng.choice(CHARS) for _ in range(rng.randint(min_len, max_len)))
+
+
+def synthetic_guild(rng, quotes, triggers):
+    """語録 quotes 件・反応ワード triggers 件のサーバー設定 (config.json 形式)"""
+    return {
+        'quote_channel_id': 1,
+        'triggers': [
+            {'word': japanese_text(rng, 2, 6), 'response': japanese_text(rng, 4, 12)}
+            for _ in range(triggers)
+        ],
+        'quotes': [
+            {'id': i + 1, 'text': japanese_text(rng, 5, 30),
+             'image': f'https://example.com/{i}.png' if i % 10 == 0 else None}
+            for i in range(quotes)
+        ],
+    }
+
+
+def synthetic_messages(rng, guild, count, hit_ratio=0.1):
+    """通常の雑談に、一定の割合で語録・反応ワードを含むメッセージを混ぜる"""
+    entries = [q['text'] for q in guild['quotes']] + [t['word'] for t in guild['triggers']]
+    messages = []
+    for _ in range(count):
+        text = japanese_text(rng, 10, 80)
+        if entries and rng.random() < hit_ratio:
+            pos = rng.randint(0, len(text))
+            text = text[:pos] + rng.choice(entries) + text[pos:]
+        messages.append(text)
+    return messages
+
+
+# --- 偽のDiscordオブジェクト ---
+
+class FakeMessageResult:
+    __slots__ = ('id',)
+
+    def __init__(self, message_id):
+        self.id = message_id
+
+
+class FakeChannel:
+    def __init__(self, channel_id):
+        self.id = channel_id
+        self.mention = f'<#{channel_id}>'
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent += 1
+        return FakeMessageResult(self.sent)
+
+
+class FakeGuild:
+    def __init__(self, guild_id, channel):
+        self.id = guild_id
+        self.shard_id = 0
+        self._channel = channel
+
+    def get_channel(self, channel_id):
+        return self._channel
+
+
+class FakeAuthor:
+    bot = False
+    id = 1
+
+
+class FakeMessage:
+    __slots__ = ('guild', 'channel', 'content', 'author', 'attachments')
+
+    def __init__(self, guild, channel, content):
+        self.guild = guild
+        self.channel = channel
+        self.content = content
+        self.author = FakeAuthor()
+        self.attachments = []
+
+
+class FakeContext:
+    def __init__(self, guild, channel, command=None):
+        self.guild = guild
+        self.channel = channel
+        self.command = command
+        self.message = FakeMessage(guild, channel, '')
+        self.author = self.message.author
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+
+# --- 計測 ---
+
+def summarize(latencies_ms, wall_seconds=None):
+    """wall_seconds を渡すと、1秒あたりの回数は合計の所要時間ではなく経過時間から出す"""
+    ordered = sorted(latencies_ms)
+    n = len(ordered)
+    total = sum(ordered)
+    elapsed = wall_seconds if wall_seconds is not None else total / 1000
+    return {
+        'count': n,
+        'per_second': n / elapsed if elapsed else None,
+        'mean_ms': total / n if n else None,
+        'p50_ms': ordered[n // 2] if n else None,
+        'p99_ms': ordered[min(n - 1, int(n * 0.99))] if n else None,
+    }
+
+
+async def measure(func, args_list):
+    latencies = []
+    for args in args_list:
+        start = time.perf_counter()
+        await func(*args)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+async def measure_allocations(func, args_list):
+    """1回あたりの確保メモリ (バイト) とピーク"""
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    before = tracemalloc.get_traced_memory()[0]
+    for args in args_list:
+        await func(*args)
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'retained_bytes_per_call': (after - before) / max(1, len(args_list)),
+        'peak_bytes': peak - before,
+    }
+
+
+async def drain(main):
+    # 送信キューを空にする (計測の外で)
+    while main.dispatcher.depth():
+        await asyncio.sleep(0)
+
+
+async def bench_size(main, rng, size, message_count, triggers):
+    from models import GuildState
+
+    guild_id = 10_000 + size
+    gid = str(guild_id)
+    data = synthetic_guild(rng, size, triggers)
+    channel = FakeChannel(1)
+    guild = FakeGuild(guild_id, channel)
+    main.servers[gid] = GuildState.from_dict(data)
+    result = {'quotes': size, 'triggers': triggers}
+
+    # マッチャーの構築 (初回のメッセージの前にスレッドで行う分。失敗リンクまで含める)
+    start = time.perf_counter()
+    main.servers[gid].matcher.compile()
+    result['matcher_build_ms'] = (time.perf_counter() - start) * 1000
+
+    # on_message (1通目で残りの準備を済ませてから、経過時間で1秒あたりの件数を出す)
+    messages = [(FakeMessage(guild, channel, text),)
+                for text in synthetic_messages(rng, data, message_count)]
+    await main.on_message(messages[0][0])
+    await drain(main)
+    latencies = []
+    wall = 0.0
+    for chunk in range(0, len(messages), 200):
+        start = time.perf_counter()
+        latencies += await measure(main.on_message, messages[chunk:chunk + 200])
+        wall += time.perf_counter() - start
+        await drain(main)
+    result['on_message'] = summarize(latencies, wall)
+    result['on_message'].update(await measure_allocations(main.on_message, messages[:200]))
+    await drain(main)
+
+    # list_quotes
+    ctx = FakeContext(guild, channel, main.list_quotes)
+    repeats = 20 if size <= 10_000 else 3
+    result['list_quotes'] = summarize(await measure(main.list_quotes.callback, [(ctx,)] * repeats))
+    await drain(main)
+
+    # daily_quote (1サーバー分の投稿)
+    main.bot.get_guild = lambda i: guild if i == guild_id else None
+    result['daily_quote'] = summarize(await measure(main.daily_quote, [(gid,)] * 200))
+    await drain(main)
+    return result
+
+
+async def bench_scheduler(main, rng, guild_counts):
+    """多数のサーバーのうち時刻になったものだけを取り出すコスト"""
+    from scheduler import QuoteScheduler
+
+    async def post(guild_id):
+        pass
+
+    results = []
+    for count in guild_counts:
+        scheduler = QuoteScheduler(post, path=os.path.join(tempfile.gettempdir(), 'bench-schedule.json'))
+        now = time.time()
+        spec = {'time': '12:00', 'interval_minutes': 60, 'timezone': 'Asia/Tokyo'}
+        for i in range(count):
+            scheduler.schedules[str(i)] = spec
+            scheduler._push(str(i), now + rng.random() * 3600)
+        start = time.perf_counter()
+        due = scheduler._pop_due(now + 60)
+        results.append({
+            'guilds': count,
+            'due': len(due),
+            'pop_due_ms': (time.perf_counter() - start) * 1000,
+        })
+    return results
+
+
+def bench_persistence(rng, sizes, workdir):
+    """save_config (書き込み) のコストを JSON / SQLite で計測"""
+    from persistence import ConfigWriter
+    from storage import JsonStore, SQLiteStore
+    from models import GuildState
+
+    results = []
+    for size in sizes:
+        guilds = {str(i): GuildState.from_dict(synthetic_guild(rng, size, 20)) for i in range(10)}
+        for backend in ('json', 'sqlite'):
+            path = os.path.join(workdir, f'bench-{backend}-{size}.{"json" if backend == "json" else "db"}')
+            store = JsonStore(path) if backend == 'json' else SQLiteStore(path)
+            writer = ConfigWriter(store, serialize=GuildState.to_dict)
+            # 全サーバーを書き込んだ後、1サーバー1件の変更を保存するコスト
+            for guild_id, state in guilds.items():
+                writer._dirty[guild_id] = state
+            writer.flush_sync()
+            state = guilds['0']
+            timings = []
+            for _ in range(5):
+                state.add_quote(japanese_text(rng, 5, 30))
+                writer._dirty['0'] = state
+                start = time.perf_counter()
+                writer.flush_sync()
+                timings.append((time.perf_counter() - start) * 1000)
+            store.close()
+            results.append({
+                'backend': backend,
+                'quotes_per_guild': size,
+                'guilds': len(guilds),
+                'file_bytes': os.path.getsize(path),
+                'save_ms_median': statistics.median(timings),
+                'save_ms_max': max(timings),
+            })
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=BOT_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    sizes = [int(s) for s in args.sizes.split(',')]
+    workdir = tempfile.mkdtemp(prefix='pp-angel-bench-')
+    # 自動返信がすべて送られるようにクールダウンは無効にする (最悪ケースを計測)
+    with open(os.path.join(workdir, 'settings.json'), 'w', encoding='utf-8') as f:
+        json.dump({'cooldown': {'guild_seconds': 0, 'channel_seconds': 0, 'duplicate_seconds': 0,
+                                'trigger_burst': 0}}, f)
+    os.chdir(workdir)
+    sys.path.insert(0, BOT_DIR)
+    import main
+
+    async def no_commands(message):
+        pass
+    main.bot.process_commands = no_commands  # コマンド解析はdiscord.py側の処理なので除外
+
+    report = {
+        'meta': {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'seed': args.seed,
+            'messages': args.messages,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        },
+        'sizes': [],
+    }
+    for size in sizes:
+        print(f'語録 {size} 件を計測中...', file=sys.stderr)
+        report['sizes'].append(await bench_size(main, rng, size, args.messages, args.triggers))
+    report['scheduler'] = await bench_scheduler(main, rng, [100, 10_000, 100_000])
+    report['persistence'] = bench_persistence(rng, [s for s in sizes if s <= args.max_persist], workdir)
+    shutil.rmtree(workdir, ignore_errors=True)
+    return report
+
+
+def print_report(report):
+    print(f"revision: {report['meta']['revision']}  python: {report['meta']['python']}")
+    print(f"{'quotes':>8} {'msg/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'B/msg':>8} "
+          f"{'list ms':>9} {'daily ms':>9} {'build ms':>9}")
+    for row in report['sizes']:
+        m = row['on_message']
+        print(f"{row['quotes']:>8} {m['per_second']:>10.0f} {m['p50_ms']:>8.3f} {m['p99_ms']:>8.3f} "
+              f"{m['retained_bytes_per_call']:>8.0f} {row['list_quotes']['p50_ms']:>9.2f} "
+              f"{row['daily_quote']['p50_ms']:>9.3f} {row['matcher_build_ms']:>9.1f}")
+    for row in report['scheduler']:
+        print(f"scheduler: {row['guilds']} guilds, {row['due']} due -> {row['pop_due_ms']:.2f} ms")
+    for row in report['persistence']:
+        print(f"save_config[{row['backend']}]: {row['quotes_per_guild']} quotes x {row['guilds']} guilds "
+              f"-> {row['save_ms_median']:.2f} ms (file {row['file_bytes']} bytes)")
+
+
+def compare(old_path, new_path):
+    """2つの結果の主要な値を比べて表示"""
+    with open(old_path, encoding='utf-8') as f:
+        old = json.load(f)
+    with open(new_path, encoding='utf-8') as f:
+        new = json.load(f)
+    old_sizes = {row['quotes']: row for row in old['sizes']}
+    print(f"{old['meta']['revision']} -> {new['meta']['revision']}")
+    for row in new['sizes']:
+        before = old_sizes.get(row['quotes'])
+        if not before:
+            continue
+        for key in ('on_message', 'list_quotes', 'daily_quote'):
+            a, b = before[key]['p50_ms'], row[key]['p50_ms']
+            change = (b - a) / a * 100 if a else 0.0
+            print(f"{row['quotes']:>8} {key:<12} p50 {a:.3f} -> {b:.3f} ms ({change:+.1f}%)")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='ハンドラーのベンチマーク')
+    parser.add_argument('--sizes', default='10,1000,10000,100000', help='語録の件数 (カンマ区切り)')
+    parser.add_argument('--messages', type=int, default=2000, help='サイズごとのメッセージ数')
+    parser.add_argument('--triggers', type=int, default=50, help='反応ワードの件数')
+    parser.add_argument('--max-persist', type=int, default=10000, help='保存を計測する最大の語録数')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='結果を保存するJSONファイル')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='2つの結果を比較')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    output = os.path.abspath(args.output) if args.output else None
+    report = asyncio.run(run(args))
+    print_report(report)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,629 @@
+"""ローカルの偽Discord (ゲートウェイ + REST) と偽Twitter検索APIを使った負荷試験
+
+使い方 (bot/ ディレクトリで):
+    python bench/loadtest.py --guilds 200 --rate 100 --duration 60 --output load.json
+    python bench/loadtest.py --replay traffic.jsonl --rate 50
+
+本物の main.py の bot を子プロセスで起動し、接続先だけをこのスクリプトが立てた
+サーバーに向ける。合成 (または --replay で指定したJSON Lines) のメッセージを
+指定のレートで流し、返信までの時間、ハートビートの揺らぎ、レート制限の様子を集計する。
+イベントループが止まるとハートビートの間隔が伸びるので、揺らぎで詰まりがわかる。
+
+--replay のファイルは1行に {"guild": サーバー番号, "content": "本文"} の形式。
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict, deque
+
+from aiohttp import web, WSMsgType
+
+BOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DISCORD_EPOCH = 1420070400000
+BOT_USER_ID = 1000
+AUTHOR_ID = 2000
+
+HASHTAG = 'かなたーと'
+
+
+class Snowflakes:
+    def __init__(self):
+        self._counter = itertools.count()
+
+    def next(self):
+        millis = int(time.time() * 1000) - DISCORD_EPOCH
+        return (millis << 22) | (next(self._counter) & 0x3FFFFF)
+
+
+def summarize(values):
+    ordered = sorted(values)
+    n = len(ordered)
+    if not n:
+        return {'count': 0}
+    return {
+        'count': n,
+        'mean': sum(ordered) / n,
+        'p50': ordered[n // 2],
+        'p99': ordered[min(n - 1, int(n * 0.99))],
+        'max': ordered[-1],
+    }
+
+
+def api_response(data, status=200, headers=None):
+    # discord.py は Content-Type が application/json ちょうどの時だけJSONとして読む
+    return web.Response(body=json.dumps(data).encode(), status=status, headers=headers,
+                        content_type='application/json')
+
+
+def user_payload(user_id, name, bot=False):
+    return {'id': str(user_id), 'username': name, 'discriminator': '0', 'global_name': name,
+            'avatar': None, 'bot': bot}
+
+
+class FakeDiscord:
+    """ゲートウェイとRESTの最低限の実装。送受信の時刻を記録する"""
+
+    def __init__(self, guilds, heartbeat_ms, channel_limit, channel_per):
+        self.guilds = guilds                   # [(guild_id, channel_id)]
+        self.heartbeat_ms = heartbeat_ms
+        self.channel_limit = channel_limit     # チャンネルごとに channel_per 秒で channel_limit 件
+        self.channel_per = channel_per
+        self.ids = Snowflakes()
+        self.ws = None
+        self.connected = asyncio.Event()
+        self.ready = asyncio.Event()
+        self.sequence = 0
+        self.heartbeats = []                   # 受信時刻
+        self.expected = defaultdict(deque)     # (channel_id, 返信の内容) -> 送信時刻
+        self.latencies = defaultdict(list)     # 種類 -> ミリ秒
+        self.kinds = {}                        # (channel_id, 返信の内容) -> 種類
+        self.unexpected_replies = 0
+        self.requests = 0
+        self.rate_limited = 0
+        self.buckets = {}                      # channel_id -> (窓の開始時刻, 件数)
+        self.channel_sends = defaultdict(list)
+        self.unknown_routes = defaultdict(int)
+
+    # --- ゲートウェイ ---
+
+    async def gateway(self, request):
+        ws = web.WebSocketResponse(max_msg_size=0)
+        await ws.prepare(request)
+        self.ws = ws
+        self.connected.set()
+        await ws.send_json({'op': 10, 'd': {'heartbeat_interval': self.heartbeat_ms}})
+        async for msg in ws:
+            if msg.type != WSMsgType.TEXT:
+                continue
+            data = json.loads(msg.data)
+            op = data['op']
+            if op == 1:
+                self.heartbeats.append(time.perf_counter())
+                await ws.send_json({'op': 11})
+            elif op == 2:
+                await self.identify()
+            elif op == 6:
+                await ws.send_json({'op': 9, 'd': False})  # RESUMEは受け付けない
+        return ws
+
+    async def dispatch(self, event, data):
+        self.sequence += 1
+        await self.ws.send_json({'op': 0, 't': event, 's': self.sequence, 'd': data})
+
+    async def identify(self):
+        await self.dispatch('READY', {
+            'v': 10,
+            'user': user_payload(BOT_USER_ID, 'PP-Angel', bot=True),
+            'guilds': [{'id': str(guild_id), 'unavailable': True} for guild_id, _ in self.guilds],
+            'session_id': 'loadtest',
+            'resume_gateway_url': str(self.ws_url),
+            'application': {'id': str(BOT_USER_ID), 'flags': 0},
+        })
+        for guild_id, channel_id in self.guilds:
+            await self.dispatch('GUILD_CREATE', self.guild_payload(guild_id, channel_id))
+        self.ready.set()
+
+    def guild_payload(self, guild_id, channel_id):
+        return {
+            'id': str(guild_id),
+            'name': f'guild-{guild_id}',
+            'owner_id': str(AUTHOR_ID),   # 送信者をオーナーにして管理者コマンドも通す
+            'icon': None,
+            'features': [],
+            'roles': [{'id': str(guild_id), 'name': '@everyone', 'permissions': '0', 'position': 0,
+                       'color': 0, 'hoist': False, 'managed': False, 'mentionable': False}],
+            'emojis': [],
+            'stickers': [],
+            'channels': [{'id': str(channel_id), 'type': 0, 'name': 'general', 'position': 0,
+                          'permission_overwrites': [], 'guild_id': str(guild_id)}],
+            'threads': [],
+            'members': [],
+            'voice_states': [],
+            'presences': [],
+            'member_count': 2,
+            'large': False,
+            'unavailable': False,
+            'joined_at': '2024-01-01T00:00:00+00:00',
+        }
+
+    async def send_message(self, guild_id, channel_id, content, expect, kind):
+        """MESSAGE_CREATE を送り、返信が来るはずなら待ち合わせに登録する"""
+        if expect is not None:
+            key = (channel_id, expect)
+            self.expected[key].append(time.perf_counter())
+            self.kinds[key] = kind
+        await self.dispatch('MESSAGE_CREATE', {
+            'id': str(self.ids.next()),
+            'channel_id': str(channel_id),
+            'guild_id': str(guild_id),
+            'author': user_payload(AUTHOR_ID, 'loadtester'),
+            'member': {'roles': [], 'joined_at': '2024-01-01T00:00:00+00:00', 'deaf': False,
+                       'mute': False, 'flags': 0},
+            'content': content,
+            'timestamp': '2024-01-01T00:00:00+00:00',
+            'edited_timestamp': None,
+            'tts': False,
+            'mention_everyone': False,
+            'mentions': [],
+            'mention_roles': [],
+            'attachments': [],
+            'embeds': [],
+            'pinned': False,
+            'type': 0,
+        })
+
+    # --- REST ---
+
+    async def get_me(self, request):
+        return api_response(user_payload(BOT_USER_ID, 'PP-Angel', bot=True))
+
+    async def get_application(self, request):
+        return api_response({
+            'id': str(BOT_USER_ID), 'name': 'PP-Angel', 'icon': None, 'description': '',
+            'bot_public': True, 'bot_require_code_grant': False, 'verify_key': '', 'flags': 0,
+            'owner': user_payload(AUTHOR_ID, 'loadtester'), 'team': None,
+        })
+
+    def ratelimit_headers(self, channel_id, now):
+        start, count = self.buckets.get(channel_id, (now, 0))
+        if now - start >= self.channel_per:
+            start, count = now, 0
+        reset_after = self.channel_per - (now - start)
+        return start, count, {
+            'X-Ratelimit-Limit': str(self.channel_limit),
+            'X-Ratelimit-Remaining': str(max(0, self.channel_limit - count - 1)),
+            'X-Ratelimit-Reset': f'{time.time() + reset_after:.3f}',
+            'X-Ratelimit-Reset-After': f'{reset_after:.3f}',
+            'X-Ratelimit-Bucket': f'channel-{channel_id}',
+        }
+
+    async def post_message(self, request):
+        self.requests += 1
+        channel_id = int(request.match_info['channel_id'])
+        now = time.monotonic()
+        start, count, headers = self.ratelimit_headers(channel_id, now)
+        if count >= self.channel_limit:
+            self.rate_limited += 1
+            headers['Via'] = '1.1 google'
+            headers['X-Ratelimit-Remaining'] = '0'
+            retry_after = self.channel_per - (now - start)
+            return api_response({'message': 'You are being rate limited.', 'retry_after': retry_after,
+                                      'global': False}, status=429, headers=headers)
+        self.buckets[channel_id] = (start, count + 1)
+        self.channel_sends[channel_id].append(now)
+
+        if request.content_type.startswith('multipart/'):
+            reader = await request.multipart()
+            body = {}
+            async for part in reader:
+                if part.name == 'payload_json':
+                    body = json.loads(await part.text())
+        else:
+            body = await request.json()
+        self.record_reply(channel_id, body)
+
+        return api_response({
+            'id': str(self.ids.next()),
+            'channel_id': str(channel_id),
+            'author': user_payload(BOT_USER_ID, 'PP-Angel', bot=True),
+            'content': body.get('content') or '',
+            'timestamp': '2024-01-01T00:00:00+00:00',
+            'edited_timestamp': None,
+            'tts': False,
+            'mention_everyone': False,
+            'mentions': [],
+            'mention_roles': [],
+            'attachments': [],
+            'embeds': body.get('embeds') or [],
+            'pinned': False,
+            'type': 0,
+        }, headers=headers)
+
+    def record_reply(self, channel_id, body):
+        now = time.perf_counter()
+        content = body.get('content')
+        if content:
+            content = re.sub(r' \(#\d+\)$', '', content)  # 追加した語録のIDは比較しない
+        key = (channel_id, content or ('embed' if body.get('embeds') else None))
+        waiting = self.expected.get(key)
+        if not waiting:
+            self.unexpected_replies += 1
+            return
+        # 送信キューで同じ返信がまとめられた場合は、待っていた全員への返信とみなす
+        kind = self.kinds[key]
+        while waiting:
+            self.latencies[kind].append((now - waiting.popleft()) * 1000)
+
+    async def unknown(self, request):
+        self.unknown_routes[f'{request.method} {request.path}'] += 1
+        return api_response({'message': 'Unknown route', 'code': 0}, status=404)
+
+    def routes(self):
+        return [
+            web.get('/gateway', self.gateway),
+            web.get('/api/v10/users/@me', self.get_me),
+            web.get('/api/v10/oauth2/applications/@me', self.get_application),
+            web.post('/api/v10/channels/{channel_id}/messages', self.post_message),
+            web.route('*', '/{tail:.*}', self.unknown),
+        ]
+
+    def unanswered(self):
+        counts = defaultdict(int)
+        for key, waiting in self.expected.items():
+            counts[self.kinds[key]] += len(waiting)
+        return dict(counts)
+
+    def heartbeat_report(self):
+        gaps = [(b - a) * 1000 for a, b in zip(self.heartbeats, self.heartbeats[1:])]
+        return {
+            'interval_ms': self.heartbeat_ms,
+            'received': len(self.heartbeats),
+            'jitter_ms': summarize([abs(gap - self.heartbeat_ms) for gap in gaps]),
+            'max_gap_ms': max(gaps) if gaps else None,
+        }
+
+    def ratelimit_report(self):
+        # 1チャンネルで channel_per 秒の間に送られた最大件数
+        busiest = 0
+        for sends in self.channel_sends.values():
+            window = deque()
+            for t in sends:
+                window.append(t)
+                while t - window[0] >= self.channel_per:
+                    window.popleft()
+                busiest = max(busiest, len(window))
+        return {
+            'channel_limit': f'{self.channel_limit}/{self.channel_per}s',
+            'requests': self.requests,
+            'status_429': self.rate_limited,
+            'busiest_channel_window': busiest,
+            'unknown_routes': dict(self.unknown_routes),
+        }
+
+
+class FakeTwitter:
+    """search_recent_tweets の代わり。応答を遅らせ、15分枠の回数制限を再現する"""
+
+    def __init__(self, delay, limit):
+        self.delay = delay
+        self.limit = limit
+        self.window_start = time.time()
+        self.count = 0
+        self.requests = 0
+        self.rate_limited = 0
+        self.ids = Snowflakes()
+
+    async def search(self, request):
+        self.requests += 1
+        await asyncio.sleep(self.delay)
+        now = time.time()
+        if now - self.window_start >= 900:
+            self.window_start, self.count = now, 0
+        reset = int(self.window_start + 900)
+        headers = {'x-rate-limit-limit': str(self.limit), 'x-rate-limit-reset': str(reset)}
+        if self.count >= self.limit:
+            self.rate_limited += 1
+            headers['x-rate-limit-remaining'] = '0'
+            return api_response({'title': 'Too Many Requests', 'detail': 'Too Many Requests'},
+                                     status=429, headers=headers)
+        self.count += 1
+        headers['x-rate-limit-remaining'] = str(self.limit - self.count)
+
+        tweets, media = [], []
+        for i in range(20):
+            tweet_id = str(self.ids.next())
+            key = f'3_{tweet_id}'
+            tweets.append({'id': tweet_id, 'text': f'#{HASHTAG} テスト画像 {i}', 'author_id': '1',
+                           'attachments': {'media_keys': [key]}, 'edit_history_tweet_ids': [tweet_id]})
+            media.append({'media_key': key, 'type': 'photo', 'url': f'https://example.com/{tweet_id}.png'})
+        return api_response({'data': tweets, 'includes': {'media': media},
+                                  'meta': {'result_count': len(tweets), 'next_token': f'page{self.requests}'}},
+                                 headers=headers)
+
+    def routes(self):
+        return [web.get('/2/tweets/search/recent', self.search)]
+
+    def report(self):
+        return {'delay_s': self.delay, 'requests': self.requests, 'status_429': self.rate_limited}
+
+
+# --- 合成データ ---
+
+def make_guilds(count):
+    ids = Snowflakes()
+    return [(ids.next(), ids.next()) for _ in range(count)]
+
+
+def make_config(guilds, triggers, quotes):
+    config = {}
+    for guild_id, channel_id in guilds:
+        config[str(guild_id)] = {
+            'quote_channel_id': channel_id,
+            'triggers': [{'word': f'ワード{k}番', 'response': f'応答{k}です'} for k in range(triggers)],
+            'quotes': [{'id': k + 1, 'text': f'語録その{k}だよ', 'image': None} for k in range(quotes)],
+            'next_quote_id': quotes + 1,
+        }
+    return {'servers': config}
+
+
+def synthetic_traffic(rng, guilds, args):
+    """(guild_id, channel_id, 本文, 期待する返信, 種類) を無限に生成"""
+    counter = itertools.count()
+    while True:
+        guild_id, channel_id = rng.choice(guilds)
+        roll = rng.random()
+        if roll < args.art_ratio:
+            yield guild_id, channel_id, f'!{HASHTAG}', 'embed', 'hashtag_art'
+        elif roll < args.art_ratio + args.add_quote_ratio:
+            text = f'追加した語録{next(counter)}'
+            yield guild_id, channel_id, f'!add_quote {text}', f'✅ 語録を追加しました: `{text}`', 'add_quote'
+        elif roll < args.art_ratio + args.add_quote_ratio + args.trigger_ratio:
+            k = rng.randrange(args.triggers)
+            yield guild_id, channel_id, f'今日もワード{k}番だね', f'応答{k}です', 'trigger'
+        else:
+            yield guild_id, channel_id, f'ただの雑談 {next(counter)}', None, 'chatter'
+
+
+def replay_traffic(path, guilds):
+    """記録したメッセージを繰り返し流す (返信の待ち合わせはしない)"""
+    with open(path, encoding='utf-8') as f:
+        rows = [json.loads(line) for line in f if line.strip()]
+    while True:
+        for row in rows:
+            guild_id, channel_id = guilds[row.get('guild', 0) % len(guilds)]
+            yield guild_id, channel_id, row['content'], None, 'replay'
+
+
+# --- 子プロセス (本物のbot) ---
+
+def run_bot(base_url):
+    import discord
+    import yarl
+    from discord.gateway import DiscordWebSocket
+
+    discord.http.Route.BASE = f'{base_url}/api/v10'
+    DiscordWebSocket.DEFAULT_GATEWAY = yarl.URL(base_url.replace('http', 'ws', 1) + '/gateway')
+    sys.path.insert(0, BOT_DIR)
+    import main
+
+    setup_twitter_api = main.setup_twitter_api
+
+    def setup_local_twitter():
+        # Twitterは最初に使われた時に読み込まれるので、作られたクライアントの接続先を書き換える
+        client = setup_twitter_api()
+        if client:
+            # tweepyの接続先は固定なのでセッションで書き換える
+            session = client.session
+            original = session.request
+
+            def request(method, url, *args, **kwargs):
+                return original(method, url.replace('https://api.twitter.com', base_url, 1), *args, **kwargs)
+            session.request = request
+        return client
+    main.setup_twitter_api = setup_local_twitter
+
+    try:
+        asyncio.run(main.run_bot('loadtest-token'))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        main.config_writer.flush_sync()
+        main.quote_scheduler.save_sync()
+        main.quote_rotation.save_sync()
+
+
+# --- 親プロセス ---
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def run(args):
+    rng = random.Random(args.seed)
+    guilds = make_guilds(args.guilds)
+    workdir = tempfile.mkdtemp(prefix='pp-angel-load-')
+    with open(os.path.join(workdir, 'config.json'), 'w', encoding='utf-8') as f:
+        json.dump(make_config(guilds, args.triggers, args.quotes), f, ensure_ascii=False)
+    settings = {'storage': {'backend': args.backend, 'path': 'config.json' if args.backend == 'json' else 'bot.db'},
+                'gateway': {'profile': args.gateway_profile}}
+    if not args.cooldowns:
+        # 既定ではすべてのメッセージに返信させて遅延を測る
+        settings['cooldown'] = {'guild_seconds': 0, 'channel_seconds': 0, 'duplicate_seconds': 0,
+                                'trigger_burst': 0}
+    with open(os.path.join(workdir, 'settings.json'), 'w', encoding='utf-8') as f:
+        json.dump(settings, f)
+    if args.art_ratio > 0:
+        with open(os.path.join(workdir, 'twitter_config.json'), 'w') as f:
+            json.dump({'bearer_token': 'loadtest'}, f)
+
+    discord_server = FakeDiscord(guilds, args.heartbeat_ms, args.channel_limit, args.channel_per)
+    twitter_server = FakeTwitter(args.twitter_delay, args.twitter_limit)
+    app = web.Application()
+    app.add_routes(twitter_server.routes())
+    app.add_routes(discord_server.routes())
+    port = free_port()
+    base_url = f'http://127.0.0.1:{port}'
+    discord_server.ws_url = f'ws://127.0.0.1:{port}/gateway'
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+
+    sys.path.insert(0, BOT_DIR)
+    from metrics import process_rss_bytes
+
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--run-bot', base_url], cwd=workdir)
+    rss = {}
+    try:
+        await asyncio.wait_for(discord_server.connected.wait(), timeout=60)
+        rss['connect'] = process_rss_bytes(child.pid)   # サーバーを受け取る前
+        await asyncio.wait_for(discord_server.ready.wait(), timeout=60)
+        # on_ready まで (GUILD_CREATE の受信待ちが終わるまで) 待つ
+        await asyncio.sleep(args.warmup)
+        rss['ready'] = process_rss_bytes(child.pid)
+
+        traffic = replay_traffic(args.replay, guilds) if args.replay else synthetic_traffic(rng, guilds, args)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        total = int(args.rate * args.duration)
+        send_lag = []
+        kinds = defaultdict(int)
+        heartbeats_before = len(discord_server.heartbeats)
+        for i in range(total):
+            target = start + i / args.rate
+            delay = target - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            else:
+                send_lag.append(-delay * 1000)
+            guild_id, channel_id, content, expect, kind = next(traffic)
+            kinds[kind] += 1
+            await discord_server.send_message(guild_id, channel_id, content, expect, kind)
+        elapsed = loop.time() - start
+        # 最後の返信を待つ
+        await asyncio.sleep(args.drain)
+        rss['end'] = process_rss_bytes(child.pid)
+    finally:
+        child.send_signal(signal.SIGINT)
+        try:
+            child.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            child.kill()
+        await runner.cleanup()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    heartbeats = discord_server.heartbeat_report()
+    heartbeats['received_during_load'] = len(discord_server.heartbeats) - heartbeats_before
+    return {
+        'config': {key: value for key, value in vars(args).items() if key != 'run_bot'},
+        'traffic': {
+            'sent': total,
+            'elapsed_s': elapsed,
+            'achieved_rate': total / elapsed if elapsed else None,
+            'by_kind': dict(kinds),
+            'generator_lag_ms': summarize(send_lag),
+        },
+        'latency_ms': {kind: summarize(values) for kind, values in discord_server.latencies.items()},
+        'unanswered': discord_server.unanswered(),
+        'unexpected_replies': discord_server.unexpected_replies,
+        'heartbeat': heartbeats,
+        'rate_limits': discord_server.ratelimit_report(),
+        'twitter': twitter_server.report(),
+        'memory': memory_report(rss, args),
+    }
+
+
+def memory_report(rss, args):
+    """子プロセスのRSS (MB) と、接続後に増えた分の1サーバーあたり (KB)"""
+    report = {'profile': args.gateway_profile}
+    for key, value in rss.items():
+        report[f'rss_{key}_mb'] = value / 1024 / 1024 if value is not None else None
+    if rss.get('connect') is not None and rss.get('ready') is not None:
+        report['per_guild_kb'] = (rss['ready'] - rss['connect']) / 1024 / args.guilds
+    if rss.get('ready') is not None and rss.get('end') is not None:
+        report['growth_during_load_mb'] = (rss['end'] - rss['ready']) / 1024 / 1024
+    return report
+
+
+def print_report(report):
+    traffic = report['traffic']
+    print(f"送信: {traffic['sent']} 件 / {traffic['elapsed_s']:.1f}秒 ({traffic['achieved_rate']:.1f} msg/s)")
+    for kind, stats in sorted(report['latency_ms'].items()):
+        print(f"  {kind:<12} 返信 {stats['count']:>6}件  p50 {stats['p50']:8.1f}ms  p99 {stats['p99']:8.1f}ms  "
+              f"max {stats['max']:8.1f}ms")
+    if report['unanswered']:
+        print(f"  返信なし: {report['unanswered']}")
+    hb = report['heartbeat']
+    jitter = hb['jitter_ms']
+    if jitter['count']:
+        print(f"ハートビート: {hb['received']}回  揺らぎ p50 {jitter['p50']:.1f}ms  p99 {jitter['p99']:.1f}ms  "
+              f"最大間隔 {hb['max_gap_ms']:.0f}ms (設定 {hb['interval_ms']}ms)")
+    rl = report['rate_limits']
+    print(f"REST: {rl['requests']}件  429: {rl['status_429']}件  "
+          f"1チャンネルの最大 {rl['busiest_channel_window']}件/{rl['channel_limit']}")
+    tw = report['twitter']
+    print(f"Twitter: {tw['requests']}件  429: {tw['status_429']}件")
+    mem = report['memory']
+    if mem.get('per_guild_kb') is not None:
+        print(f"メモリ ({mem['profile']}): 接続時 {mem['rss_connect_mb']:.1f}MB → 起動後 {mem['rss_ready_mb']:.1f}MB "
+              f"(1サーバーあたり {mem['per_guild_kb']:.1f}KB)", end='')
+        if mem.get('growth_during_load_mb') is not None:
+            print(f"  負荷中の増加 {mem['growth_during_load_mb']:+.1f}MB", end='')
+        print()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description='偽のDiscord/Twitterに本物のbotを接続して負荷をかける')
+    parser.add_argument('--guilds', type=int, default=100)
+    parser.add_argument('--rate', type=float, default=50, help='1秒あたりのメッセージ数')
+    parser.add_argument('--duration', type=float, default=30, help='送信する秒数')
+    parser.add_argument('--triggers', type=int, default=20, help='サーバーごとの反応ワード数')
+    parser.add_argument('--quotes', type=int, default=100, help='サーバーごとの語録数')
+    parser.add_argument('--trigger-ratio', type=float, default=0.3)
+    parser.add_argument('--add-quote-ratio', type=float, default=0.02)
+    parser.add_argument('--art-ratio', type=float, default=0.02, help='!かなたーと の割合 (0でTwitterなし)')
+    parser.add_argument('--replay', help='流すメッセージのJSON Lines')
+    parser.add_argument('--backend', choices=['json', 'sqlite'], default='json')
+    parser.add_argument('--cooldowns', action='store_true', help='クールダウンを既定値のまま有効にする')
+    parser.add_argument('--gateway-profile', choices=['default', 'low_memory'], default='default',
+                        help='Botの gateway.profile (メモリの比較用)')
+    parser.add_argument('--heartbeat-ms', type=int, default=1000, help='ゲートウェイのハートビート間隔')
+    parser.add_argument('--channel-limit', type=int, default=5, help='チャンネルごとの送信回数の上限')
+    parser.add_argument('--channel-per', type=float, default=5.0, help='その上限の秒数')
+    parser.add_argument('--twitter-delay', type=float, default=0.5, help='Twitter APIの応答時間 (秒)')
+    parser.add_argument('--twitter-limit', type=int, default=450, help='Twitter APIの15分あたりの上限')
+    parser.add_argument('--warmup', type=float, default=3.0)
+    parser.add_argument('--drain', type=float, default=10.0, help='送信後に返信を待つ秒数')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='結果を保存するJSONファイル')
+    parser.add_argument('--run-bot', metavar='URL', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_bot:
+        run_bot(args.run_bot)
+        return
+
+    output = os.path.abspath(args.output) if args.output else None
+    if args.replay:
+        args.replay = os.path.abspath(args.replay)
+    report = asyncio.run(run(args))
+    print_report(report)
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main_cli()
@@ -0,0 +1,114 @@
+"""シャードを複数プロセスに分けてBotを起動するランチャー
+
+使い方: python cluster.py --processes 2 [--shards 8]
+
+各プロセスは main.py を担当シャードの範囲を環境変数で指定して起動する。
+設定は全プロセスで共有するため、settings.json で storage.backend を sqlite にしておく。
+"""
+import argparse
+import json
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+import urllib.request
+
+from storage import open_store
+
+ENV_SHARD_COUNT = 'PP_ANGEL_SHARD_COUNT'
+ENV_SHARD_IDS = 'PP_ANGEL_SHARD_IDS'
+ENV_CLUSTER_ID = 'PP_ANGEL_CLUSTER_ID'
+
+
+def recommended_shard_count(token):
+    """Discordが推奨するシャード数を取得"""
+    request = urllib.request.Request(
+        'https://discord.com/api/v10/gateway/bot',
+        headers={'Authorization': f'Bot {token}', 'User-Agent': 'PP-Angel cluster launcher'}
+    )
+    with urllib.request.urlopen(request, timeout=10) as response:
+        return json.load(response)['shards']
+
+
+def split_shards(shard_count, processes):
+    """シャードIDをプロセス数でなるべく均等に分ける"""
+    processes = min(processes, shard_count)
+    size, rest = divmod(shard_count, processes)
+    ranges = []
+    start = 0
+    for i in range(processes):
+        end = start + size + (1 if i < rest else 0)
+        ranges.append(list(range(start, end)))
+        start = end
+    return ranges
+
+
+def load_storage_settings():
+    if os.path.exists('settings.json'):
+        with open('settings.json', 'r', encoding='utf-8') as f:
+            return json.load(f).get('storage', {})
+    return {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='シャードを複数プロセスに分けてBotを起動')
+    parser.add_argument('--processes', type=int, default=2, help='起動するプロセス数')
+    parser.add_argument('--shards', type=int, default=None, help='シャード数 (省略時はDiscordの推奨値)')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(message)s')   # 設定の移行などの通知を表示する
+
+    storage = load_storage_settings()
+    if storage.get('backend') != 'sqlite':
+        sys.exit('複数プロセスで起動するには settings.json で storage.backend を "sqlite" にしてください')
+    # 初回の移行は子プロセスを起動する前に1回だけ行う
+    open_store('sqlite', storage.get('path')).close()
+
+    shard_count = args.shards
+    if shard_count is None:
+        with open('token.txt', 'r') as f:
+            shard_count = recommended_shard_count(f.read().strip())
+    ranges = split_shards(shard_count, args.processes)
+
+    def spawn(cluster_id):
+        env = dict(os.environ)
+        env[ENV_SHARD_COUNT] = str(shard_count)
+        env[ENV_SHARD_IDS] = ','.join(str(i) for i in ranges[cluster_id])
+        env[ENV_CLUSTER_ID] = str(cluster_id)
+        print(f'クラスター {cluster_id}: シャード {ranges[cluster_id][0]}-{ranges[cluster_id][-1]} / {shard_count}')
+        return subprocess.Popen([sys.executable, 'main.py'], env=env)
+
+    children = {cluster_id: spawn(cluster_id) for cluster_id in range(len(ranges))}
+    restarts = {cluster_id: 0 for cluster_id in children}
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for child in children.values():
+            child.send_signal(signal.SIGINT)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
+    # 落ちたプロセスは間隔を空けて再起動する
+    while not stopping:
+        time.sleep(1)
+        for cluster_id, child in list(children.items()):
+            if child.poll() is None or stopping:
+                continue
+            restarts[cluster_id] += 1
+            delay = min(60, 2 ** restarts[cluster_id])
+            print(f'クラスター {cluster_id} が終了しました (code {child.returncode})。{delay}秒後に再起動します')
+            time.sleep(delay)
+            if stopping:
+                break  # 待っている間に停止を指示された (起動すると SIGINT を受け取らないまま残る)
+            children[cluster_id] = spawn(cluster_id)
+
+    for child in children.values():
+        child.wait()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""自動返信のクールダウン・連投防止"""
+import time
+
+# 各サーバーで上書きできる項目と既定値 (どれも0でその制限を無効にする)
+DEFAULT_COOLDOWN = {
+    'guild_seconds': 0,          # サーバー全体で自動返信の間隔を空ける秒数
+    'channel_seconds': 3,        # チャンネルごとに自動返信の間隔を空ける秒数
+    'duplicate_seconds': 30,     # 同じチャンネルで同じ返信をしない秒数
+    'trigger_burst': 3,          # 反応ワード・語録ごとに連続で返信できる回数
+    'trigger_per_minute': 6,     # その回数が1分あたりに回復する量 (0 なら回数の制限なし)
+}
+
+
+class ExpiringDict:
+    """有効期限付きの辞書。タイミングホイールで期限切れを O(1) で掃除する
+
+    キーごとに期限が違っても、1秒刻みのスロットに振り分けておき、
+    時刻が進んだ分のスロットだけを掃除する。
+    """
+
+    def __init__(self, slots=4096, resolution=1.0):
+        self.resolution = resolution
+        self._slots = [[] for _ in range(slots)]
+        self._data = {}              # key -> (value, 期限)
+        self._tick = None
+
+    def __len__(self):
+        return len(self._data)
+
+    def _advance(self, now):
+        tick = int(now / self.resolution)
+        if self._tick is None:
+            self._tick = tick
+            return
+        # 進んだ分のスロットを掃除 (一周以上空いたら全スロット1回ずつ)
+        steps = min(tick - self._tick, len(self._slots))
+        for step in range(1, steps + 1):
+            slot = self._slots[(self._tick + step) % len(self._slots)]
+            keep = []
+            for key in slot:
+                entry = self._data.get(key)
+                if entry is None:
+                    continue
+                if entry[1] <= now:
+                    del self._data[key]
+                elif int(entry[1] / self.resolution) % len(self._slots) == (self._tick + step) % len(self._slots):
+                    keep.append(key)  # 一周以上先の期限
+            slot[:] = keep
+        self._tick = max(self._tick, tick)
+
+    def get(self, key, now, default=None):
+        self._advance(now)
+        entry = self._data.get(key)
+        if entry is None or entry[1] <= now:
+            return default
+        return entry[0]
+
+    def set(self, key, value, ttl, now):
+        self._advance(now)
+        expires = now + ttl
+        self._data[key] = (value, expires)
+        self._slots[int(expires / self.resolution) % len(self._slots)].append(key)
+
+
+class CooldownManager:
+    """サーバー・チャンネルのクールダウン、返信ごとのトークンバケット、重複返信の抑制"""
+
+    def __init__(self, defaults=None):
+        self.defaults = dict(DEFAULT_COOLDOWN, **(defaults or {}))
+        self.suppressed = 0
+        self._marks = ExpiringDict()     # クールダウン中・重複抑制中の印
+        self._buckets = ExpiringDict()   # 満タンになるまでの間だけトークン数を保持
+
+    def settings_for(self, overrides):
+        if not overrides:
+            return self.defaults
+        return dict(self.defaults, **overrides)
+
+    def allow(self, cfg, guild_id, channel_id, key, response_key, now=None):
+        """自動返信してよいか判定し、よければ返信ごとのトークンを消費する
+
+        サーバー・チャンネルのクールダウンは mark() で開始する。
+        """
+        now = time.monotonic() if now is None else now
+        marks = self._marks
+        if (marks.get(('guild', guild_id), now) or marks.get(('channel', channel_id), now)
+                or marks.get(('dup', channel_id, response_key), now)):
+            self.suppressed += 1
+            return False
+
+        # トークンバケット (消費した分は trigger_per_minute の速さで回復)
+        # 回復しないバケットは満タンに戻らず消せないので、どちらかが0なら回数は制限しない
+        capacity = cfg['trigger_burst']
+        rate = cfg['trigger_per_minute'] / 60.0
+        if capacity > 0 and rate > 0:
+            bucket_key = (guild_id, key)
+            bucket = self._buckets.get(bucket_key, now)
+            if bucket is None:
+                tokens = capacity
+            else:
+                tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+            if tokens < 1:
+                self.suppressed += 1
+                return False
+            tokens -= 1
+            self._buckets.set(bucket_key, (tokens, now), (capacity - tokens) / rate, now)
+
+        if cfg['duplicate_seconds'] > 0:
+            marks.set(('dup', channel_id, response_key), True, cfg['duplicate_seconds'], now)
+        return True
+
+    def mark(self, cfg, guild_id, channel_id, now=None):
+        """自動返信したのでサーバー・チャンネルのクールダウンを開始する"""
+        now = time.monotonic() if now is None else now
+        if cfg['guild_seconds'] > 0:
+            self._marks.set(('guild', guild_id), True, cfg['guild_seconds'], now)
+        if cfg['channel_seconds'] > 0:
+            self._marks.set(('channel', channel_id), True, cfg['channel_seconds'], now)
+
+    def stats(self):
+        return {'suppressed': self.suppressed, 'tracked': len(self._marks) + len(self._buckets)}
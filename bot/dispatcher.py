@@ -0,0 +1,140 @@
+"""送信キュー (チャンネルごとの順番待ち・優先度・重複の統合)"""
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+
+log = logging.getLogger('pp_angel.dispatcher')
+
+# 数字が小さいほど先に送る
+PRIORITY_ADMIN = 0    # 管理者コマンドの返信
+PRIORITY_NORMAL = 1   # 通常のコマンドの返信・エラー
+PRIORITY_LOW = 2      # 反応ワード・語録の自動返信、定期投稿
+
+
+class _Item:
+    __slots__ = ('priority', 'seq', 'channel', 'kwargs', 'merge_key', 'future', 'queued_at')
+
+    def __init__(self, priority, seq, channel, kwargs, merge_key, future):
+        self.priority = priority
+        self.seq = seq
+        self.channel = channel
+        self.kwargs = kwargs
+        self.merge_key = merge_key
+        self.future = future
+        self.queued_at = time.perf_counter()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class _ChannelQueue:
+    __slots__ = ('heap', 'merge_keys', 'worker')
+
+    def __init__(self):
+        self.heap = []
+        self.merge_keys = {}   # merge_key -> 待機中の _Item
+        self.worker = None
+
+
+class OutboundDispatcher:
+    """送信をチャンネルごとのキューに入れ、1チャンネルずつ順番に送る
+
+    Discordのメッセージ送信のレート制限はチャンネル単位なので、チャンネルごとに
+    直列化すればハンドラーが制限待ちで溜まらない。キューが溢れたら優先度の低い
+    ものから捨て、同じ内容の自動返信が待機中なら1つにまとめる。
+    """
+
+    def __init__(self, max_depth=20, latency_samples=1000):
+        self.max_depth = max_depth
+        self.sent = 0
+        self.dropped = 0
+        self.merged = 0
+        self.failed = 0
+        self._queues = {}
+        self._seq = itertools.count()
+        self._latencies = deque(maxlen=latency_samples)  # キュー投入から送信完了まで (ミリ秒)
+
+    def send(self, channel, priority=PRIORITY_NORMAL, merge_key=None, **kwargs):
+        """送信を予約して Future を返す (結果は送信した Message、捨てられた場合は None)"""
+        loop = asyncio.get_running_loop()
+        queue = self._queues.get(channel.id)
+        if queue is None:
+            queue = self._queues[channel.id] = _ChannelQueue()
+
+        if merge_key is not None and merge_key in queue.merge_keys:
+            # 同じ内容が送信待ちなら新しく送らない
+            self.merged += 1
+            return queue.merge_keys[merge_key].future
+
+        item = _Item(priority, next(self._seq), channel, kwargs, merge_key, loop.create_future())
+        if len(queue.heap) >= self.max_depth:
+            worst = max(queue.heap)
+            if not item < worst:
+                self._drop(queue, item)
+                return item.future
+            queue.heap.remove(worst)
+            heapq.heapify(queue.heap)
+            self._drop(queue, worst)
+
+        heapq.heappush(queue.heap, item)
+        if merge_key is not None:
+            queue.merge_keys[merge_key] = item
+        if queue.worker is None:
+            queue.worker = loop.create_task(self._drain(channel.id, queue))
+        return item.future
+
+    def _drop(self, queue, item):
+        self.dropped += 1
+        if item.merge_key is not None and queue.merge_keys.get(item.merge_key) is item:
+            del queue.merge_keys[item.merge_key]
+        if not item.future.done():
+            item.future.set_result(None)
+
+    async def _drain(self, channel_id, queue):
+        try:
+            while queue.heap:
+                item = heapq.heappop(queue.heap)
+                if item.merge_key is not None and queue.merge_keys.get(item.merge_key) is item:
+                    del queue.merge_keys[item.merge_key]
+                try:
+                    # レート制限の待ちは discord.py がルートごとに行う
+                    message = await item.channel.send(**item.kwargs)
+                except Exception as e:
+                    self.failed += 1
+                    log.warning('送信エラー: %s', e, extra={'channel_id': channel_id})
+                    message = None
+                else:
+                    self.sent += 1
+                    self._latencies.append((time.perf_counter() - item.queued_at) * 1000)
+                if not item.future.done():
+                    item.future.set_result(message)
+        finally:
+            queue.worker = None
+            if not queue.heap:
+                self._queues.pop(channel_id, None)
+
+    def depth(self):
+        return sum(len(q.heap) for q in self._queues.values())
+
+    def stats(self):
+        latencies = sorted(self._latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return latencies[min(len(latencies) - 1, int(len(latencies) * p))]
+
+        return {
+            'queued': self.depth(),
+            'channels': len(self._queues),
+            'max_channel_depth': max((len(q.heap) for q in self._queues.values()), default=0),
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'merged': self.merged,
+            'failed': self.failed,
+            'latency_p50_ms': percentile(0.5),
+            'latency_p99_ms': percentile(0.99),
+        }
@@ -1,41 +1,263 @@
+import time
+BOOT_STARTED = time.perf_counter()   # 起動時間の内訳の計測用 (on_ready でログに出す)
 import discord
 from discord.ext import commands, tasks
+import io
 import json
-import random
-from datetime import time, datetime, timedelta
+import logging
 import os
-import tweepy
+import signal
+import asyncio
+from models import GuildState, build_matcher
+from persistence import ConfigWriter
+from storage import open_store, GuildCache
+from scheduler import QuoteScheduler, parse_schedule
+from dispatcher import OutboundDispatcher, PRIORITY_ADMIN, PRIORITY_NORMAL, PRIORITY_LOW
+from cooldown import CooldownManager, DEFAULT_COOLDOWN
+import quote_io
+from search import build_index
+from pages import Paginator, PageCache, clip
+from metrics import Metrics, LoopLagMonitor, start_http_server, setup_logging, process_rss_bytes
+from media import MediaStore, EXTENSIONS as MEDIA_EXTENSIONS, url_expired
+from snapshot import load_snapshot, save_snapshot, freeze, thaw
+from sampler import ShuffleBag, RotationStore, MAX_WEIGHT
 
-# 設定ファイルの読み込み
+# 起動の各段階にかかった時間 (秒)
+startup_timings = {}
+_startup_mark = BOOT_STARTED
+
+def startup_phase(name):
+    """前の段階からの経過時間を name として記録する"""
+    global _startup_mark
+    now = time.perf_counter()
+    startup_timings[name] = now - _startup_mark
+    _startup_mark = now
+
+startup_phase('imports')
+
+# Botの動作設定 (settings.json があれば上書き)
+DEFAULT_SETTINGS = {
+    'storage': {
+        'backend': 'json',         # 'json' (config.json) または 'sqlite'
+        'path': None,              # 省略時は json なら config.json、sqlite なら bot.db
+        'idle_minutes': 30,        # この時間使われないサーバーはメモリから解放
+        'reload_seconds': 5,       # config.json が外で編集されたか確認する間隔 (null で無効、jsonのみ)
+        'snapshot_path': 'state.snapshot'  # 照合器などの派生データを終了時に保存し、次の起動で使う (null で無効)
+    },
+    'twitter': {
+        'hashtags': ['かなたーと'],        # 画像を取得できるハッシュタグ
+        'cache_path': 'twitter_cache.json',
+        'refresh_minutes': 25,            # これより古いキャッシュは裏で更新
+        'max_hashtags': 16,               # キャッシュするハッシュタグ数の上限 (LRU)
+        'max_images': 1000,               # ハッシュタグごとの画像数の上限
+        'pages_per_refresh': 2            # 1回の更新で取得するページ数
+    },
+    'cooldown': dict(DEFAULT_COOLDOWN),   # 自動返信のクールダウンの既定値 (!set_cooldownで上書き)
+    'gateway': {
+        'profile': 'default',             # 'low_memory' でキャッシュを減らし、必要なIntentsだけで接続
+        'max_messages': None              # メッセージキャッシュの件数 (0 で無効、省略時はプロファイルの値)
+    },
+    'sharding': {
+        'enabled': False,                 # AutoShardedBotで起動 (cluster.py からは自動で有効)
+        'shard_count': None               # 省略時はDiscordの推奨値
+    },
+    'dispatcher': {
+        'max_depth': 20                   # チャンネルごとの送信待ちの上限
+    },
+    'schedule': {
+        'path': 'schedule.json',          # 次の投稿時刻の保存先
+        'default_time': '12:00',          # !set_schedule していないサーバーの投稿時刻
+        'timezone': 'Asia/Tokyo',
+        'concurrency': 10,                # 同時に投稿するサーバー数
+        'rotation_path': 'rotation.json'  # 語録・画像を1巡させる位置の保存先 (再起動しても続きから出す)
+    },
+    'metrics': {
+        'host': '127.0.0.1',              # Prometheus形式の /metrics を公開するアドレス
+        'port': 9108,                     # null で無効 (クラスターではクラスターIDを足す)
+        'loop_lag_interval': 0.5          # イベントループの遅れを測る間隔 (秒)
+    },
+    'media': {
+        'path': 'media',                  # 語録の画像の保存先 (内容のハッシュで保存)
+        'max_mb': 512,                    # 合計サイズの上限 (超えたら使われていない順に消す)
+        'variant_max_side': None          # 長辺をこのピクセル数に縮小した版を送る (Pillowが必要)
+    },
+    'logging': {
+        'level': 'INFO',
+        'format': 'json',                 # 'json' (1行1レコード) または 'text'
+        'path': None                      # 省略時は標準エラー出力
+    }
+}
+
+def load_settings():
+    settings = {key: dict(value) for key, value in DEFAULT_SETTINGS.items()}
+    if os.path.exists('settings.json'):
+        with open('settings.json', 'r', encoding='utf-8') as f:
+            for key, value in json.load(f).items():
+                if isinstance(value, dict):
+                    settings.setdefault(key, {}).update(value)
+                else:
+                    settings[key] = value
+    return settings
+
+settings = load_settings()
+
+# ログは別スレッドで書き出す
+log_listener = setup_logging(**settings['logging'])
+log = logging.getLogger('pp_angel.main')
+
+# 計測 (!stats と /metrics で公開)
+metrics = Metrics()
+loop_lag = LoopLagMonitor(metrics, interval=settings['metrics']['loop_lag_interval'])
+
+# シャード構成 (cluster.py から起動された場合は環境変数で担当シャードが渡される)
+CLUSTER_ID = os.environ.get('PP_ANGEL_CLUSTER_ID')
+SHARD_IDS = [int(i) for i in os.environ['PP_ANGEL_SHARD_IDS'].split(',')] \
+    if os.environ.get('PP_ANGEL_SHARD_IDS') else None
+SHARD_COUNT = int(os.environ.get('PP_ANGEL_SHARD_COUNT') or settings['sharding']['shard_count'] or 0) or None
+SHARDED = CLUSTER_ID is not None or settings['sharding']['enabled']
+
+startup_phase('settings')
+
+# 派生データのスナップショット (クラスターではクラスターごとのファイル)
+snapshot_path = settings['storage']['snapshot_path']
+if snapshot_path and CLUSTER_ID is not None:
+    _root, _ext = os.path.splitext(snapshot_path)
+    snapshot_path = f'{_root}-{CLUSTER_ID}{_ext}'
+
+# 設定の読み込み（サーバーごとに必要になった時に読み込む）
 def load_config():
-    if os.path.exists('config.json'):
-        with open('config.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
-    return {'servers': {}}
+    storage_settings = settings['storage']
+    origin = f'cluster-{CLUSTER_ID}' if CLUSTER_ID is not None else None
+    store = open_store(storage_settings['backend'], storage_settings['path'], origin=origin)
+    # 設定ファイルが前回の終了時から変わっていなければ、照合器ごと復元する
+    snapshot = load_snapshot(snapshot_path, store.fingerprint()) if snapshot_path else None
+    cache = GuildCache(store, idle_seconds=storage_settings['idle_minutes'] * 60,
+                       wrap=GuildState.from_dict, known=snapshot.guild_ids if snapshot else None)
+    if snapshot:
+        cache.preload(snapshot.frozen, thaw)
+        log.info('スナップショットから起動しました', extra={'guilds': len(snapshot.guild_ids),
+                                                             'frozen': len(snapshot.frozen)})
+    return cache
+
+servers = load_config()
+startup_phase('config')
+
+def write_snapshot():
+    """終了時にメモリ上のサーバー設定を保存する (未保存の変更を書き込んだ後に呼ぶ)"""
+    if not snapshot_path:
+        return
+    try:
+        # 一度も使われなかったサーバーは読んだ時のまま書き戻す
+        frozen = servers.frozen()
+        for guild_id, state in servers.loaded().items():
+            state.matcher.compile()   # 追加・削除を組み込んだ状態で保存する
+            frozen[guild_id] = freeze(state)
+        size = save_snapshot(snapshot_path, servers.store.fingerprint(), servers.ids(), frozen)
+    except Exception as e:
+        log.warning('スナップショットを保存できませんでした: %s', e)
+        return
+    log.info('スナップショットを保存しました', extra={'guilds': len(frozen), 'bytes': size})
+
+# 書き込みはまとめて後からイベントループ外で行う
+config_writer = ConfigWriter(servers.store, serialize=GuildState.to_dict)
+config_writer.on_flush.append(
+    lambda seconds: metrics.observe('save_config_seconds', seconds, help='設定の書き込み時間 (秒)'))
+
+def save_config(guild_id):
+    config_writer.mark_dirty(guild_id, servers.get(guild_id))
+
+# 語録の画像 (DiscordのURLは期限付きなので、追加時にローカルにも保存しておく)
+media_settings = settings['media']
+media_store = MediaStore(media_settings['path'], max_bytes=media_settings['max_mb'] * 1024 * 1024,
+                         variant_max_side=media_settings['variant_max_side'])
+media_store.load()
+startup_phase('media')
+
+# Intentsとキャッシュの設定
+def gateway_options(gateway_settings):
+    """(Intents, Botに渡すキャッシュの設定) を返す"""
+    profile = gateway_settings['profile']
+    if profile == 'low_memory':
+        # 使うのはサーバーとチャンネル (get_guild / get_channel) とメッセージの本文だけ。
+        # メンバーはメッセージに付いてくる分で権限を確認できるので保持しない
+        intents = discord.Intents.none()
+        intents.guilds = True
+        intents.guild_messages = True
+        intents.message_content = True
+        options = {'max_messages': 0, 'member_cache_flags': discord.MemberCacheFlags.none(),
+                   'chunk_guilds_at_startup': False}
+    elif profile == 'default':
+        intents = discord.Intents.default()
+        intents.message_content = True  # これを有効にするにはDeveloper Portalで設定が必要
+        intents.guilds = True
+        options = {'max_messages': 1000}
+    else:
+        raise ValueError(f"gateway.profile は 'default' か 'low_memory' です ({profile})")
+    if gateway_settings['max_messages'] is not None:
+        options['max_messages'] = gateway_settings['max_messages']
+    options['max_messages'] = options['max_messages'] or None   # discord.py では None で無効
+    return intents, options
+
+intents, gateway_cache_options = gateway_options(settings['gateway'])
+
+if SHARDED:
+    bot = commands.AutoShardedBot(command_prefix='!', intents=intents,
+                                  shard_ids=SHARD_IDS, shard_count=SHARD_COUNT, **gateway_cache_options)
+else:
+    bot = commands.Bot(command_prefix='!', intents=intents, **gateway_cache_options)
+
+def owns_guild(guild_id):
+    """このプロセスが担当するサーバーか (シャードIDは (guild_id >> 22) % シャード数)"""
+    if SHARD_IDS is None or not SHARD_COUNT:
+        return True
+    return (int(guild_id) >> 22) % SHARD_COUNT in SHARD_IDS
 
-def save_config(config):
-    with open('config.json', 'w', encoding='utf-8') as f:
-        json.dump(config, f, ensure_ascii=False, indent=2)
+# 自動返信のクールダウン・連投防止
+cooldowns = CooldownManager(settings['cooldown'])
 
-# Intentsの設定
-intents = discord.Intents.default()
-intents.message_content = True  # これを有効にするにはDeveloper Portalで設定が必要
-intents.guilds = True
+# 送信はチャンネルごとのキューを通す
+dispatcher = OutboundDispatcher(max_depth=settings['dispatcher']['max_depth'])
 
-bot = commands.Bot(command_prefix='!', intents=intents)
+async def reply(ctx, content=None, **kwargs):
+    """コマンドへの返信を送信キューに入れる（権限チェック付きの管理者コマンドは優先）"""
+    priority = PRIORITY_ADMIN if ctx.command and ctx.command.checks else PRIORITY_NORMAL
+    return dispatcher.send(ctx.channel, priority=priority, content=content, **kwargs)
 
-config = load_config()
+def send_quote(channel, guild_id, quote, priority=PRIORITY_LOW, merge_key=None):
+    """語録を送信キューに入れる。画像のURLが期限切れなら保存しておいた画像を添付する"""
+    if quote.media and (not quote.image or url_expired(quote.image)):
+        path = media_store.path(quote.media)
+        if path:
+            filename = f'quote-{quote.id}{os.path.splitext(path)[1]}'
+            embed = discord.Embed(description=quote.text, color=discord.Color.blue())
+            embed.set_image(url=f'attachment://{filename}')
+            future = dispatcher.send(channel, priority=priority, merge_key=merge_key, embed=embed,
+                                     file=discord.File(path, filename=filename))
+            future.add_done_callback(lambda f: _remember_image_url(guild_id, quote, f))
+            return future
+    return dispatcher.send(channel, priority=priority, merge_key=merge_key, **quote.payload())
+
+def _remember_image_url(guild_id, quote, future):
+    """添付して送った画像の新しいURLを、期限が切れるまで次からの送信に使う"""
+    message = None if future.cancelled() else future.result()
+    if message is None or not message.attachments or not servers.is_loaded(guild_id):
+        return
+    if servers[guild_id].get_quote(quote.id) is quote:
+        quote.image = message.attachments[0].url
+        save_config(guild_id)
 
 # Twitter API設定
 def setup_twitter_api():
     """Twitter APIクライアントのセットアップ"""
+    from twitter_quota import QuotaTrackingClient
     try:
         # twitter_config.jsonから認証情報を読み込み
         if os.path.exists('twitter_config.json'):
             with open('twitter_config.json', 'r') as f:
                 twitter_config = json.load(f)
             
-            client = tweepy.Client(
+            # レート制限ヘッダーを記録するクライアント
+            client = QuotaTrackingClient(
                 bearer_token=twitter_config.get('bearer_token'),
                 consumer_key=twitter_config.get('api_key'),
                 consumer_secret=twitter_config.get('api_secret'),
@@ -45,87 +267,260 @@ def setup_twitter_api():
             return client
         return None
     except Exception as e:
-        print(f"Twitter API setup error: {e}")
+        log.error('Twitter APIのセットアップに失敗しました: %s', e)
         return None
 
-twitter_client = setup_twitter_api()
+# Twitterの機能は twitter_config.json がある場合だけ、最初に使われた時に tweepy ごと読み込む
+twitter_settings = settings['twitter']
+twitter_client = None
+twitter_cache = None
+_twitter_loading = None
 
-# Twitter画像キャッシュ
-twitter_cache = {
-    'かなたーと': {
-        'images': [],
-        'last_updated': None
-    }
-}
+def create_twitter():
+    """(クライアント, 画像キャッシュ) を作る (import とファイルの読み込みがあるのでスレッドで呼ぶ)"""
+    from twitter_images import TwitterImageFetcher, TwitterImageCache
+    client = setup_twitter_api()
+    if client is None:
+        return None, None
+    # API呼び出しは専用スレッドで行い、同時の取得は1回にまとめる
+    # 画像キャッシュは期限前に裏で更新し、再起動後も保持する
+    cache = TwitterImageCache(
+        TwitterImageFetcher(client),
+        path=twitter_settings['cache_path'],
+        refresh_after=twitter_settings['refresh_minutes'] * 60,
+        max_hashtags=twitter_settings['max_hashtags'],
+        max_images=twitter_settings['max_images'],
+        pages_per_refresh=twitter_settings['pages_per_refresh']
+    )
+    cache.load()
+    return client, cache
 
-def get_cached_twitter_images(hashtag, cache_duration_minutes=30):
-    """キャッシュされたTwitter画像を取得（有効期限付き）"""
-    cache_key = hashtag
-    
-    if cache_key not in twitter_cache:
-        twitter_cache[cache_key] = {'images': [], 'last_updated': None}
-    
-    cache_data = twitter_cache[cache_key]
+async def _start_twitter():
+    global twitter_client, twitter_cache
+    start = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    twitter_client, twitter_cache = await loop.run_in_executor(None, create_twitter)
+    if twitter_cache:
+        twitter_cache.on_refresh.append(
+            lambda hashtag, seconds, ok: metrics.observe(
+                'twitter_refresh_seconds', seconds, help='Twitterキャッシュの更新時間 (秒)',
+                status='ok' if ok else 'error'))
+        if not refresh_twitter_cache.is_running():
+            refresh_twitter_cache.start()
+    log.info('Twitterの機能を読み込みました', extra={
+        'enabled': twitter_cache is not None, 'ms': round((time.perf_counter() - start) * 1000, 1)})
+    return twitter_cache
+
+async def load_twitter():
+    """Twitter画像キャッシュを返す (初回だけ読み込み、同時に呼ばれたら同じ読み込みを待つ)。設定がなければ None"""
+    global _twitter_loading
+    if _twitter_loading is None:
+        if not os.path.exists('twitter_config.json'):
+            return None
+        _twitter_loading = asyncio.ensure_future(_start_twitter())
+    return await asyncio.shield(_twitter_loading)
+
+# 語録の定期投稿 (時刻になったサーバーだけを処理する)
+@metrics.timed('event_seconds', event='daily_quote')
+async def daily_quote(guild_id):
+    """スケジュールに従って語録を投稿"""
+    guild = bot.get_guild(int(guild_id))
+    if not guild or guild_id not in servers:
+        return
+    server_config = await servers.load(guild_id)
     
-    # キャッシュが有効かチェック
-    if cache_data['last_updated']:
-        elapsed = datetime.now() - cache_data['last_updated']
-        if elapsed < timedelta(minutes=cache_duration_minutes) and cache_data['images']:
-            return cache_data['images'], True  # キャッシュから返す
+    # 語録が登録されているかチェック
+    if not server_config.quotes or server_config.quote_channel_id is None:
+        return
     
-    return [], False  # キャッシュ無効
+    channel = guild.get_channel(server_config.quote_channel_id)
+    if channel:
+        quote = next_quote(guild_id, server_config)
+        await send_quote(channel, guild_id, quote)
 
-def update_twitter_cache(hashtag, images):
-    """Twitterキャッシュを更新"""
-    cache_key = hashtag
-    twitter_cache[cache_key] = {
-        'images': images,
-        'last_updated': datetime.now()
-    }
+schedule_settings = settings['schedule']
+schedule_path = schedule_settings['path']
+if CLUSTER_ID is not None:
+    # スケジュールは担当サーバーの分だけをクラスターごとのファイルに保存
+    root, ext = os.path.splitext(schedule_path)
+    schedule_path = f'{root}-{CLUSTER_ID}{ext}'
+quote_scheduler = QuoteScheduler(daily_quote, path=schedule_path,
+                                 concurrency=schedule_settings['concurrency'])
+scheduler_task = None
+
+# 語録・画像のローテーション (重み付きで1巡するまで同じものを出さない)
+rotation_path = schedule_settings['rotation_path']
+if CLUSTER_ID is not None:
+    root, ext = os.path.splitext(rotation_path)
+    rotation_path = f'{root}-{CLUSTER_ID}{ext}'
+quote_rotation = RotationStore(rotation_path)
+quote_rotation.load()
+# 解放したサーバーは位置だけを残す
+servers.on_evict.append(quote_rotation.release)
+hashtag_bags = {}   # ハッシュタグ -> (サンプラーを揃えた時の画像リスト, {URL: 画像}, ShuffleBag)
+
+def next_quote(guild_id, state):
+    """次に投稿する語録 (サーバーごとのサンプラーから選ぶ)"""
+    if not state.has_sampler():
+        # 読み込み直した設定でも、保存した位置 (使用中ならその位置) から続ける
+        state.attach_sampler(quote_rotation.cursor(guild_id))
+    quote = state.draw_quote()
+    quote_rotation.track(guild_id, state.sampler)
+    return quote
+
+def next_hashtag_image(hashtag, images):
+    """ハッシュタグの画像から次の1枚を選ぶ (キャッシュが更新されたら差分だけ反映)"""
+    key = f'twitter:#{hashtag}'
+    synced, by_url, bag = hashtag_bags.get(hashtag, (None, None, None))
+    if bag is None:
+        bag = ShuffleBag(cursor=quote_rotation.cursor(key))
+    if synced is not images:
+        by_url = {}
+        for image in images:
+            by_url.setdefault(image['image_url'], image)   # 同じURLは最初の画像を使う
+        bag.sync(by_url)
+        hashtag_bags[hashtag] = (images, by_url, bag)
+    url = bag.draw()
+    quote_rotation.track(key, bag)
+    return by_url[url]
+
+def default_schedule():
+    return parse_schedule(schedule_settings['default_time'], timezone=schedule_settings['timezone'])
+
+first_run = not quote_scheduler.load()
+if first_run or SHARD_IDS is not None:
+    # 初回は投稿チャンネルが設定済みのサーバーを既定の時刻で登録する。クラスターでは起動のたびに
+    # シャード数 (Discordの推奨値) が変わりうるので、担当から外れたサーバーを外し、新たに担当するものを登録する
+    dropped, added = quote_scheduler.reconcile(owns_guild, servers.store.channel_guild_ids(), default_schedule())
+    if dropped or added:
+        log.info('担当サーバーに合わせてスケジュールを更新しました', extra={'dropped': dropped, 'added': added})
+    # 登録するサーバーがなくても保存し、次の起動で初回扱いにしない
+    quote_scheduler.save_sync(force=first_run)
+startup_phase('scheduler')
+
+# 他のクラスが数えている値は読み出し時に取得する
+metrics.gauge('guilds', lambda: len(bot.guilds), help='接続中のサーバー数')
+metrics.gauge('guilds_loaded', servers.loaded_count, help='メモリ上に読み込んだサーバー設定の数')
+metrics.gauge('gateway_latency_seconds', lambda: bot.latency, help='ゲートウェイのハートビート応答時間')
+metrics.gauge('event_loop_lag_last_seconds', lambda: loop_lag.last_lag, help='直近のイベントループの遅れ')
+metrics.gauge('dispatcher_queued', dispatcher.depth, help='送信待ちのメッセージ数')
+for _name in ('sent', 'dropped', 'merged', 'failed'):
+    metrics.gauge(f'dispatcher_{_name}_total', lambda name=_name: getattr(dispatcher, name), kind='counter')
+metrics.gauge('autoreply_suppressed_total', lambda: cooldowns.suppressed, kind='counter',
+              help='クールダウンで抑制した自動返信')
+metrics.gauge('config_pending', lambda: config_writer.pending, help='未書き込みの設定変更')
+metrics.gauge('scheduled_posts_total', lambda: quote_scheduler.posted, kind='counter')
+metrics.gauge('scheduled_posts_failed_total', lambda: quote_scheduler.failed, kind='counter')
+metrics.gauge('process_rss_bytes', process_rss_bytes, help='プロセスの常駐メモリ (バイト)')
+metrics.gauge('media_files', lambda: len(media_store), help='保存している語録の画像の数')
+metrics.gauge('media_bytes', lambda: media_store.total_bytes, help='保存している語録の画像の合計サイズ')
+metrics.gauge('media_evicted_total', lambda: media_store.evicted, kind='counter')
+metrics_runner = None
+loop_lag_task = None
 
 @bot.event
 async def on_ready():
-    print(f'{bot.user} としてログインしました')
-    print(f'Bot ID: {bot.user.id}')
-    daily_quote.start()
+    global scheduler_task, metrics_runner, loop_lag_task
+    log.info('%s としてログインしました', bot.user, extra={'bot_id': bot.user.id, 'guilds': len(bot.guilds)})
+    if 'gateway' not in startup_timings:
+        # 接続してサーバーの情報を受け取り終わるまでを含めた起動時間の内訳
+        startup_phase('gateway')
+        log.info('起動時間の内訳', extra={
+            'total_ms': round((time.perf_counter() - BOOT_STARTED) * 1000, 1),
+            **{f'{name}_ms': round(seconds * 1000, 1) for name, seconds in startup_timings.items()}})
+    if scheduler_task is None:
+        scheduler_task = asyncio.create_task(quote_scheduler.run())
+    if loop_lag_task is None:
+        loop_lag_task = asyncio.create_task(loop_lag.run())
+    metrics_settings = settings['metrics']
+    if metrics_runner is None and metrics_settings['port']:
+        port = metrics_settings['port'] + (int(CLUSTER_ID) if CLUSTER_ID is not None else 0)
+        try:
+            metrics_runner = await start_http_server(metrics, metrics_settings['host'], port)
+        except OSError as e:
+            log.error('メトリクスのHTTPサーバーを起動できませんでした: %s', e, extra={'port': port})
+    if not evict_idle_guilds.is_running():
+        evict_idle_guilds.start()
+    if servers.store.shared and not sync_shared_store.is_running():
+        sync_shared_store.start()
+    if not servers.store.shared and settings['storage']['reload_seconds'] and not reload_config.is_running():
+        reload_config.start()
+    if not save_rotation.is_running():
+        save_rotation.start()
+
+# 照合器の構築・組み込みはスレッドで行う (サーバーごとに1つずつ)
+matcher_tasks = {}   # guild_id -> (GuildState, Task)
+
+async def _compile_matcher(state):
+    loop = asyncio.get_running_loop()
+    while not state.has_matcher():
+        versions = state.versions()
+        matcher = await loop.run_in_executor(None, build_matcher, state.matcher_source())
+        state.attach_matcher(matcher, versions)   # 作っている間に変わっていたら作り直す
+    matcher = state.matcher
+    while matcher.needs_compile():
+        start = time.perf_counter()
+        matcher.install(await loop.run_in_executor(None, matcher.compile_job()))
+        metrics.observe('matcher_compile_seconds', time.perf_counter() - start,
+                        help='照合器の構築・組み込みの時間 (秒)')
+
+def compile_matcher(guild_id, state):
+    """照合器の構築・追加や削除の組み込みを予約し、その Task を返す (実行中ならそれを返す)"""
+    entry = matcher_tasks.get(guild_id)
+    if entry is not None and entry[0] is state and not entry[1].done():
+        return entry[1]
+    task = asyncio.ensure_future(_compile_matcher(state))
+    matcher_tasks[guild_id] = (state, task)
+    task.add_done_callback(lambda t: matcher_tasks.pop(guild_id, None)
+                           if matcher_tasks.get(guild_id, (None, None))[1] is t else None)
+    return task
+
+async def guild_matcher(guild_id, state):
+    """サーバーの照合器。初回はスレッドでの構築を待ち、以降は組み込み前の変更も含めてすぐ返す"""
+    if not state.has_matcher():
+        await compile_matcher(guild_id, state)
+    matcher = state.matcher
+    if matcher.needs_compile():
+        compile_matcher(guild_id, state)
+    return matcher
 
 @bot.event
+@metrics.timed('event_seconds', event='on_message')
 async def on_message(message):
     if message.author.bot:
         return
     
     guild_id = str(message.guild.id)
     
-    if guild_id in config['servers']:
-        server_config = config['servers'][guild_id]
+    if guild_id in servers:
+        server_config = await servers.load(guild_id)   # 未読み込みならスレッドで読み込む
+        # 反応ワード・語録を1回の走査でチェック
+        matcher = await guild_matcher(guild_id, server_config)
+        trigger, quote = matcher.search(message.content)
+        metrics.inc('matcher_total', help='on_message の反応ワード・語録の判定結果',
+                    result='both' if trigger and quote else 'trigger' if trigger
+                    else 'quote' if quote else 'miss')
         
-        # 反応ワードのチェック
-        if 'triggers' in server_config:
-            for trigger in server_config['triggers']:
-                if trigger['word'] in message.content:
-                    await message.channel.send(trigger['response'])
-                    break
+        if trigger or quote:
+            # クールダウン中・連投・同じ返信の繰り返しは返信しない
+            channel_id = message.channel.id
+            cfg = cooldowns.settings_for(server_config.cooldown)
+            if trigger and not cooldowns.allow(cfg, guild_id, channel_id, ('trigger', trigger.word),
+                                               trigger.response):
+                trigger = None
+            if quote and not cooldowns.allow(cfg, guild_id, channel_id, ('quote', quote.id),
+                                             ('quote', quote.id)):
+                quote = None
+            if trigger or quote:
+                cooldowns.mark(cfg, guild_id, channel_id)
         
-        # 語録ワードのチェック
-        if 'quotes' in server_config and server_config['quotes']:
-            for quote in server_config['quotes']:
-                # 文字列の場合と辞書の場合の両方に対応
-                if isinstance(quote, str):
-                    quote_text = quote
-                    quote_image = None
-                else:
-                    quote_text = quote.get('text', '')
-                    quote_image = quote.get('image')
-                
-                # メッセージ内に語録のテキストが含まれているかチェック
-                if quote_text and quote_text in message.content:
-                    if quote_image:
-                        embed = discord.Embed(description=quote_text, color=discord.Color.blue())
-                        embed.set_image(url=quote_image)
-                        await message.channel.send(embed=embed)
-                    else:
-                        await message.channel.send(quote_text)
-                    break
+        # 自動返信は優先度を下げ、同じ返信が送信待ちなら1つにまとめる
+        if trigger:
+            dispatcher.send(message.channel, priority=PRIORITY_LOW,
+                            merge_key=('trigger', trigger.response), content=trigger.response)
+        
+        if quote:
+            send_quote(message.channel, guild_id, quote, merge_key=('quote', quote.id))
     
     await bot.process_commands(message)
 
@@ -138,194 +533,362 @@ async def set_channel(ctx, channel: discord.TextChannel = None):
         channel = ctx.channel
     
     guild_id = str(ctx.guild.id)
-    if guild_id not in config['servers']:
-        config['servers'][guild_id] = {}
+    servers.create(guild_id).quote_channel_id = channel.id
+    save_config(guild_id)
+    quote_scheduler.ensure(guild_id, default_schedule())
+    
+    await reply(ctx, f'✅ 語録投稿チャンネルを {channel.mention} に設定しました')
+
+@bot.command(name='set_schedule')
+@commands.has_permissions(administrator=True)
+async def set_schedule(ctx, time_text: str, interval_text: str = None, timezone: str = None):
+    """語録の投稿時刻を設定 (例: !set_schedule 12:00 / !set_schedule 09:00 180 Asia/Tokyo / !set_schedule 09:00 Asia/Tokyo)"""
+    guild_id = str(ctx.guild.id)
+    if time_text == 'off':
+        quote_scheduler.remove(guild_id)
+        await reply(ctx, '✅ 語録の定期投稿を停止しました')
+        return
+    
+    try:
+        # 2番目の引数は数値なら間隔、そうでなければタイムゾーンとして扱う
+        interval_minutes = None
+        if interval_text is not None:
+            try:
+                interval_minutes = int(interval_text)
+            except ValueError:
+                if timezone is not None:
+                    raise
+                timezone = interval_text
+        spec = parse_schedule(time_text, interval_minutes, timezone or schedule_settings['timezone'])
+    except Exception:
+        await reply(ctx, '❌ 時刻は `HH:MM`、間隔は分、タイムゾーンは `Asia/Tokyo` のように指定してください')
+        return
+    
+    next_fire = quote_scheduler.set_schedule(guild_id, spec)
+    interval = f"、{spec['interval_minutes']}分ごと" if spec['interval_minutes'] else '、毎日'
+    await reply(ctx, f"✅ 語録の投稿時刻を {spec['time']} ({spec['timezone']}){interval}に設定しました\n"
+                   f"次回: <t:{int(next_fire)}:F>")
+
+@bot.command(name='set_cooldown')
+@commands.has_permissions(administrator=True)
+async def set_cooldown(ctx, name: str = None, value: float = None):
+    """自動返信のクールダウンを設定 (例: !set_cooldown channel_seconds 5)"""
+    guild_id = str(ctx.guild.id)
+    if name is None:
+        # 現在の設定を表示
+        server_config = servers.get(guild_id)
+        cfg = cooldowns.settings_for(server_config.cooldown if server_config else None)
+        lines = [f'`{key}`: {cfg[key]}' for key in DEFAULT_COOLDOWN]
+        await reply(ctx, embed=discord.Embed(title='クールダウン設定', description='\n'.join(lines),
+                                             color=discord.Color.purple()))
+        return
     
-    config['servers'][guild_id]['quote_channel_id'] = channel.id
-    save_config(config)
+    if name not in DEFAULT_COOLDOWN:
+        keys = ' '.join(f'`{key}`' for key in DEFAULT_COOLDOWN)
+        await reply(ctx, f'❌ 設定できる項目: {keys}')
+        return
     
-    await ctx.send(f'✅ 語録投稿チャンネルを {channel.mention} に設定しました')
+    server_config = servers.create(guild_id)
+    if value is None:
+        server_config.cooldown.pop(name, None)  # 既定値に戻す
+        message = f'✅ `{name}` を既定値 ({cooldowns.defaults[name]}) に戻しました'
+    elif value < 0:
+        await reply(ctx, '❌ 0以上の値を指定してください')
+        return
+    else:
+        server_config.cooldown[name] = value
+        message = f'✅ `{name}` を {value} に設定しました'
+        if value == 0:
+            message += '（0 はこの制限を無効にします）'
+    save_config(guild_id)
+    await reply(ctx, message)
 
 @bot.command(name='add_trigger')
 @commands.has_permissions(administrator=True)
 async def add_trigger(ctx, word: str, *, response: str):
     """反応ワードを追加"""
     guild_id = str(ctx.guild.id)
-    if guild_id not in config['servers']:
-        config['servers'][guild_id] = {}
-    if 'triggers' not in config['servers'][guild_id]:
-        config['servers'][guild_id]['triggers'] = []
-    
-    config['servers'][guild_id]['triggers'].append({
-        'word': word,
-        'response': response
-    })
-    save_config(config)
+    _, created = servers.create(guild_id).add_trigger(word, response)
+    save_config(guild_id)
     
-    await ctx.send(f'✅ 反応ワードを追加しました\nワード: `{word}`\n応答: `{response}`')
+    if created:
+        await reply(ctx, f'✅ 反応ワードを追加しました\nワード: `{word}`\n応答: `{response}`')
+    else:
+        await reply(ctx, f'✅ 反応ワード `{word}` の応答を更新しました\n応答: `{response}`')
 
 @bot.command(name='remove_trigger')
 @commands.has_permissions(administrator=True)
 async def remove_trigger(ctx, word: str):
     """反応ワードを削除"""
     guild_id = str(ctx.guild.id)
-    if guild_id not in config['servers'] or 'triggers' not in config['servers'][guild_id]:
-        await ctx.send('❌ 設定された反応ワードがありません')
+    if guild_id not in servers or not servers[guild_id].triggers:
+        await reply(ctx, '❌ 設定された反応ワードがありません')
         return
     
-    triggers = config['servers'][guild_id]['triggers']
-    original_len = len(triggers)
-    config['servers'][guild_id]['triggers'] = [t for t in triggers if t['word'] != word]
-    
-    if len(config['servers'][guild_id]['triggers']) < original_len:
-        save_config(config)
-        await ctx.send(f'✅ 反応ワード `{word}` を削除しました')
+    if servers[guild_id].remove_triggers(word):
+        save_config(guild_id)
+        await reply(ctx, f'✅ 反応ワード `{word}` を削除しました')
     else:
-        await ctx.send(f'❌ 反応ワード `{word}` が見つかりませんでした')
+        await reply(ctx, f'❌ 反応ワード `{word}` が見つかりませんでした')
+
+# 一覧はページごとに描画し、一覧が変わるまで使い回す
+page_cache = PageCache()
+
+async def send_pages(ctx, kind, source, render):
+    """1ページ目を送信し、複数ページならページ送りのボタンを付ける"""
+    view = Paginator((ctx.guild.id, kind), source, render, page_cache)
+    embed = view.current()
+    if view.pages == 1:
+        view.stop()
+        await reply(ctx, embed=embed)
+        return
+    # reply() は送信キューの Future を返すので、送信されるまで待って Message を受け取る
+    view.message = await (await reply(ctx, embed=embed, view=view))
+    if view.message is None:
+        view.stop()  # 送信キューから捨てられた、または送信に失敗した
 
 @bot.command(name='list_triggers')
 async def list_triggers(ctx):
     """反応ワード一覧を表示"""
     guild_id = str(ctx.guild.id)
-    if guild_id not in config['servers'] or 'triggers' not in config['servers'][guild_id]:
-        await ctx.send('設定された反応ワードがありません')
+    if guild_id not in servers or not servers[guild_id].triggers:
+        await reply(ctx, '設定された反応ワードがありません')
         return
     
-    triggers = config['servers'][guild_id]['triggers']
-    if not triggers:
-        await ctx.send('設定された反応ワードがありません')
-        return
+    def source():
+        server_config = servers[guild_id]
+        return server_config.triggers_version, server_config.triggers
     
-    embed = discord.Embed(title='反応ワード一覧', color=discord.Color.blue())
-    for trigger in triggers:
-        embed.add_field(
-            name=f"ワード: {trigger['word']}", 
-            value=f"応答: {trigger['response']}", 
-            inline=False
-        )
-    await ctx.send(embed=embed)
+    def render(triggers, start, page, pages):
+        embed = discord.Embed(title='反応ワード一覧', color=discord.Color.blue())
+        for trigger in triggers:
+            embed.add_field(
+                name=clip(f"ワード: {trigger.word}", 100), 
+                value=clip(f"応答: {trigger.response}", 300), 
+                inline=False
+            )
+        embed.set_footer(text=f'ページ {page + 1}/{pages}')
+        return embed
+    
+    await send_pages(ctx, 'triggers', source, render)
 
 @bot.command(name='add_quote')
 @commands.has_permissions(administrator=True)
 async def add_quote(ctx, *, quote: str):
     """語録を追加（このサーバー専用）"""
     guild_id = str(ctx.guild.id)
-    if guild_id not in config['servers']:
-        config['servers'][guild_id] = {}
-    if 'quotes' not in config['servers'][guild_id]:
-        config['servers'][guild_id]['quotes'] = []
     
-    # 画像が添付されているかチェック
+    if servers.create(guild_id).find_quote(quote) is not None:
+        await reply(ctx, f'❌ 同じ語録が既に登録されています: `{quote}`')
+        return
+    
+    # 画像が添付されているかチェック (URLは期限が切れるので画像自体も保存)
     image_url = None
+    media_name = None
     if ctx.message.attachments:
         attachment = ctx.message.attachments[0]
-        if any(attachment.filename.lower().endswith(ext) for ext in ['.png', '.jpg', '.jpeg', '.gif', '.webp']):
+        ext = os.path.splitext(attachment.filename.lower())[1]
+        if ext in MEDIA_EXTENSIONS:
             image_url = attachment.url
+            try:
+                media_name = await media_store.put(await attachment.read(), ext)
+            except (discord.HTTPException, OSError, ValueError) as e:
+                log.warning('語録の画像を保存できませんでした: %s', e, extra={'guild_id': guild_id})
     
-    quote_data = {
-        'text': quote,
-        'image': image_url
-    }
-    
-    config['servers'][guild_id]['quotes'].append(quote_data)
-    save_config(config)
+    added = servers.create(guild_id).add_quote(quote, image_url, media_name)
+    if added is None:
+        await reply(ctx, f'❌ 同じ語録が既に登録されています: `{quote}`')
+        return
+    save_config(guild_id)
     
     if image_url:
-        await ctx.send(f'✅ 語録（画像付き）を追加しました: `{quote}`')
+        await reply(ctx, f'✅ 語録（画像付き）を追加しました: `{quote}` (#{added.id})')
     else:
-        await ctx.send(f'✅ 語録を追加しました: `{quote}`')
+        await reply(ctx, f'✅ 語録を追加しました: `{quote}` (#{added.id})')
 
 @bot.command(name='remove_quote')
 @commands.has_permissions(administrator=True)
 async def remove_quote(ctx, *, quote: str):
-    """語録を削除"""
+    """語録を削除（`#ID` でIDを指定して削除）"""
     guild_id = str(ctx.guild.id)
-    if guild_id not in config['servers'] or 'quotes' not in config['servers'][guild_id]:
-        await ctx.send('❌ 登録された語録がありません')
+    if guild_id not in servers or not servers[guild_id].quotes:
+        await reply(ctx, '❌ 登録された語録がありません')
         return
     
-    quotes = config['servers'][guild_id]['quotes']
-    removed = False
-    for q in quotes:
-        # 文字列の場合と辞書の場合の両方に対応
-        q_text = q if isinstance(q, str) else q.get('text', '')
-        if q_text == quote:
-            config['servers'][guild_id]['quotes'].remove(q)
-            removed = True
-            break
-    
+    server_config = servers[guild_id]
+    if quote.startswith('#') and quote[1:].isdigit():
+        removed = server_config.remove_quote_by_id(int(quote[1:]))
+    else:
+        removed = server_config.remove_quote(quote)
     if removed:
-        save_config(config)
-        await ctx.send(f'✅ 語録を削除しました: `{quote}`')
+        save_config(guild_id)
+        await reply(ctx, f'✅ 語録を削除しました: `{removed.text}` (#{removed.id})')
     else:
-        await ctx.send(f'❌ 語録が見つかりませんでした')
+        await reply(ctx, f'❌ 語録が見つかりませんでした')
+
+@bot.command(name='set_quote_weight')
+@commands.has_permissions(administrator=True)
+async def set_quote_weight(ctx, quote: str, weight: int = 1):
+    """語録の出やすさを設定 (例: !set_quote_weight #3 5)"""
+    guild_id = str(ctx.guild.id)
+    if not (quote.startswith('#') and quote[1:].isdigit()):
+        await reply(ctx, '❌ 語録は `#ID` で指定してください')
+        return
+    if not 1 <= weight <= MAX_WEIGHT:
+        await reply(ctx, f'❌ 重みは1〜{MAX_WEIGHT}で指定してください')
+        return
+    
+    server_config = servers.get(guild_id)
+    updated = server_config.set_quote_weight(int(quote[1:]), weight) if server_config else None
+    if updated is None:
+        await reply(ctx, '❌ 語録が見つかりませんでした')
+        return
+    save_config(guild_id)
+    await reply(ctx, f'✅ 語録 #{updated.id} の重みを {weight} に設定しました')
 
 @bot.command(name='list_quotes')
 async def list_quotes(ctx):
     """語録一覧を表示"""
     guild_id = str(ctx.guild.id)
-    if guild_id not in config['servers'] or 'quotes' not in config['servers'][guild_id]:
-        await ctx.send('登録された語録がありません')
+    if guild_id not in servers or not servers[guild_id].quotes:
+        await reply(ctx, '登録された語録がありません')
+        return
+    
+    def source():
+        server_config = servers[guild_id]
+        return server_config.quotes_version, server_config.quotes
+    
+    def render(quotes, start, page, pages):
+        embed = discord.Embed(title='語録一覧', color=discord.Color.green())
+        for quote in quotes:
+            has_image = ' 🖼️' if quote.image else ''
+            embed.add_field(name=f'#{quote.id}{has_image}', value=clip(quote.text, 300), inline=False)
+        embed.set_footer(text=f'ページ {page + 1}/{pages}')
+        return embed
+    
+    await send_pages(ctx, 'quotes', source, render)
+
+SEARCH_PAGE_SIZE = 10
+
+@bot.command(name='search_quote')
+async def search_quote(ctx, *, query: str):
+    """語録を検索 (例: !search_quote 天使 / 2ページ目は !search_quote 天使 2)"""
+    guild_id = str(ctx.guild.id)
+    if guild_id not in servers or not servers[guild_id].quotes:
+        await reply(ctx, '登録された語録がありません')
+        return
+    
+    # 末尾の数字はページ番号
+    page = 1
+    words = query.rsplit(maxsplit=1)
+    if len(words) == 2 and words[1].isdigit():
+        query, page = words[0], max(1, int(words[1]))
+    
+    server_config = servers[guild_id]
+    if not server_config.has_search_index():
+        # 初回はインデックスをスレッドで作る (語録が多いと時間がかかるため)
+        loop = asyncio.get_running_loop()
+        index = await loop.run_in_executor(None, build_index, server_config.quote_snapshot())
+        server_config.attach_search_index(index)
+    
+    start = time.perf_counter()
+    total, quotes = server_config.search_quotes(query, SEARCH_PAGE_SIZE, (page - 1) * SEARCH_PAGE_SIZE)
+    elapsed = (time.perf_counter() - start) * 1000
+    if not total:
+        await reply(ctx, f'❌ 「{query}」に一致する語録が見つかりませんでした')
         return
     
-    quotes = config['servers'][guild_id]['quotes']
+    pages = (total + SEARCH_PAGE_SIZE - 1) // SEARCH_PAGE_SIZE
+    embed = discord.Embed(title=f'「{query}」の検索結果 ({total}件)', color=discord.Color.green())
+    for quote in quotes:
+        has_image = ' 🖼️' if quote.image else ''
+        text = quote.text if len(quote.text) <= 200 else quote.text[:200] + '...'
+        embed.add_field(name=f'#{quote.id}{has_image}', value=text, inline=False)
     if not quotes:
-        await ctx.send('登録された語録がありません')
+        embed.description = 'このページには結果がありません'
+    embed.set_footer(text=f'ページ {page}/{pages} ・ {elapsed:.1f}ms')
+    await reply(ctx, embed=embed)
+
+# 語録のインポート・エクスポート
+IMPORT_MAX_BYTES = 8 * 1024 * 1024
+
+@bot.command(name='import_quotes')
+@commands.has_permissions(administrator=True)
+async def import_quotes(ctx):
+    """添付したJSON/CSVから語録をまとめて追加"""
+    if not ctx.message.attachments:
+        await reply(ctx, '❌ JSON (.json / .jsonl) または CSV ファイルを添付してください')
+        return
+    attachment = ctx.message.attachments[0]
+    if attachment.size > IMPORT_MAX_BYTES:
+        await reply(ctx, f'❌ ファイルが大きすぎます (上限 {IMPORT_MAX_BYTES // 1024 // 1024}MB)')
         return
     
-    embed = discord.Embed(title='語録一覧', color=discord.Color.green())
-    for i, quote in enumerate(quotes, 1):
-        # 文字列の場合と辞書の場合の両方に対応
-        if isinstance(quote, str):
-            embed.add_field(name=f'{i}', value=quote, inline=False)
-        else:
-            text = quote.get('text', '')
-            has_image = '🖼️' if quote.get('image') else ''
-            embed.add_field(name=f'{i} {has_image}', value=text, inline=False)
-    await ctx.send(embed=embed)
+    loop = asyncio.get_running_loop()
+    try:
+        text = await quote_io.download(attachment.url, IMPORT_MAX_BYTES)
+        rows = await loop.run_in_executor(None, quote_io.parse_quotes, text, attachment.filename)
+    except ValueError as e:
+        await reply(ctx, f'❌ ファイルを読み込めませんでした: {e}')
+        return
+    
+    # 重複の除去と照合器の構築はスレッドで行い、ループ上では1回で反映して1回だけ保存する
+    guild_id = str(ctx.guild.id)
+    with config_writer.hold(guild_id):   # 準備している間は読み込み直し・解放しない
+        server_config = servers.create(guild_id)
+        result = None
+        while result is None:
+            # 準備している間に語録が変わったらやり直す
+            prepared = await loop.run_in_executor(None, server_config.import_job(rows))
+            result = server_config.apply_import(prepared)
+        added, skipped = result
+        if added:
+            save_config(guild_id)
+    await reply(ctx, f'✅ 語録を{added}件追加しました' + (f'（重複 {skipped}件はスキップ）' if skipped else ''))
+
+@bot.command(name='export_quotes')
+@commands.has_permissions(administrator=True)
+async def export_quotes(ctx, fmt: str = 'json'):
+    """語録をJSON/CSVファイルで出力"""
+    fmt = fmt.lower()
+    if fmt not in ('json', 'csv'):
+        await reply(ctx, '❌ 形式は `json` か `csv` を指定してください')
+        return
+    guild_id = str(ctx.guild.id)
+    if guild_id not in servers or not servers[guild_id].quotes:
+        await reply(ctx, '❌ 登録された語録がありません')
+        return
+    
+    quotes = servers[guild_id].quotes
+    loop = asyncio.get_running_loop()
+    data = await loop.run_in_executor(None, quote_io.export_quotes, quotes, fmt)
+    await reply(ctx, f'✅ 語録 {len(quotes)}件を出力しました',
+                file=discord.File(io.BytesIO(data), filename=f'quotes-{guild_id}.{fmt}'))
 
 @bot.command(name='test_quote')
 async def test_quote(ctx):
     """ランダムに語録を投稿（テスト用）"""
     guild_id = str(ctx.guild.id)
-    if guild_id not in config['servers'] or 'quotes' not in config['servers'][guild_id]:
-        await ctx.send('語録が登録されていません')
-        return
-    
-    quotes = config['servers'][guild_id]['quotes']
-    if not quotes:
-        await ctx.send('語録が登録されていません')
+    if guild_id not in servers or not servers[guild_id].quotes:
+        await reply(ctx, '語録が登録されていません')
         return
     
-    quote = random.choice(quotes)
-    
-    # 文字列の場合と辞書の場合の両方に対応
-    if isinstance(quote, str):
-        await ctx.send(quote)
-    else:
-        text = quote.get('text', '')
-        image = quote.get('image')
-        
-        if image:
-            embed = discord.Embed(description=text, color=discord.Color.blue())
-            embed.set_image(url=image)
-            await ctx.send(embed=embed)
-        else:
-            await ctx.send(text)
+    quote = next_quote(guild_id, servers[guild_id])
+    await send_quote(ctx.channel, guild_id, quote, priority=PRIORITY_NORMAL)
 
 @bot.command(name='show_config')
 async def show_config(ctx):
     """現在の設定を表示"""
     guild_id = str(ctx.guild.id)
-    if guild_id not in config['servers']:
-        await ctx.send('このサーバーの設定がありません')
+    if guild_id not in servers:
+        await reply(ctx, 'このサーバーの設定がありません')
         return
     
-    server_config = config['servers'][guild_id]
+    server_config = servers[guild_id]
     embed = discord.Embed(title='サーバー設定', color=discord.Color.purple())
     
-    if 'quote_channel_id' in server_config:
-        channel = ctx.guild.get_channel(server_config['quote_channel_id'])
+    if server_config.quote_channel_id is not None:
+        channel = ctx.guild.get_channel(server_config.quote_channel_id)
         embed.add_field(
             name='語録投稿チャンネル', 
             value=channel.mention if channel else '未設定', 
@@ -334,104 +897,246 @@ async def show_config(ctx):
     else:
         embed.add_field(name='語録投稿チャンネル', value='未設定', inline=False)
     
-    trigger_count = len(server_config.get('triggers', []))
+    spec = quote_scheduler.schedules.get(guild_id)
+    if spec:
+        interval = f"{spec['interval_minutes']}分ごと" if spec['interval_minutes'] else '毎日'
+        next_fire = int(quote_scheduler.next_fire[guild_id])
+        embed.add_field(
+            name='投稿スケジュール',
+            value=f"{spec['time']} ({spec['timezone']}) {interval}\n次回: <t:{next_fire}:F>",
+            inline=False
+        )
+    else:
+        embed.add_field(name='投稿スケジュール', value='停止中', inline=False)
+    
+    trigger_count = len(server_config.triggers)
     embed.add_field(name='反応ワード数', value=f'{trigger_count}個', inline=False)
     
-    quote_count = len(server_config.get('quotes', []))
+    quote_count = len(server_config.quotes)
     embed.add_field(name='語録数', value=f'{quote_count}個', inline=False)
     
-    await ctx.send(embed=embed)
+    await reply(ctx, embed=embed)
 
-@bot.command(name='かなたーと')
-async def kanata_art(ctx):
-    """#かなたーとのツイートから画像をランダムに取得"""
-    if not twitter_client:
-        await ctx.send('❌ Twitter APIが設定されていません')
+async def send_hashtag_art(ctx, hashtag):
+    """ハッシュタグのキャッシュから画像をランダムに1枚投稿"""
+    twitter_cache = await load_twitter()
+    if not twitter_cache:
+        await reply(ctx, '❌ Twitter APIが設定されていません')
         return
+    import tweepy
+    from twitter_quota import QuotaExceeded, SEARCH_RECENT
     
     try:
-        # キャッシュをチェック
-        cached_images, is_cached = get_cached_twitter_images('かなたーと', cache_duration_minutes=30)
-        
-        if is_cached:
-            # キャッシュから返す
-            if cached_images:
-                selected = random.choice(cached_images)
-                
-                embed = discord.Embed(
-                    description=selected['text'][:200] + ('...' if len(selected['text']) > 200 else ''),
-                    color=discord.Color.blue()
-                )
-                embed.set_image(url=selected['image_url'])
-                embed.set_footer(text=f"Tweet ID: {selected['tweet_id']} (キャッシュ)")
-                
-                await ctx.send(embed=embed)
-                return
-        
-        # キャッシュがない場合はAPIから取得
-        await ctx.send('🔍 #かなたーと から画像を検索中...')
-        
-        # ハッシュタグで検索（画像付きツイートのみ）
-        tweets = twitter_client.search_recent_tweets(
-            query='#かなたーと has:images -is:retweet',
-            max_results=100,
-            tweet_fields=['attachments', 'author_id'],
-            expansions=['attachments.media_keys'],
-            media_fields=['url', 'preview_image_url']
-        )
-        
-        if not tweets.data:
-            await ctx.send('❌ #かなたーと の画像付きツイートが見つかりませんでした')
-            return
-        
-        # メディア情報を取得
-        media_dict = {}
-        if tweets.includes and 'media' in tweets.includes:
-            for media in tweets.includes['media']:
-                media_dict[media.media_key] = media
+        # キャッシュがない場合はAPIから取得（取得中なら同じ結果を待つ）
+        if twitter_cache.age(hashtag) is None and not twitter_cache.is_refreshing(hashtag):
+            await reply(ctx, f'🔍 #{hashtag} から画像を検索中...')
+        images, is_cached = await twitter_cache.get_images(hashtag)
+        metrics.inc('twitter_cache_requests_total', help='Twitter画像のキャッシュ参照',
+                    result='hit' if is_cached else 'miss')
         
-        # 画像付きツイートを収集
-        image_tweets = []
-        for tweet in tweets.data:
-            if hasattr(tweet, 'attachments') and 'media_keys' in tweet.attachments:
-                for media_key in tweet.attachments['media_keys']:
-                    if media_key in media_dict:
-                        media = media_dict[media_key]
-                        if media.type == 'photo':
-                            image_tweets.append({
-                                'text': tweet.text,
-                                'image_url': media.url,
-                                'tweet_id': tweet.id
-                            })
-        
-        if not image_tweets:
-            await ctx.send('❌ 画像が見つかりませんでした')
+        if not images:
+            await reply(ctx, f'❌ #{hashtag} の画像付きツイートが見つかりませんでした')
             return
         
-        # キャッシュを更新
-        update_twitter_cache('かなたーと', image_tweets)
-        
-        # ランダムに1つ選択
-        selected = random.choice(image_tweets)
+        # 1巡するまで同じ画像を出さないように選ぶ
+        selected = next_hashtag_image(hashtag, images)
         
         embed = discord.Embed(
             description=selected['text'][:200] + ('...' if len(selected['text']) > 200 else ''),
             color=discord.Color.blue()
         )
         embed.set_image(url=selected['image_url'])
-        embed.set_footer(text=f"Tweet ID: {selected['tweet_id']}")
+        footer = f"Tweet ID: {selected['tweet_id']}"
+        embed.set_footer(text=footer + (' (キャッシュ)' if is_cached else ''))
         
-        await ctx.send(embed=embed)
+        await reply(ctx, embed=embed)
         
+    except QuotaExceeded as e:
+        # キャッシュがない状態で制限中 (キャッシュがあればそちらを返している)
+        minutes = max(1, int(e.retry_in // 60) + 1)
+        await reply(ctx, f'❌ Twitter APIのレート制限中です。{minutes}分後に再試行してください。')
+    except tweepy.TooManyRequests:
+        wait = twitter_client.quota.wait_seconds(SEARCH_RECENT)
+        minutes = max(1, int(wait // 60) + 1)
+        await reply(ctx, f'❌ Twitter APIのレート制限に達しました。{minutes}分後に再試行してください。')
     except tweepy.TweepyException as e:
-        error_msg = str(e)
-        if '429' in error_msg:
-            await ctx.send('❌ Twitter APIのレート制限に達しました。30分後に再試行してください。')
-        else:
-            await ctx.send(f'❌ Twitter APIエラー: {error_msg}')
+        await reply(ctx, f'❌ Twitter APIエラー: {str(e)}')
     except Exception as e:
-        await ctx.send(f'❌ エラーが発生しました: {str(e)}')
-        print(f"Error in kanata_art: {e}")
+        await reply(ctx, f'❌ エラーが発生しました: {str(e)}')
+        log.exception('画像の投稿に失敗しました', extra={'hashtag': hashtag, 'guild_id': ctx.guild.id})
+
+@bot.command(name='かなたーと')
+async def kanata_art(ctx):
+    """#かなたーとのツイートから画像をランダムに取得"""
+    await send_hashtag_art(ctx, 'かなたーと')
+
+@bot.command(name='hashtag_art')
+async def hashtag_art(ctx, hashtag: str):
+    """設定されたハッシュタグのツイートから画像をランダムに取得"""
+    hashtag = hashtag.lstrip('#')
+    if hashtag not in twitter_settings['hashtags']:
+        tags = ' '.join(f'`#{tag}`' for tag in twitter_settings['hashtags'])
+        await reply(ctx, f'❌ 使用できるハッシュタグ: {tags}')
+        return
+    await send_hashtag_art(ctx, hashtag)
+
+@bot.command(name='twitter_quota')
+async def twitter_quota(ctx):
+    """Twitter APIの残り回数を表示"""
+    await load_twitter()
+    if not twitter_client:
+        await reply(ctx, '❌ Twitter APIが設定されていません')
+        return
+    
+    quotas = twitter_client.quota.snapshot()
+    if not quotas:
+        await reply(ctx, 'まだTwitter APIを呼び出していません')
+        return
+    
+    embed = discord.Embed(title='Twitter APIの残り回数', color=discord.Color.blue())
+    for route, quota in quotas.items():
+        remaining = '不明' if quota['remaining'] is None else f"{quota['remaining']}/{quota['limit']}"
+        lines = [f'残り: {remaining}']
+        if quota['reset_in'] is not None:
+            lines.append(f"リセットまで: {int(quota['reset_in'] // 60)}分{int(quota['reset_in'] % 60)}秒")
+        if quota['blocked_for']:
+            lines.append(f"制限中: あと{int(quota['blocked_for'])}秒")
+        lines.append(f"リクエスト数: {quota['requests']}")
+        embed.add_field(name=route, value='\n'.join(lines), inline=False)
+    await reply(ctx, embed=embed)
+
+@bot.command(name='shards')
+async def shards(ctx):
+    """シャードごとのレイテンシとサーバー数を表示"""
+    if servers.store.shared:
+        # 共有ストアに記録された全プロセス分
+        loop = asyncio.get_running_loop()
+        rows = await loop.run_in_executor(None, servers.store.shard_status)
+        rows = [row for row in rows if time.time() - row[4] < 120]
+    else:
+        rows = [row + (time.time(),) for row in shard_status_rows()]
+    
+    embed = discord.Embed(title='シャードの状態', color=discord.Color.purple())
+    current = ctx.guild.shard_id
+    for shard_id, cluster_id, latency, guild_count, _ in rows[:25]:
+        mark = ' (このサーバー)' if shard_id == current else ''
+        cluster = f'クラスター {cluster_id} / ' if cluster_id is not None else ''
+        latency_text = f'{latency * 1000:.0f}ms' if latency == latency else '接続中'
+        embed.add_field(
+            name=f'シャード {shard_id}{mark}',
+            value=f'{cluster}レイテンシ {latency_text} / {guild_count}サーバー',
+            inline=True
+        )
+    await reply(ctx, embed=embed)
+
+@bot.command(name='memory')
+@commands.has_permissions(administrator=True)
+async def memory(ctx):
+    """メモリ使用量とサーバーあたりの量を表示"""
+    rss = process_rss_bytes()
+    guild_count = len(bot.guilds)
+    embed = discord.Embed(title='メモリ使用量', color=discord.Color.purple())
+    if rss is None:
+        embed.add_field(name='常駐メモリ (RSS)', value='このOSでは取得できません', inline=False)
+    else:
+        lines = [f'{rss / 1024 / 1024:.1f}MB']
+        if RSS_AT_START is not None and guild_count:
+            # 接続前 (モジュール読み込み直後) からの増加分をサーバー数で割る
+            per_guild = max(0, rss - RSS_AT_START) / guild_count
+            lines.append(f'起動時 {RSS_AT_START / 1024 / 1024:.1f}MB から +{(rss - RSS_AT_START) / 1024 / 1024:.1f}MB '
+                         f'(1サーバーあたり {per_guild / 1024:.1f}KB)')
+        embed.add_field(name='常駐メモリ (RSS)', value='\n'.join(lines), inline=False)
+    
+    members = sum(len(guild.members) for guild in bot.guilds)
+    channels = sum(len(guild.channels) for guild in bot.guilds)
+    max_messages = gateway_cache_options['max_messages']
+    embed.add_field(
+        name='Discordのキャッシュ',
+        value=f"プロファイル `{settings['gateway']['profile']}`\n"
+              f'サーバー {guild_count} / チャンネル {channels} / メンバー {members}\n'
+              f"メッセージ {len(bot.cached_messages)}件 (上限 {max_messages or '無効'})",
+        inline=False
+    )
+    embed.add_field(
+        name='Botのデータ',
+        value=f'読み込み済みのサーバー設定 {servers.loaded_count()}/{len(servers)}\n'
+              f'一覧のページキャッシュ {len(page_cache)}件 / '
+              f'語録の画像 {len(media_store)}件',
+        inline=False
+    )
+    await reply(ctx, embed=embed)
+
+def _ms(seconds):
+    return '-' if seconds is None else f'{seconds * 1000:.1f}ms'
+
+@bot.command(name='stats')
+@commands.has_permissions(administrator=True)
+async def stats(ctx):
+    """Botの計測値を表示"""
+    embed = discord.Embed(title='Botの統計', color=discord.Color.purple())
+    
+    def histogram_lines(name, label, limit=10):
+        rows = sorted(metrics.histograms(name).items(), key=lambda item: -item[1].count)[:limit]
+        lines = []
+        for labels, histogram in rows:
+            summary = histogram.summary()
+            title = ' '.join(str(value) for key, value in labels if key == label) or '全体'
+            if ('status', 'error') in labels:
+                title += ' (エラー)'
+            lines.append(f"`{title}` {summary['count']}回 p50 {_ms(summary['p50'])} "
+                         f"p99 {_ms(summary['p99'])} 最大 {_ms(summary['max'])}")
+        return '\n'.join(lines) or 'まだありません'
+    
+    embed.add_field(name='イベント', value=histogram_lines('event_seconds', 'event'), inline=False)
+    embed.add_field(name='コマンド (回数の多い順)', value=histogram_lines('command_seconds', 'command'),
+                    inline=False)
+    
+    counts = {result: metrics.counter_value('matcher_total', result=result)
+              for result in ('trigger', 'quote', 'both', 'miss')}
+    total = sum(counts.values())
+    hits = total - counts['miss']
+    ratio = f' ({hits / total:.1%})' if total else ''
+    embed.add_field(
+        name='反応ワード・語録の判定',
+        value=f"{total}件中 一致 {hits}件{ratio}\n"
+              f"反応ワード {counts['trigger']} / 語録 {counts['quote']} / 両方 {counts['both']}\n"
+              f"クールダウンで抑制: {cooldowns.suppressed}件",
+        inline=False
+    )
+    
+    if twitter_cache:
+        hit = metrics.counter_value('twitter_cache_requests_total', result='hit')
+        miss = metrics.counter_value('twitter_cache_requests_total', result='miss')
+        ratio = f'{hit / (hit + miss):.1%}' if hit + miss else '-'
+        embed.add_field(
+            name='Twitterキャッシュ',
+            value=f'ヒット率 {ratio} ({hit}/{hit + miss})\n' + histogram_lines('twitter_refresh_seconds', 'status'),
+            inline=False
+        )
+    
+    media = media_store.stats()
+    embed.add_field(
+        name='語録の画像',
+        value=f"{media['files']}件 {media['bytes'] / 1024 / 1024:.1f}MB / "
+              f"上限 {media_store.max_bytes / 1024 / 1024:.0f}MB\n"
+              f"保存 {media['stored']} / 重複 {media['deduplicated']} / 削除 {media['evicted']}",
+        inline=False
+    )
+    
+    embed.add_field(name='設定の保存', value=histogram_lines('save_config_seconds', None) +
+                    f'\n未書き込み: {config_writer.pending}件', inline=False)
+    embed.add_field(name='イベントループの遅れ', value=histogram_lines('event_loop_lag_seconds', None),
+                    inline=False)
+    
+    queue = dispatcher.stats()
+    embed.add_field(
+        name='送信キュー',
+        value=f"待機 {queue['queued']}件 / 送信 {queue['sent']} / 破棄 {queue['dropped']} / "
+              f"統合 {queue['merged']} / 失敗 {queue['failed']}\n"
+              f"p50 {queue['latency_p50_ms'] or 0:.1f}ms p99 {queue['latency_p99_ms'] or 0:.1f}ms",
+        inline=False
+    )
+    await reply(ctx, embed=embed)
 
 @bot.command(name='help_bot')
 async def help_bot(ctx):
@@ -447,6 +1152,21 @@ async def help_bot(ctx):
         value='語録を投稿するチャンネルを設定',
         inline=False
     )
+    embed.add_field(
+        name='🔒 !set_schedule <HH:MM> [間隔(分)] [タイムゾーン]',
+        value='語録の投稿時刻を設定（間隔は省略可・`off` で停止）',
+        inline=False
+    )
+    embed.add_field(
+        name='🔒 !set_quote_weight <#ID> [重み]',
+        value=f'語録の出やすさを1〜{MAX_WEIGHT}で設定（1巡で出る回数、既定は1）',
+        inline=False
+    )
+    embed.add_field(
+        name='🔒 !set_cooldown [項目] [値]',
+        value='自動返信のクールダウンを設定（引数なしで現在の設定を表示、0 で無効）',
+        inline=False
+    )
     embed.add_field(
         name='🔒 !add_trigger <ワード> <応答>',
         value='反応ワードと応答を追加',
@@ -468,7 +1188,7 @@ async def help_bot(ctx):
         inline=False
     )
     embed.add_field(
-        name='🔒 !remove_quote <語録>',
+        name='🔒 !remove_quote <語録 or #ID>',
         value='語録を削除',
         inline=False
     )
@@ -477,11 +1197,31 @@ async def help_bot(ctx):
         value='語録一覧を表示',
         inline=False
     )
+    embed.add_field(
+        name='!search_quote <語句> [ページ]',
+        value='語録を検索（一致度の高い順）',
+        inline=False
+    )
+    embed.add_field(
+        name='🔒 !import_quotes',
+        value='添付したJSON/CSVファイルから語録をまとめて追加（重複はスキップ）',
+        inline=False
+    )
+    embed.add_field(
+        name='🔒 !export_quotes [json|csv]',
+        value='語録をファイルで出力',
+        inline=False
+    )
     embed.add_field(
         name='!test_quote',
         value='ランダムに語録を投稿（テスト用）',
         inline=False
     )
+    embed.add_field(
+        name='!shards',
+        value='シャードごとのレイテンシとサーバー数を表示',
+        inline=False
+    )
     embed.add_field(
         name='!show_config',
         value='現在のサーバー設定を表示',
@@ -492,59 +1232,186 @@ async def help_bot(ctx):
         value='#かなたーと から画像をランダムに取得',
         inline=False
     )
+    embed.add_field(
+        name='!hashtag_art <ハッシュタグ>',
+        value='設定されたハッシュタグから画像をランダムに取得',
+        inline=False
+    )
+    embed.add_field(
+        name='!twitter_quota',
+        value='Twitter APIの残り回数を表示',
+        inline=False
+    )
+    embed.add_field(
+        name='🔒 !stats',
+        value='応答時間やキャッシュのヒット率などの統計を表示',
+        inline=False
+    )
+    embed.add_field(
+        name='🔒 !memory',
+        value='メモリ使用量と1サーバーあたりの量を表示',
+        inline=False
+    )
     
-    await ctx.send(embed=embed)
+    await reply(ctx, embed=embed)
 
-@tasks.loop(minutes=1)  # テスト用: 1分ごと (本番は time=time(hour=12, minute=0) に戻す)
-async def daily_quote():
-    """定期的に語録を投稿"""
-    for guild_id, server_config in config['servers'].items():
-        try:
-            guild = bot.get_guild(int(guild_id))
-            if not guild:
-                continue
-            
-            # 語録が登録されているかチェック
-            if 'quotes' not in server_config or not server_config['quotes']:
-                continue
-            
-            if 'quote_channel_id' in server_config:
-                channel = guild.get_channel(server_config['quote_channel_id'])
-                if channel:
-                    quote = random.choice(server_config['quotes'])
-                    
-                    # 文字列の場合と辞書の場合の両方に対応
-                    if isinstance(quote, str):
-                        await channel.send(quote)
-                    else:
-                        text = quote.get('text', '')
-                        image = quote.get('image')
-                        
-                        if image:
-                            embed = discord.Embed(description=text, color=discord.Color.blue())
-                            embed.set_image(url=image)
-                            await channel.send(embed=embed)
-                        else:
-                            await channel.send(text)
-        except Exception as e:
-            print(f"エラー (Server {guild_id}): {e}")
-
-@daily_quote.before_loop
-async def before_daily_quote():
-    await bot.wait_until_ready()
+@tasks.loop(minutes=5)
+async def evict_idle_guilds():
+    """しばらく使われていないサーバーの設定をメモリから解放"""
+    servers.evict_idle(keep=config_writer.is_dirty)
+
+@tasks.loop(minutes=1)
+async def save_rotation():
+    """語録・画像のローテーションの位置を保存 (変わった時だけ)"""
+    await quote_rotation.save()
+
+@tasks.loop(minutes=5)
+async def refresh_twitter_cache():
+    """設定されたハッシュタグのキャッシュを期限切れ前に更新"""
+    if CLUSTER_ID not in (None, '0'):
+        # 定期更新はクラスター0だけが行い、他はそのスナップショットを読み直す
+        await twitter_cache.reload_if_changed()
+        return
+    for hashtag in twitter_settings['hashtags']:
+        if twitter_cache.is_stale(hashtag):
+            twitter_cache.refresh_in_background(hashtag)
+
+def prepare_guilds(store, changed, loaded):
+    """変更されたサーバーの {guild_id: (設定 or None, 差し替える GuildState or None)} (スレッドで呼ぶ)
+
+    メモリ上にあるサーバーは照合器 (失敗リンクまで) を作っておき、ループ上では差し替えるだけにする。
+    """
+    prepared = {}
+    for guild_id in changed:
+        data = store.load_guild(guild_id)
+        state = None
+        if data is not None and guild_id in loaded:
+            state = GuildState.from_dict(data)
+            state.matcher.compile()
+        prepared[guild_id] = (data, state)
+    return prepared
+
+@tasks.loop(seconds=settings['storage']['reload_seconds'] or 5)
+async def reload_config():
+    """外で編集された config.json を読み直し、内容が変わったサーバーだけを差し替える"""
+    store = servers.store
+    if not store.changed_on_disk():
+        return
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    try:
+        changed = await loop.run_in_executor(None, store.reload)
+    except ValueError as e:
+        log.warning('設定ファイルを読み直せませんでした: %s', e)
+        return
+    if changed is None:
+        # スナップショットから起動して読み込む前に書き換えられた: すべて読み直す
+        changed = set(servers.ids()) | set(await loop.run_in_executor(None, store.guild_ids))
+    # 未保存の変更があるサーバーはこちらを優先 (次の書き込みで上書きされる)
+    changed = [guild_id for guild_id in changed if not config_writer.is_dirty(guild_id)]
+    if not changed:
+        return
+    loaded = {guild_id for guild_id in changed if servers.is_loaded(guild_id)}
+    prepared = await loop.run_in_executor(None, prepare_guilds, store, changed, loaded)
+    
+    for guild_id, (data, state) in prepared.items():
+        if config_writer.is_dirty(guild_id):
+            continue  # 読み直している間に変更された
+        if state is not None:
+            servers[guild_id] = state
+        else:
+            # メモリ上にないサーバー (または削除) は次に使う時に読み込む
+            servers.invalidate(guild_id, exists=data is not None)
+        if data is not None and data.get('quote_channel_id') is not None and owns_guild(guild_id):
+            quote_scheduler.ensure(guild_id, default_schedule())
+    log.info('設定ファイルの変更を反映しました', extra={
+        'guilds': len(prepared), 'swapped': sum(1 for _, state in prepared.values() if state is not None),
+        'ms': round((time.perf_counter() - start) * 1000, 1)})
+
+# 共有ストアの同期 (他のプロセスが書き込んだサーバーを読み直す)
+last_change_seq = servers.store.latest_change()
+status_published_at = 0.0
+
+@tasks.loop(seconds=5)
+async def sync_shared_store():
+    global last_change_seq, status_published_at
+    loop = asyncio.get_running_loop()
+    store = servers.store
+    changes = await loop.run_in_executor(None, store.changes_since, last_change_seq)
+    for seq, guild_id in changes:
+        last_change_seq = seq
+        if config_writer.is_dirty(guild_id):
+            continue  # こちらの未保存の変更を優先
+        servers.invalidate(guild_id)
+    
+    # シャードの状態を30秒ごとに記録
+    if time.time() - status_published_at >= 30:
+        status_published_at = time.time()
+        await loop.run_in_executor(None, store.publish_shard_status, shard_status_rows())
+        await loop.run_in_executor(None, store.prune_changes, time.time() - 3600)
+
+def shard_status_rows():
+    """このプロセスの [(shard_id, cluster_id, latency, guild_count)]"""
+    counts = {}
+    for guild in bot.guilds:
+        counts[guild.shard_id] = counts.get(guild.shard_id, 0) + 1
+    latencies = bot.latencies if SHARDED else [(0, bot.latency)]
+    return [(shard_id, CLUSTER_ID, latency, counts.get(shard_id, 0)) for shard_id, latency in latencies]
+
+# コマンドの実行時間 (失敗した場合も記録)
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.started_at = time.perf_counter()
+    if ctx.guild is not None and str(ctx.guild.id) in servers:
+        # 未読み込みの設定はスレッドで読み込んでおく (コマンド内の servers[...] でループを止めない)
+        await servers.load(str(ctx.guild.id))
+
+@bot.after_invoke
+async def stop_command_timer(ctx):
+    started_at = getattr(ctx, 'started_at', None)
+    if started_at is not None:
+        metrics.observe('command_seconds', time.perf_counter() - started_at, help='コマンドの実行時間 (秒)',
+                        command=ctx.command.qualified_name, status='error' if ctx.command_failed else 'ok')
 
 # エラーハンドリング
 @bot.event
+@metrics.timed('event_seconds', event='on_command_error')
 async def on_command_error(ctx, error):
     if isinstance(error, commands.MissingPermissions):
-        await ctx.send('❌ このコマンドを実行する権限がありません（管理者権限が必要です）')
+        await reply(ctx, '❌ このコマンドを実行する権限がありません（管理者権限が必要です）')
     elif isinstance(error, commands.MissingRequiredArgument):
-        await ctx.send(f'❌ 引数が不足しています: `{error.param.name}`')
+        await reply(ctx, f'❌ 引数が不足しています: `{error.param.name}`')
     else:
-        await ctx.send(f'❌ エラーが発生しました: {str(error)}')
+        await reply(ctx, f'❌ エラーが発生しました: {str(error)}')
+
+# 接続前のメモリ使用量 (!memory で1サーバーあたりの量を出す基準)
+RSS_AT_START = process_rss_bytes()
+startup_phase('setup')
 
 # Botの起動
+async def run_bot(token):
+    """SIGTERM でも bot.close() で正常に終了し、下の終了処理まで進むようにして起動する"""
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGTERM, lambda: loop.create_task(bot.close()))
+    except NotImplementedError:
+        pass  # Windows はシグナルハンドラ非対応
+    async with bot:
+        await bot.start(token)
+
+
 if __name__ == '__main__':
     with open('token.txt', 'r') as f:
         token = f.read().strip()
-    bot.run(token)
+    try:
+        # ログは setup_logging() の設定で出す (bot.run() と違い discord.py のハンドラは付けない)
+        asyncio.run(run_bot(token))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # 終了時に未保存の変更を書き込み、次の起動用にスナップショットを残す
+        config_writer.flush_sync()
+        write_snapshot()
+        quote_scheduler.save_sync()
+        quote_rotation.save_sync()
+        log_listener.stop()
@@ -0,0 +1,191 @@
+"""反応ワード・語録のマッチング (Aho-Corasick)"""
+from array import array
+
+TRIGGER = 'trigger'
+QUOTE = 'quote'
+
+
+def build_automaton(words):
+    """[(エントリID, ワード)] から (goto, fail, link, out) を作る (スレッドで呼べる)"""
+    goto = [{}]      # ノード -> {文字: 子ノード}
+    out = {}         # ノード -> そこで終わるエントリID (出力のあるノードだけ持つ)
+    for entry_id, word in words:
+        node = 0
+        for ch in word:
+            child = goto[node].get(ch)
+            if child is None:
+                child = len(goto)
+                goto[node][ch] = child
+                goto.append({})
+            node = child
+        out.setdefault(node, []).append(entry_id)
+
+    # 幅優先で失敗リンクと出力リンク (出力を持つ最も近い接尾辞ノード) を張る
+    fail = [0] * len(goto)
+    link = [0] * len(goto)
+    queue = list(goto[0].values())
+    for node in queue:
+        for ch, child in goto[node].items():
+            state = fail[node]
+            while state and ch not in goto[state]:
+                state = fail[state]
+            target = goto[state].get(ch, 0)
+            fail[child] = target if target != child else 0
+            link[child] = fail[child] if fail[child] in out else link[fail[child]]
+            queue.append(child)
+    return goto, fail, link, out
+
+
+class Matcher:
+    """サーバーごとの反応ワード・語録をまとめて照合するオートマトン
+
+    メッセージを1回走査するだけで、登録順で最初の反応ワードと
+    最初の語録を見つける。オートマトンは作ったら変更しない。
+    追加したエントリは次に組み込むまで別に持って部分文字列で調べ、
+    削除したエントリは照合結果から除く。組み込み (compile_job / install) は
+    オートマトンをスレッドで作り直し、ループ上では差し替えるだけにする。
+    """
+
+    def __init__(self, entries=()):
+        self._entries = {}     # エントリID -> (種別, ワード, 値)
+        self._pending = {}     # まだオートマトンにないエントリID -> ワード
+        self._next_id = 0      # 登録順 = 優先順位
+        self._removed = 0      # 削除した数 (組み込み後に残っている分を数える)
+        self._stale = 0        # オートマトンに残っている削除済みエントリの数
+        for kind, word, value in entries:
+            self.add(kind, word, value)
+        self.install(self.compile_job()())
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __getstate__(self):
+        # スナップショット用。ノードごとの辞書は (文字, 子) を並べた形にして小さく・速く読めるようにする
+        counts = array('i', map(len, self._goto))
+        chars = ''.join(ch for node in self._goto for ch in node)
+        children = array('i', [child for node in self._goto for child in node.values()])
+        return {
+            'goto': (counts, chars, children),
+            'fail': array('i', self._fail),
+            'link': array('i', self._link),
+            'out': self._out,
+            'entries': self._entries,
+            'pending': self._pending,
+            'next_id': self._next_id,
+            'stale': self._stale,
+        }
+
+    def __setstate__(self, state):
+        counts, chars, children = state['goto']
+        children = children.tolist()
+        goto = []
+        pos = 0
+        for count in counts.tolist():
+            end = pos + count
+            goto.append(dict(zip(chars[pos:end], children[pos:end])) if count else {})
+            pos = end
+        self._goto = goto
+        self._fail = state['fail'].tolist()
+        self._link = state['link'].tolist()
+        self._out = state['out']
+        self._entries = state['entries']
+        self._pending = state['pending']
+        self._next_id = state['next_id']
+        self._removed = 0
+        self._stale = state['stale']
+
+    def add(self, kind, word, value):
+        """エントリを末尾（最低優先度）に追加"""
+        if kind == QUOTE and not word:
+            return None  # 空の語録は反応しない
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = (kind, word, value)
+        self._pending[entry_id] = word
+        return entry_id
+
+    def remove(self, kind, word, first_only=False):
+        """ワードに一致するエントリを削除し、削除した値のリストを返す"""
+        node = 0
+        for ch in word:
+            node = self._goto[node].get(ch)
+            if node is None:
+                break
+        candidates = list(self._out.get(node, ())) if node is not None else []
+        candidates += [entry_id for entry_id, pending in self._pending.items() if pending == word]
+        entries = self._entries
+        ids = sorted(i for i in candidates if i in entries and entries[i][0] == kind)
+        if first_only:
+            ids = ids[:1]
+        removed = []
+        for entry_id in ids:
+            if self._pending.pop(entry_id, None) is None:
+                self._stale += 1
+            self._removed += 1
+            removed.append(entries.pop(entry_id)[2])
+        return removed
+
+    def needs_compile(self):
+        """追加・削除がオートマトンに組み込まれていないか"""
+        return bool(self._pending or self._stale)
+
+    def compile_job(self):
+        """現在のエントリからオートマトンを作る関数を返す (ループ上で呼び、返した関数をスレッドで呼ぶ)
+
+        関数の戻り値を install() に渡す。
+        """
+        entries = self._entries.copy()
+        mark = (self._next_id, self._removed)
+
+        def job():
+            return mark, build_automaton((entry_id, entry[1]) for entry_id, entry in entries.items())
+        return job
+
+    def install(self, compiled):
+        """compile_job() の関数が作ったオートマトンに差し替える。作っている間の変更は持ち越す"""
+        (next_id, removed), automaton = compiled
+        self._goto, self._fail, self._link, self._out = automaton
+        self._pending = {entry_id: word for entry_id, word in self._pending.items() if entry_id >= next_id}
+        # 作り始めた後に削除した分は新しいオートマトンにも残っている
+        self._stale = self._removed - removed
+
+    def compile(self):
+        """組み込んでいない変更があれば、その場でオートマトンを作り直す
+
+        スレッド内や終了時など、ループを止めてよい場合に使う。
+        """
+        if self.needs_compile():
+            self.install(self.compile_job()())
+
+    def search(self, text):
+        """(最初の反応ワードの値, 最初の語録の値) を返す。なければ None"""
+        entries = self._entries
+        if not entries:
+            return None, None
+
+        goto, fail, link, out = self._goto, self._fail, self._link, self._out
+        best = {}
+        hits = set(out.get(0, ()))  # 空ワードの反応はどのメッセージにも一致
+        state = 0
+        for ch in text:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            node = state if state in out else link[state]
+            while node:
+                hits.update(out[node])
+                node = link[node]
+        for entry_id, word in self._pending.items():
+            if word in text:
+                hits.add(entry_id)
+
+        for entry_id in sorted(hits):
+            entry = entries.get(entry_id)
+            if entry is None:
+                continue  # 削除済み (次に組み込むまでオートマトンに残っている)
+            kind = entry[0]
+            if kind not in best:
+                best[kind] = entry[2]
+                if len(best) == 2:
+                    break
+        return best.get(TRIGGER), best.get(QUOTE)
@@ -0,0 +1,212 @@
+"""語録の画像のローカル保存 (内容のハッシュを名前にし、サーバーをまたいでも重複させない)
+
+DiscordのCDNのURLは期限付きなので、追加時に一度だけダウンロードしておき、
+URLが使えなくなったら保存した画像をファイルとして添付する。
+"""
+import asyncio
+import hashlib
+import io
+import logging
+import os
+import time
+from collections import OrderedDict
+from urllib.parse import parse_qs, urlsplit
+
+try:
+    from PIL import Image  # 縮小版を作る場合のみ必要 (pip install Pillow)
+except ImportError:
+    Image = None
+
+log = logging.getLogger('pp_angel.media')
+
+EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.webp')
+DISCORD_CDN_HOSTS = ('cdn.discordapp.com', 'media.discordapp.net')
+_PIL_FORMATS = {'.png': 'PNG', '.jpg': 'JPEG', '.jpeg': 'JPEG', '.webp': 'WEBP'}
+
+
+def url_expired(url, now=None, margin=60):
+    """DiscordのCDNのURLが期限切れか (期限は ex= の16進数。他のサイトのURLは分からないので False)"""
+    parts = urlsplit(url)
+    if parts.hostname not in DISCORD_CDN_HOSTS:
+        return False
+    ex = parse_qs(parts.query).get('ex')
+    if not ex:
+        return True  # 署名のない古い形式のURLはもう表示されない
+    try:
+        expires = int(ex[0], 16)
+    except ValueError:
+        return True
+    return (now or time.time()) >= expires - margin
+
+
+def _split_name(filename):
+    """'<sha256>.png' / '<sha256>.w1024.png' -> (保存名, 縮小版か)"""
+    digest, _, rest = filename.partition('.')
+    variant, _, ext = rest.rpartition('.')
+    if len(digest) != 64 or not ext:
+        return None, False
+    return f'{digest}.{ext}', bool(variant)
+
+
+class MediaStore:
+    """画像を SHA-256 の名前で保存し、合計サイズが上限を超えたら使われていない順に消す
+
+    root/ab/<sha256>.png の形で保存し、縮小版は <sha256>.w1024.png として隣に置く。
+    最後に使った時刻はファイルの更新時刻で持つので、索引ファイルはない。
+    """
+
+    def __init__(self, root='media', max_bytes=512 * 1024 * 1024, variant_max_side=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.variant_max_side = variant_max_side if Image is not None else None
+        self._entries = OrderedDict()   # 保存名 -> (合計サイズ, 縮小版の名前 or None)、古い順
+        self.total_bytes = 0
+        self.stored = 0
+        self.deduplicated = 0
+        self.evicted = 0
+        if variant_max_side and Image is None:
+            log.warning('Pillowがインストールされていないため、縮小版は作りません')
+
+    def _dir(self, name):
+        return os.path.join(self.root, name[:2])
+
+    def load(self):
+        """保存済みの画像を読み込む (起動時に一度だけ)"""
+        found = {}
+        if os.path.isdir(self.root):
+            for sub in os.scandir(self.root):
+                if not sub.is_dir():
+                    continue
+                for entry in os.scandir(sub.path):
+                    name, is_variant = _split_name(entry.name)
+                    if name is None or entry.name.endswith('.tmp'):
+                        continue
+                    stat = entry.stat()
+                    size, mtime, variant = found.get(name, (0, 0.0, None))
+                    if is_variant:
+                        variant = entry.name
+                    else:
+                        mtime = stat.st_mtime
+                    found[name] = (size + stat.st_size, mtime, variant)
+        for name, (size, _, variant) in sorted(found.items(), key=lambda item: item[1][1]):
+            self._entries[name] = (size, variant)
+            self.total_bytes += size
+        _remove_files(self._evict())
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def __len__(self):
+        return len(self._entries)
+
+    def path(self, name):
+        """送信に使うファイルのパス (縮小版があればそちら)。保存していなければ None"""
+        entry = self._entries.get(name)
+        if entry is None:
+            return None
+        self._entries.move_to_end(name)
+        original = os.path.join(self._dir(name), name)
+        try:
+            os.utime(original)   # 使った時刻を残す (再起動後のLRU用)
+        except OSError:
+            # 外から消された
+            self._forget(name)
+            return None
+        return os.path.join(self._dir(name), entry[1]) if entry[1] else original
+
+    async def put(self, data, ext):
+        """画像を保存して保存名を返す。同じ内容が保存済みなら書き込まない"""
+        ext = ext.lower()
+        if ext not in EXTENSIONS:
+            raise ValueError(f'対応していない画像形式です ({ext})')
+        loop = asyncio.get_running_loop()
+        digest = await loop.run_in_executor(None, lambda: hashlib.sha256(data).hexdigest())
+        name = digest + ext
+        if name in self._entries:
+            self.deduplicated += 1
+            self.path(name)
+            return name
+
+        size, variant = await loop.run_in_executor(None, self._write, name, data)
+        if name in self._entries:
+            # 書き込み中に同じ画像が保存された
+            self.deduplicated += 1
+            return name
+        self._entries[name] = (size, variant)
+        self.total_bytes += size
+        self.stored += 1
+        removed = self._evict(keep=name)
+        if removed:
+            await loop.run_in_executor(None, _remove_files, removed)
+        return name
+
+    def _write(self, name, data):
+        """原本 (と縮小版) を書き込み、(合計サイズ, 縮小版の名前) を返す (スレッドで呼ぶ)"""
+        directory = self._dir(name)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, name)
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        size = len(data)
+
+        variant = None
+        try:
+            variant = self._write_variant(name, data)
+        except Exception as e:
+            log.warning('縮小版を作れませんでした: %s', e, extra={'media': name})
+        if variant:
+            size += os.path.getsize(os.path.join(directory, variant))
+        return size, variant
+
+    def _write_variant(self, name, data):
+        side = self.variant_max_side
+        ext = os.path.splitext(name)[1]
+        if not side or ext not in _PIL_FORMATS:
+            return None  # GIFはアニメーションが消えるので縮小しない
+        with Image.open(io.BytesIO(data)) as image:
+            if max(image.size) <= side:
+                return None
+            image.thumbnail((side, side))
+            if ext in ('.jpg', '.jpeg') and image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            variant = f'{name[:-len(ext)]}.w{side}{ext}'
+            image.save(os.path.join(self._dir(name), variant), _PIL_FORMATS[ext])
+        return variant
+
+    def _forget(self, name):
+        size, _ = self._entries.pop(name)
+        self.total_bytes -= size
+
+    def _evict(self, keep=None):
+        """上限を超えた分を古い順に一覧から外し、消すファイルのパスを返す"""
+        removed = []
+        while self.total_bytes > self.max_bytes and self._entries:
+            name = next(iter(self._entries))
+            if name == keep:
+                break
+            variant = self._entries[name][1]
+            self._forget(name)
+            self.evicted += 1
+            removed.append(os.path.join(self._dir(name), name))
+            if variant:
+                removed.append(os.path.join(self._dir(name), variant))
+        return removed
+
+    def stats(self):
+        return {
+            'files': len(self._entries),
+            'bytes': self.total_bytes,
+            'stored': self.stored,
+            'deduplicated': self.deduplicated,
+            'evicted': self.evicted,
+        }
+
+
+def _remove_files(paths):
+    for path in paths:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -0,0 +1,253 @@
+"""計測 (ヒストグラム・カウンター)、Prometheus形式での公開、構造化ログ"""
+import asyncio
+import functools
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import time
+from collections import deque
+
+# 秒単位のバケット (0.5ms〜10秒)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Histogram:
+    """累積バケットに加え、パーセンタイル表示用に直近の値を保持する"""
+    __slots__ = ('buckets', 'counts', 'count', 'sum', 'max', 'recent')
+
+    def __init__(self, buckets=LATENCY_BUCKETS, samples=1000):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+        self.recent = deque(maxlen=samples)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        self.recent.append(value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def percentile(self, p):
+        if not self.recent:
+            return None
+        ordered = sorted(self.recent)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+    def summary(self):
+        return {'count': self.count, 'p50': self.percentile(0.5), 'p99': self.percentile(0.99),
+                'max': self.max}
+
+
+def _labels_text(labels):
+    if not labels:
+        return ''
+    parts = []
+    for key, value in labels:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        parts.append(f'{key}="{value}"')
+    return '{' + ','.join(parts) + '}'
+
+
+class Metrics:
+    """カウンター・ヒストグラム・ゲージ (読み出し時に関数を呼ぶ) の置き場"""
+
+    def __init__(self, prefix='pp_angel'):
+        self.prefix = prefix
+        self._help = {}
+        self._counters = {}     # name -> {labels: 値}
+        self._histograms = {}   # name -> {labels: Histogram}
+        self._gauges = {}       # name -> (関数, 種類)
+
+    def _name(self, name, help_text):
+        full = f'{self.prefix}_{name}'
+        if help_text:
+            self._help.setdefault(full, help_text)
+        return full
+
+    def inc(self, name, value=1, help=None, **labels):
+        series = self._counters.setdefault(self._name(name, help), {})
+        key = tuple(sorted(labels.items()))
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name, value, help=None, **labels):
+        series = self._histograms.setdefault(self._name(name, help), {})
+        key = tuple(sorted(labels.items()))
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram()
+        histogram.observe(value)
+
+    def gauge(self, name, func, help=None, kind='gauge'):
+        """読み出すたびに func() の値を返す (他のクラスの stats() などを公開する用)"""
+        self._gauges[self._name(name, help)] = (func, kind)
+
+    def counter_value(self, name, **labels):
+        series = self._counters.get(f'{self.prefix}_{name}', {})
+        if labels:
+            return series.get(tuple(sorted(labels.items())), 0)
+        return sum(series.values())
+
+    def histograms(self, name):
+        """{((ラベル名, 値), ...): Histogram}"""
+        return dict(self._histograms.get(f'{self.prefix}_{name}', {}))
+
+    def timed(self, name, **labels):
+        """コルーチン関数の実行時間をヒストグラムに記録するデコレーター"""
+        def decorator(func):
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    self.observe(name, time.perf_counter() - start, **labels)
+            return wrapper
+        return decorator
+
+    def render(self):
+        """Prometheusのテキスト形式"""
+        lines = []
+
+        def header(name, kind):
+            if name in self._help:
+                lines.append(f'# HELP {name} {self._help[name]}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        for name, series in sorted(self._counters.items()):
+            header(name, 'counter')
+            for labels, value in series.items():
+                lines.append(f'{name}{_labels_text(labels)} {value}')
+
+        for name, series in sorted(self._histograms.items()):
+            header(name, 'histogram')
+            for labels, histogram in series.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{_labels_text(labels + (("le", bound),))} {cumulative}')
+                lines.append(f'{name}_bucket{_labels_text(labels + (("le", "+Inf"),))} {histogram.count}')
+                lines.append(f'{name}_sum{_labels_text(labels)} {histogram.sum}')
+                lines.append(f'{name}_count{_labels_text(labels)} {histogram.count}')
+
+        for name, (func, kind) in sorted(self._gauges.items()):
+            try:
+                value = func()
+            except Exception:
+                continue
+            if value is None:
+                continue
+            header(name, kind)
+            lines.append(f'{name} {float(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def process_rss_bytes(pid='self'):
+    """プロセスの常駐メモリ (RSS)。/proc がなければ自分の最大値で代用し、分からなければ None"""
+    try:
+        with open(f'/proc/{pid}/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    if pid != 'self' and pid != os.getpid():
+        return None
+    try:
+        import resource
+    except ImportError:
+        return None
+    # Linux は KB、macOS はバイト単位
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss if os.uname().sysname == 'Darwin' else rss * 1024
+
+
+class LoopLagMonitor:
+    """一定間隔で sleep し、予定より遅れた時間をイベントループの詰まりとして記録する"""
+
+    def __init__(self, metrics, interval=0.5):
+        self.metrics = metrics
+        self.interval = interval
+        self.last_lag = 0.0
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.last_lag = max(0.0, loop.time() - start - self.interval)
+            self.metrics.observe('event_loop_lag_seconds', self.last_lag,
+                                 help='イベントループの遅れ (秒)')
+
+
+async def start_http_server(metrics, host='127.0.0.1', port=9108):
+    """/metrics を返すHTTPサーバーをイベントループ上で起動する"""
+    from aiohttp import web
+
+    async def handle(request):
+        return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+# --- 構造化ログ ---
+
+# LogRecord が標準で持つ属性 (これ以外は extra= で渡された項目)
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+
+class JsonFormatter(logging.Formatter):
+    """1行1レコードのJSON (extra= で渡した項目もそのまま出す)"""
+
+    def format(self, record):
+        data = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created))
+                    + f'.{int(record.msecs):03d}',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRS and not key.startswith('_'):
+                data[key] = value
+        if record.exc_info:
+            data['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+def setup_logging(level='INFO', format='json', path=None, loggers=('pp_angel', 'discord')):
+    """ログはキューに入れるだけにし、書き出しは別スレッドで行う
+
+    戻り値の QueueListener は終了時に stop() する。
+    """
+    if path:
+        handler = logging.handlers.WatchedFileHandler(path, encoding='utf-8')
+    else:
+        handler = logging.StreamHandler()
+    if format == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    for name in loggers:
+        logger = logging.getLogger(name)
+        logger.setLevel(level)
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        logger.propagate = False
+    listener.start()
+    return listener
@@ -0,0 +1,421 @@
+"""サーバー設定のメモリ上の表現 (反応ワード・語録)"""
+import itertools
+
+import discord
+
+from matcher import Matcher, TRIGGER, QUOTE
+from sampler import ShuffleBag
+from search import build_index
+
+# 一覧のバージョン (サーバーをまたいでも、読み込み直しても重ならない番号)
+_versions = itertools.count(1)
+
+
+class Trigger:
+    """反応ワード"""
+    __slots__ = ('word', 'response')
+
+    def __init__(self, word, response):
+        self.word = word
+        self.response = response
+
+    def to_dict(self):
+        return {'word': self.word, 'response': self.response}
+
+
+class Quote:
+    """語録。送信内容はキャッシュし、テキストや画像が変わった時だけ作り直す
+
+    media は画像をローカルに保存した時の保存名 (media.MediaStore)。
+    weight はランダムに選ぶ時の重み (1巡で出る回数)。
+    """
+    __slots__ = ('id', '_text', '_image', 'media', 'weight', '_payload')
+
+    def __init__(self, quote_id, text, image=None, media=None, weight=1):
+        self.id = quote_id
+        self._text = text
+        self._image = image
+        self.media = media
+        self.weight = weight
+        self._payload = None
+
+    @property
+    def text(self):
+        return self._text
+
+    @text.setter
+    def text(self, value):
+        self._text = value
+        self._payload = None
+
+    @property
+    def image(self):
+        return self._image
+
+    @image.setter
+    def image(self, value):
+        self._image = value
+        self._payload = None
+
+    def payload(self):
+        """send() に渡す引数 (テキストのみ、または画像付きEmbed)"""
+        if self._payload is None:
+            if self._image:
+                embed = discord.Embed(description=self._text, color=discord.Color.blue())
+                embed.set_image(url=self._image)
+                self._payload = {'embed': embed}
+            else:
+                self._payload = {'content': self._text}
+        return self._payload
+
+    def __getstate__(self):
+        # 送信内容 (Embed) はスナップショットに含めない
+        return self.id, self._text, self._image, self.media, self.weight
+
+    def __setstate__(self, state):
+        self.id, self._text, self._image, self.media, self.weight = state
+        self._payload = None
+
+    def to_dict(self):
+        data = {'id': self.id, 'text': self._text, 'image': self._image}
+        if self.media:
+            data['media'] = self.media
+        if self.weight != 1:
+            data['weight'] = self.weight
+        return data
+
+    @classmethod
+    def from_raw(cls, raw, quote_id):
+        """保存形式 (文字列 or 辞書) から変換"""
+        if isinstance(raw, str):
+            return cls(quote_id, raw)
+        return cls(raw.get('id', quote_id), raw.get('text', ''), raw.get('image'), raw.get('media'),
+                   raw.get('weight') or 1)
+
+
+def build_matcher(source):
+    """matcher_source() の内容から照合器を作る (スレッドで呼べる)"""
+    triggers, quotes = source
+    entries = [(TRIGGER, trigger.word, trigger) for trigger in triggers]
+    entries += [(QUOTE, quote.text, quote) for quote in quotes]
+    return Matcher(entries)
+
+
+class GuildState:
+    """1サーバー分の設定。読み込み時に一度だけ正規化する
+
+    語録はIDとテキスト、反応ワードはワードで引ける辞書で持ち、
+    検索・削除・重複チェックを O(1) で行う。
+    """
+    __slots__ = ('quote_channel_id', 'cooldown', 'extra', 'next_quote_id', '_triggers', '_quotes',
+                 '_quotes_by_text', '_trigger_list', '_quote_list', 'triggers_version', 'quotes_version',
+                 '_matcher', '_search_index', '_sampler')
+
+    def __init__(self):
+        self.quote_channel_id = None
+        self.cooldown = {}     # クールダウン設定の上書き (cooldown.DEFAULT_COOLDOWN のキー)
+        self.extra = {}        # その他のキー (quote_channel_name など) はそのまま保持
+        self.next_quote_id = 1
+        self._triggers = {}         # word -> Trigger (登録順)
+        self._quotes = {}           # id -> Quote (登録順)
+        self._quotes_by_text = {}   # text -> [Quote] (旧データには同じテキストが複数ありうる)
+        self._trigger_list = None   # 一覧用のリスト (変更されたら作り直す)
+        self._quote_list = None
+        self.triggers_version = next(_versions)  # 変更のたびに変わる (表示のキャッシュ用)
+        self.quotes_version = next(_versions)
+        self._matcher = None
+        self._search_index = None
+        self._sampler = None
+
+    @classmethod
+    def from_dict(cls, data):
+        state = cls()
+        data = dict(data)
+        state.quote_channel_id = data.pop('quote_channel_id', None)
+        for t in data.pop('triggers', []):
+            # 同じワードは最初のものしか反応しないので、後のものは読み込まない
+            state._triggers.setdefault(t['word'], Trigger(t['word'], t['response']))
+        state.cooldown = data.pop('cooldown', {})
+        next_id = data.pop('next_quote_id', 1)
+        raws = data.pop('quotes', [])
+        for raw in raws:
+            if isinstance(raw, dict) and raw.get('id') is not None:
+                next_id = max(next_id, raw['id'] + 1)
+        for raw in raws:
+            quote = Quote.from_raw(raw, None)
+            if quote.id is None or quote.id in state._quotes:
+                quote.id = next_id  # 旧形式の語録や重複したIDには読み込み時にIDを振る
+                next_id += 1
+            state._index_quote(quote)
+        state.next_quote_id = next_id
+        state.extra = data
+        return state
+
+    def __getstate__(self):
+        # スナップショット用。一覧のリストは作り直せるので含めない
+        # 検索インデックスは大きく、必要になればスレッドで作り直すので含めない
+        # サンプラーの位置は sampler.RotationStore が別に保存している
+        return {name: getattr(self, name) for name in self.__slots__
+                if name not in ('_trigger_list', '_quote_list', 'triggers_version', 'quotes_version',
+                                '_search_index', '_sampler')}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        self._trigger_list = None
+        self._quote_list = None
+        self._search_index = None
+        self._sampler = None
+        # バージョンは表示のキャッシュのキーなので、このプロセスの番号を振り直す
+        self.triggers_version = next(_versions)
+        self.quotes_version = next(_versions)
+
+    def to_dict(self):
+        data = dict(self.extra)
+        if self.quote_channel_id is not None:
+            data['quote_channel_id'] = self.quote_channel_id
+        if self._triggers:
+            data['triggers'] = [t.to_dict() for t in self._triggers.values()]
+        if self._quotes:
+            data['quotes'] = [q.to_dict() for q in self._quotes.values()]
+        if self.cooldown:
+            data['cooldown'] = dict(self.cooldown)
+        data['next_quote_id'] = self.next_quote_id
+        return data
+
+    @property
+    def triggers(self):
+        """反応ワードのリスト (登録順、読み取り専用として使う)"""
+        if self._trigger_list is None:
+            self._trigger_list = list(self._triggers.values())
+        return self._trigger_list
+
+    @property
+    def quotes(self):
+        """語録のリスト (登録順、読み取り専用として使う)"""
+        if self._quote_list is None:
+            self._quote_list = list(self._quotes.values())
+        return self._quote_list
+
+    def _triggers_changed(self):
+        self._trigger_list = None
+        self.triggers_version = next(_versions)
+
+    def _quotes_changed(self):
+        self._quote_list = None
+        self.quotes_version = next(_versions)
+
+    @property
+    def matcher(self):
+        """反応ワード・語録のマッチャー（なければその場で構築する。ループ上では attach_matcher で渡す）"""
+        if self._matcher is None:
+            self._matcher = build_matcher(self.matcher_source())
+        return self._matcher
+
+    def has_matcher(self):
+        return self._matcher is not None
+
+    def versions(self):
+        """(反応ワードのバージョン, 語録のバージョン) (スレッドで作っている間に変わったかの確認用)"""
+        return self.triggers_version, self.quotes_version
+
+    def matcher_source(self):
+        """(反応ワードのリスト, 語録のリスト) (照合器をスレッドで作る時に build_matcher に渡す)"""
+        return list(self._triggers.values()), list(self._quotes.values())
+
+    def attach_matcher(self, matcher, versions):
+        """スレッドで作った照合器を使う。作っている間に変わっていたら使わずに False"""
+        if self._matcher is not None:
+            return True
+        if versions != self.versions():
+            return False
+        self._matcher = matcher
+        return True
+
+    @property
+    def search_index(self):
+        """語録の全文検索インデックス（初回の検索時に構築し、以降は追加・削除に合わせて更新）"""
+        if self._search_index is None:
+            self._search_index = build_index(self.quote_snapshot())
+        return self._search_index
+
+    def has_search_index(self):
+        return self._search_index is not None
+
+    def quote_snapshot(self):
+        """[(id, text)] (検索インデックスをスレッドで作る時に渡す)"""
+        return [(quote.id, quote.text) for quote in self._quotes.values()]
+
+    def attach_search_index(self, index):
+        """スレッドで作ったインデックスを使う。作っている間に変わった語録の分は反映する"""
+        if self._search_index is not None:
+            return
+        for quote_id in index.ids():
+            if quote_id not in self._quotes:
+                index.remove(quote_id)
+        for quote in self._quotes.values():
+            if quote.id not in index:
+                index.add(quote.id, quote.text)
+        self._search_index = index
+
+    def has_sampler(self):
+        return self._sampler is not None
+
+    def attach_sampler(self, cursor=None):
+        """語録を選ぶサンプラーを作る (cursor は保存しておいた位置)。以降は追加・削除に合わせて更新"""
+        self._sampler = ShuffleBag({quote.id: quote.weight for quote in self._quotes.values()}, cursor)
+        return self._sampler
+
+    @property
+    def sampler(self):
+        if self._sampler is None:
+            self.attach_sampler()
+        return self._sampler
+
+    def draw_quote(self):
+        """重みに従って語録を1つ選ぶ。1巡するまで同じ語録は (重みの回数を超えて) 出ない"""
+        return self._quotes.get(self.sampler.draw())
+
+    def set_quote_weight(self, quote_id, weight):
+        """語録の重みを変えて返す (なければ None)"""
+        quote = self._quotes.get(quote_id)
+        if quote is None:
+            return None
+        quote.weight = weight
+        if self._sampler is not None:
+            self._sampler.add(quote.id, weight)
+        return quote
+
+    def search_quotes(self, query, limit=10, offset=0):
+        """(ヒット数, [Quote]) をスコアの高い順に返す"""
+        total, hits = self.search_index.search(query, limit, offset)
+        return total, [self._quotes[quote_id] for quote_id, _ in hits]
+
+    def get_trigger(self, word):
+        return self._triggers.get(word)
+
+    def add_trigger(self, word, response):
+        """反応ワードを追加し (trigger, 新規か) を返す。同じワードがあれば応答を置き換える"""
+        trigger = self._triggers.get(word)
+        if trigger is not None:
+            trigger.response = response  # マッチャーは同じオブジェクトを指しているので作り直し不要
+            self._triggers_changed()
+            return trigger, False
+        trigger = Trigger(word, response)
+        if self._matcher is not None:
+            self._matcher.add(TRIGGER, word, trigger)
+        self._triggers[word] = trigger
+        self._triggers_changed()
+        return trigger, True
+
+    def remove_triggers(self, word):
+        """ワードに一致する反応ワードを削除し、削除した数を返す"""
+        if self._triggers.pop(word, None) is None:
+            return 0
+        if self._matcher is not None:
+            self._matcher.remove(TRIGGER, word)
+        self._triggers_changed()
+        return 1
+
+    def get_quote(self, quote_id):
+        return self._quotes.get(quote_id)
+
+    def find_quote(self, text):
+        """テキストが一致する最初の語録"""
+        matches = self._quotes_by_text.get(text)
+        return matches[0] if matches else None
+
+    def _index_quote(self, quote):
+        self._quotes[quote.id] = quote
+        self._quotes_by_text.setdefault(quote.text, []).append(quote)
+        self._quotes_changed()
+        if self._search_index is not None:
+            self._search_index.add(quote.id, quote.text)
+        if self._sampler is not None:
+            self._sampler.add(quote.id, quote.weight)
+
+    def add_quote(self, text, image=None, media=None):
+        """語録を追加して返す。同じテキストが登録済みなら追加せず None"""
+        if text in self._quotes_by_text:
+            return None
+        quote = Quote(self.next_quote_id, text, image, media)
+        self.next_quote_id += 1
+        if self._matcher is not None:
+            self._matcher.add(QUOTE, text, quote)
+        self._index_quote(quote)
+        return quote
+
+    def import_job(self, rows):
+        """[(text, image)] をまとめて追加する準備の関数を返す (ループ上で呼び、返した関数をスレッドで呼ぶ)
+
+        関数は重複を除いた語録と、それを含めた照合器を作る。戻り値を apply_import() に渡す。
+        """
+        known = set(self._quotes_by_text)
+        source = self.matcher_source()
+        versions = self.versions()
+
+        def job():
+            quotes = []
+            for text, image in rows:
+                if text not in known:
+                    known.add(text)
+                    quotes.append(Quote(None, text, image))
+            triggers, existing = source
+            return versions, quotes, len(rows) - len(quotes), build_matcher((triggers, existing + quotes))
+        return job
+
+    def apply_import(self, prepared):
+        """import_job() の結果を反映して (追加した数, 重複でスキップした数) を返す
+
+        準備している間に反応ワード・語録が変わっていたら反映せずに None (準備からやり直す)。
+        """
+        versions, quotes, skipped, matcher = prepared
+        if versions != self.versions():
+            return None
+        # 検索インデックスは次の検索でスレッドで作り直す
+        self._search_index = None
+        for quote in quotes:
+            quote.id = self.next_quote_id
+            self.next_quote_id += 1
+            self._quotes[quote.id] = quote
+            self._quotes_by_text[quote.text] = [quote]
+            if self._sampler is not None:
+                self._sampler.add(quote.id, quote.weight)
+        self._matcher = matcher
+        if quotes:
+            self._quotes_changed()
+        return len(quotes), skipped
+
+    def _unindex_quote(self, quote):
+        del self._quotes[quote.id]
+        matches = self._quotes_by_text[quote.text]
+        matches.remove(quote)
+        if not matches:
+            del self._quotes_by_text[quote.text]
+        self._quotes_changed()
+        if self._search_index is not None:
+            self._search_index.remove(quote.id)
+        if self._sampler is not None:
+            self._sampler.remove(quote.id)
+
+    def remove_quote(self, text):
+        """テキストが一致する最初の語録を削除して返す"""
+        quote = self.find_quote(text)
+        if quote is None:
+            return None
+        self._unindex_quote(quote)
+        if self._matcher is not None:
+            self._matcher.remove(QUOTE, text, first_only=True)
+        return quote
+
+    def remove_quote_by_id(self, quote_id):
+        """IDの語録を削除して返す"""
+        quote = self._quotes.get(quote_id)
+        if quote is None:
+            return None
+        if self.find_quote(quote.text) is quote:
+            return self.remove_quote(quote.text)
+        # 同じテキストの2つ目以降 (旧データのみ) はマッチャーを作り直す
+        self._unindex_quote(quote)
+        self._matcher = None
+        return quote
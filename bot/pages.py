@@ -0,0 +1,106 @@
+"""一覧表示のページ分け (ボタンでページ送り)"""
+from collections import OrderedDict
+
+import discord
+
+PAGE_SIZE = 10          # 1ページの項目数 (Embedのフィールドは25個まで)
+VIEW_TIMEOUT = 180      # ボタンが反応しなくなるまでの秒数
+
+
+def clip(text, limit):
+    """Embedの文字数制限に収まるように切り詰める"""
+    return text if len(text) <= limit else text[:limit - 1] + '…'
+
+
+def page_count(total):
+    return max(1, (total + PAGE_SIZE - 1) // PAGE_SIZE)
+
+
+class PageCache:
+    """描画したページ (Embed) をキャッシュする
+
+    キーに一覧のバージョンを含めるので、一覧が変われば自然に使われなくなり、
+    古いものはLRUで捨てられる。
+    """
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._pages = OrderedDict()
+
+    def __len__(self):
+        return len(self._pages)
+
+    def get(self, key, render):
+        embed = self._pages.get(key)
+        if embed is not None:
+            self._pages.move_to_end(key)
+            self.hits += 1
+            return embed
+        self.misses += 1
+        embed = self._pages[key] = render()
+        if len(self._pages) > self.maxsize:
+            self._pages.popitem(last=False)
+        return embed
+
+
+class Paginator(discord.ui.View):
+    """前後のボタンでページを送る一覧
+
+    source() は (バージョン, 項目のリスト) を返す関数で、押されるたびに呼ぶので
+    一覧が変わっていれば新しい内容で表示する。描画は表示するページの分だけ行う。
+    render(items, start, page, pages) はそのページの Embed を作る関数。
+    """
+
+    def __init__(self, key, source, render, cache, timeout=VIEW_TIMEOUT):
+        super().__init__(timeout=timeout)
+        self.key = key
+        self.source = source
+        self.render = render
+        self.cache = cache
+        self.page = 0
+        self.pages = 1
+        self.message = None
+
+    def current(self):
+        """現在のページの Embed (ボタンの状態も更新する)"""
+        version, items = self.source()
+        pages = self.pages = page_count(len(items))
+        self.page = min(max(self.page, 0), pages - 1)
+        page = self.page
+        start = page * PAGE_SIZE
+        embed = self.cache.get(
+            (self.key, version, page),
+            lambda: self.render(items[start:start + PAGE_SIZE], start, page, pages)
+        )
+        self.previous_page.disabled = page == 0
+        self.next_page.disabled = page >= pages - 1
+        self.position.label = f'{page + 1}/{pages}'
+        return embed
+
+    async def _show(self, interaction, page):
+        self.page = page
+        await interaction.response.edit_message(embed=self.current(), view=self)
+
+    @discord.ui.button(label='◀', style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction, button):
+        await self._show(interaction, self.page - 1)
+
+    @discord.ui.button(label='1/1', style=discord.ButtonStyle.secondary, disabled=True)
+    async def position(self, interaction, button):
+        pass
+
+    @discord.ui.button(label='▶', style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction, button):
+        await self._show(interaction, self.page + 1)
+
+    async def on_timeout(self):
+        # ボタンを消し、一覧への参照を手放す
+        self.source = self.render = None
+        if self.message is not None:
+            try:
+                await self.message.edit(view=None)
+            except discord.HTTPException:
+                pass
+            self.message = None
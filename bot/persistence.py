@@ -0,0 +1,182 @@
+"""設定ファイルの遅延・一括・アトミック書き込み"""
+import asyncio
+import contextlib
+import copy
+import logging
+import os
+import tempfile
+import threading
+import time
+
+log = logging.getLogger('pp_angel.persistence')
+
+MAX_RETRY_DELAY = 60.0  # 書き込みに失敗したときの再試行間隔の上限 (秒)
+
+
+def atomic_write(path, data):
+    """一時ファイル + fsync + rename でファイルを書き換える (data は str か bytes)"""
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix='.json')
+    try:
+        with (os.fdopen(fd, 'wb') if isinstance(data, bytes) else os.fdopen(fd, 'w', encoding='utf-8')) as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    # rename自体を永続化するためディレクトリもfsync (POSIXのみ)
+    if hasattr(os, 'O_DIRECTORY'):
+        dir_fd = os.open(directory, os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class ConfigWriter:
+    """変更をまとめて、イベントループの外で保存先に書き込む
+
+    mark_dirty() は印を付けるだけで、delay秒以内の変更は1回の書き込みにまとめる。
+    書き込みは変更のあったサーバー分だけ保存先 (storage.py) に渡す。
+    """
+
+    def __init__(self, store, delay=2.0, serialize=copy.deepcopy):
+        self.store = store
+        self.serialize = serialize  # ループ上で保存用のコピーを作る関数
+        self.delay = delay
+        self.pending = 0            # 未書き込みの変更数
+        self.flush_count = 0
+        self.last_flush_ms = None   # 直近の書き込み時間 (ミリ秒)
+        self.max_flush_ms = 0.0
+        self.last_error = None
+        self.retry_delay = None     # 失敗後の次の再試行までの秒数 (成功するまで倍にしていく)
+        self.on_flush = []          # 書き込み後にループ上で呼ぶ関数 (秒数)
+        self._dirty = {}            # guild_id -> 設定 (削除はNone)
+        self._inflight = set()      # 書き込み中のサーバー
+        self._held = {}             # guild_id -> hold() 中の数 (書き込み予定と同じ扱いにする)
+        self._task = None
+        self._lock = threading.Lock()
+
+    def is_dirty(self, guild_id):
+        return guild_id in self._dirty or guild_id in self._inflight or guild_id in self._held
+
+    @contextlib.contextmanager
+    def hold(self, guild_id):
+        """この間は変更中として扱い、読み直し・解放の対象から外す (書き込みは予約しない)"""
+        self._held[guild_id] = self._held.get(guild_id, 0) + 1
+        try:
+            yield
+        finally:
+            count = self._held.pop(guild_id) - 1
+            if count:
+                self._held[guild_id] = count
+
+    def mark_dirty(self, guild_id, data):
+        """変更を記録し、書き込みを予約する"""
+        self._dirty[guild_id] = data
+        self.pending += 1
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # イベントループ外 (起動前など) ではその場で書き込む
+            self.flush_sync()
+            return
+        if self._task is None or self._task.done():
+            self._task = loop.create_task(self._flush_later())
+
+    async def _flush_later(self, delay=None):
+        await asyncio.sleep(self.delay if delay is None else delay)
+        await self.flush()
+
+    def _reschedule(self, loop, delay=None):
+        # 自分自身 (_flush_later の中) から呼ばれた場合も、次の書き込みを予約し直す
+        if self._task is None or self._task.done() or self._task is asyncio.current_task():
+            self._task = loop.create_task(self._flush_later(delay))
+
+    def _snapshot(self):
+        # コピーはループ上で取り、書き込み中の変更と競合しないようにする
+        snapshot = {
+            guild_id: self.serialize(data) if data is not None else None
+            for guild_id, data in self._dirty.items()
+        }
+        written = self.pending
+        self._dirty = {}
+        self._inflight = set(snapshot)
+        return snapshot, written
+
+    def _write(self, snapshot):
+        with self._lock:
+            start = time.perf_counter()
+            self.store.save_guilds(snapshot)
+            elapsed = (time.perf_counter() - start) * 1000
+        self.flush_count += 1
+        self.last_flush_ms = elapsed
+        self.max_flush_ms = max(self.max_flush_ms, elapsed)
+        return elapsed
+
+    def _notify(self, elapsed):
+        # 書き込みスレッドではなく呼び出し側 (ループ) で呼ぶ。失敗しても書き込みは成功扱いのまま
+        for callback in self.on_flush:
+            try:
+                callback(elapsed / 1000)
+            except Exception:
+                log.exception('on_flush の処理に失敗しました')
+
+    def _restore(self, snapshot):
+        # 失敗した分は、その後に変更されていなければ次回に持ち越す
+        for guild_id, data in snapshot.items():
+            self._dirty.setdefault(guild_id, data)
+
+    async def flush(self):
+        """未書き込みの変更をスレッドプールで書き込む"""
+        if not self._dirty:
+            return
+        snapshot, written = self._snapshot()
+        loop = asyncio.get_running_loop()
+        try:
+            elapsed = await loop.run_in_executor(None, self._write, snapshot)
+        except Exception as e:
+            self._restore(snapshot)
+            self.last_error = str(e)
+            self.retry_delay = min(MAX_RETRY_DELAY, (self.retry_delay or self.delay) * 2)
+            log.error('設定の保存に失敗しました (%.0f秒後に再試行): %s', self.retry_delay, e,
+                      extra={'guilds': len(snapshot)})
+            self._reschedule(loop, self.retry_delay)
+            return
+        finally:
+            self._inflight = set()
+        self.pending -= written
+        self.retry_delay = None
+        self._notify(elapsed)
+        # 書き込み中に新しい変更があれば再度予約
+        if self._dirty:
+            self._reschedule(loop)
+
+    def flush_sync(self):
+        """終了時などにその場で書き込む"""
+        if not self._dirty:
+            return
+        snapshot, written = self._snapshot()
+        try:
+            elapsed = self._write(snapshot)
+        except Exception:
+            self._restore(snapshot)
+            raise
+        finally:
+            self._inflight = set()
+        self.pending -= written
+        self._notify(elapsed)
+
+    def stats(self):
+        return {
+            'pending': self.pending,
+            'dirty_guilds': len(self._dirty),
+            'flush_count': self.flush_count,
+            'last_flush_ms': self.last_flush_ms,
+            'max_flush_ms': self.max_flush_ms,
+            'last_error': self.last_error,
+            'retry_delay': self.retry_delay,
+        }
@@ -0,0 +1,90 @@
+"""語録のインポート・エクスポート (JSON / JSON Lines / CSV)"""
+import codecs
+import csv
+import io
+import json
+
+import aiohttp
+
+
+async def download(url, max_bytes, chunk_size=64 * 1024):
+    """添付ファイルを少しずつ読み込み、上限を超えたら途中でやめる"""
+    decoder = codecs.getincrementaldecoder('utf-8-sig')()
+    parts = []
+    size = 0
+    try:
+        async with aiohttp.ClientSession() as session:
+            async with session.get(url) as response:
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(chunk_size):
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise ValueError(f'ファイルが大きすぎます (上限 {max_bytes // 1024}KB)')
+                    parts.append(decoder.decode(chunk))
+    except aiohttp.ClientError as e:
+        raise ValueError(f'ダウンロードに失敗しました ({e})') from e
+    parts.append(decoder.decode(b'', final=True))
+    return ''.join(parts)
+
+
+def _row(item):
+    """1件分を (text, image) に。文字列か {'text', 'image'} を受け付ける"""
+    if isinstance(item, str):
+        text, image = item, None
+    elif isinstance(item, dict):
+        text, image = item.get('text'), item.get('image') or None
+    else:
+        return None
+    if not isinstance(text, str) or not text.strip():
+        return None
+    return text.strip(), image
+
+
+def parse_quotes(text, filename):
+    """ファイルの内容を [(text, image)] に変換 (ブロッキングなのでスレッドで呼ぶ)
+
+    - .csv: 1列目がテキスト、2列目があれば画像URL (見出し行 text,image は読み飛ばす)
+    - .jsonl: 1行に1件
+    - .json: 配列、または !export_quotes の形式 {"quotes": [...]}
+    """
+    name = filename.lower()
+    rows = []
+    if name.endswith('.csv'):
+        try:
+            for record in csv.reader(io.StringIO(text)):
+                if not record or record[0].strip().lower() == 'text':
+                    continue
+                row = _row({'text': record[0], 'image': record[1].strip() if len(record) > 1 else None})
+                if row:
+                    rows.append(row)
+        except csv.Error as e:
+            raise ValueError(f'CSVの形式が正しくありません ({e})') from e
+    elif name.endswith('.jsonl'):
+        for line in text.splitlines():
+            if line.strip():
+                row = _row(json.loads(line))
+                if row:
+                    rows.append(row)
+    elif name.endswith('.json'):
+        data = json.loads(text)
+        if isinstance(data, dict):
+            data = data.get('quotes', [])
+        if not isinstance(data, list):
+            raise ValueError('JSONは語録の配列にしてください')
+        rows = [row for row in map(_row, data) if row]
+    else:
+        raise ValueError('対応している形式は .json / .jsonl / .csv です')
+    return rows
+
+
+def export_quotes(quotes, fmt):
+    """語録をファイルの内容 (bytes) に変換 (ブロッキングなのでスレッドで呼ぶ)"""
+    if fmt == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(['text', 'image', 'id'])
+        for quote in quotes:
+            writer.writerow([quote.text, quote.image or '', quote.id])
+        return buffer.getvalue().encode('utf-8-sig')  # Excelで文字化けしないようBOM付き
+    data = {'quotes': [quote.to_dict() for quote in quotes]}
+    return json.dumps(data, ensure_ascii=False, indent=1).encode('utf-8')
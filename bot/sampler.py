@@ -0,0 +1,170 @@
+"""語録・画像を偏りなく選ぶための重み付きシャッフルバッグと、その位置の保存"""
+import asyncio
+import json
+import logging
+import os
+import random
+
+from persistence import atomic_write
+
+log = logging.getLogger('pp_angel.sampler')
+
+MAX_WEIGHT = 10   # 1巡の長さが重みの合計になるので上限を設ける
+
+
+class ShuffleBag:
+    """重み付きのシャッフルバッグ
+
+    1巡の間に各項目を重みの回数ずつランダムな順で出すので、重みの大きい項目ほど
+    よく出るが、どの項目も1巡のうちに必ず出る。取り出しは O(1) (巡の変わり目の
+    詰め直しを含めて平均 O(1))、追加・削除は O(重み)。
+    削除した項目はバッグに残し、取り出す時に読み飛ばす。
+    """
+
+    def __init__(self, weights=(), cursor=None, rng=None):
+        self._rng = rng or random.Random()
+        self._weights = {}    # 項目 -> 重み
+        self._bag = []        # この巡の残り (末尾から取り出す)
+        self._in_bag = {}     # 項目 -> バッグに残っている数 (読み飛ばす分も含む)
+        self._drawn = {}      # 項目 -> この巡で出した回数
+        self.cycle = 0
+        self.last = None
+        if cursor:
+            self.cycle = cursor.get('cycle', 0)
+            self.last = cursor.get('last')
+            self._drawn = {item: count for item, count in cursor.get('drawn', [])}
+        for item, weight in dict(weights).items():
+            self.add(item, weight)
+        self._drawn = {item: count for item, count in self._drawn.items() if item in self._weights}
+
+    def __len__(self):
+        return len(self._weights)
+
+    def __contains__(self, item):
+        return item in self._weights
+
+    def _insert(self, item, count):
+        bag = self._bag
+        rng = self._rng
+        for _ in range(count):
+            # 末尾に足してからランダムな位置と入れ替える
+            bag.append(item)
+            j = rng.randrange(len(bag))
+            bag[j], bag[-1] = bag[-1], bag[j]
+        self._in_bag[item] = self._in_bag.get(item, 0) + count
+
+    def add(self, item, weight=1):
+        """項目を追加 (追加済みなら重みを変更)。この巡の残りにも入る"""
+        weight = max(1, min(int(weight), MAX_WEIGHT))
+        self._weights[item] = weight
+        missing = weight - self._drawn.get(item, 0) - self._in_bag.get(item, 0)
+        if missing > 0:
+            self._insert(item, missing)
+
+    def remove(self, item):
+        self._weights.pop(item, None)
+        self._drawn.pop(item, None)
+
+    def sync(self, items):
+        """項目を items (重み1) に揃える。変わった分だけ追加・削除する"""
+        items = set(items)
+        for item in [item for item in self._weights if item not in items]:
+            self.remove(item)
+        for item in items:
+            if item not in self._weights:
+                self.add(item)
+
+    def _refill(self):
+        self._bag = [item for item, weight in self._weights.items() for _ in range(weight)]
+        self._rng.shuffle(self._bag)
+        bag = self._bag
+        if len(bag) > 1 and bag[-1] == self.last:
+            # 巡の変わり目で同じものが続かないようにする
+            j = self._rng.randrange(len(bag) - 1)
+            bag[j], bag[-1] = bag[-1], bag[j]
+        self._in_bag = dict(self._weights)
+        self._drawn = {}
+        self.cycle += 1
+
+    def draw(self):
+        """次の項目 (なければ None)"""
+        if not self._weights:
+            return None
+        while True:
+            if not self._bag:
+                self._refill()
+            item = self._bag.pop()
+            remaining = self._in_bag[item] - 1
+            if remaining:
+                self._in_bag[item] = remaining
+            else:
+                del self._in_bag[item]
+            weight = self._weights.get(item)
+            drawn = self._drawn.get(item, 0)
+            if weight is not None and drawn < weight:
+                break
+            # 削除された項目、または重みを下げて出しすぎになる分
+        self._drawn[item] = drawn + 1
+        self.last = item
+        return item
+
+    def cursor(self):
+        """保存用の位置 (この巡で出したもの)。項目はJSONにできる値にする"""
+        return {'cycle': self.cycle, 'last': self.last, 'drawn': [[item, n] for item, n in self._drawn.items()]}
+
+
+class RotationStore:
+    """サンプラーの位置をファイルに保存し、再起動しても1巡の続きから出す
+
+    使用中のサンプラーは track() で登録しておき、保存する時に位置を取り出す。
+    メモリから解放する時は release() で位置だけを残す。
+    """
+
+    def __init__(self, path='rotation.json'):
+        self.path = path
+        self._cursors = {}   # キー -> 位置
+        self._live = {}      # キー -> ShuffleBag
+        self._dirty = False
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self._cursors = json.load(f)
+        except (OSError, ValueError) as e:
+            log.warning('ローテーションの読み込みに失敗しました: %s', e)
+
+    def cursor(self, key):
+        """保存されている位置 (使用中ならそのサンプラーの位置)"""
+        bag = self._live.get(key)
+        return bag.cursor() if bag is not None else self._cursors.get(key)
+
+    def track(self, key, bag):
+        """取り出しのたびに呼ぶ (位置が変わったことを記録する)"""
+        self._live[key] = bag
+        self._dirty = True
+
+    def release(self, key):
+        bag = self._live.pop(key, None)
+        if bag is not None:
+            self._cursors[key] = bag.cursor()
+
+    def _serialize(self):
+        data = dict(self._cursors)
+        for key, bag in self._live.items():
+            data[key] = bag.cursor()
+        return json.dumps(data, ensure_ascii=False)
+
+    async def save(self):
+        if not self._dirty:
+            return
+        self._dirty = False
+        data = self._serialize()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, atomic_write, self.path, data)
+
+    def save_sync(self):
+        if self._dirty:
+            atomic_write(self.path, self._serialize())
+            self._dirty = False
@@ -0,0 +1,216 @@
+"""サーバーごとの語録投稿スケジューラー"""
+import asyncio
+import heapq
+import json
+import logging
+import os
+import time
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+from persistence import atomic_write
+
+log = logging.getLogger('pp_angel.scheduler')
+
+
+def _anchor_on(day, hour, minute):
+    """day (datetime) と同じ日の hour:minute の UNIX時刻"""
+    return day.replace(hour=hour, minute=minute, second=0, microsecond=0).timestamp()
+
+
+def parse_schedule(time_text, interval_minutes=None, timezone='Asia/Tokyo', now=None):
+    """コマンドの引数からスケジュールを作る (不正な値なら ValueError)
+
+    間隔を指定した場合は、設定した日の time を起点 (anchor) として、そこから間隔ごとに投稿する。
+    """
+    hour, minute = (int(part) for part in time_text.split(':'))
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        raise ValueError(f'時刻が不正です: {time_text}')
+    if interval_minutes is not None and interval_minutes <= 0:
+        raise ValueError('間隔は1分以上にしてください')
+    tz = ZoneInfo(timezone)  # 存在しないタイムゾーンなら例外
+    spec = {'time': f'{hour:02d}:{minute:02d}', 'interval_minutes': interval_minutes, 'timezone': timezone}
+    if interval_minutes:
+        now = time.time() if now is None else now
+        spec['anchor'] = _anchor_on(datetime.fromtimestamp(now, tz), hour, minute)
+    return spec
+
+
+def next_fire_time(spec, after):
+    """after (UNIX時刻) より後の最初の投稿時刻を返す
+
+    interval_minutes がなければ毎日 time に、あれば起点 (anchor) から interval_minutes ごとに投稿する。
+    日をまたいでも間隔は一定で、1日 (1440分) を割り切れない間隔や1日より長い間隔も使える。
+    """
+    tz = ZoneInfo(spec.get('timezone') or 'Asia/Tokyo')
+    hour, minute = (int(part) for part in spec['time'].split(':'))
+    now = datetime.fromtimestamp(after, tz)
+    anchor = now.replace(hour=hour, minute=minute, second=0, microsecond=0)
+    interval = spec.get('interval_minutes')
+    if not interval:
+        if anchor.timestamp() <= after:
+            anchor = (anchor + timedelta(days=1)).replace(hour=hour, minute=minute)
+        return anchor.timestamp()
+    step = interval * 60
+    start = spec.get('anchor')
+    if start is None:
+        # 起点のないスケジュールは after の日 (まだならその前日) の time から数える
+        if anchor.timestamp() > after:
+            anchor -= timedelta(days=1)
+        start = anchor.timestamp()
+    if start > after:
+        return start
+    count = int((after - start) // step) + 1
+    return start + count * step
+
+
+class QuoteScheduler:
+    """次の投稿時刻の優先度付きキューで、時刻になったサーバーだけを処理する
+
+    スケジュールと次の投稿時刻はファイルに保存し、再起動しても
+    二重投稿や投稿漏れが起きないようにする。
+    """
+
+    def __init__(self, post, path='schedule.json', concurrency=10):
+        self.post = post                  # async post(guild_id)
+        self.path = path
+        self.concurrency = concurrency
+        self.schedules = {}               # guild_id -> {'time', 'interval_minutes', 'timezone'}
+        self.disabled = set()             # !set_schedule off で停止したサーバー (自動では登録しない)
+        self.next_fire = {}               # guild_id -> UNIX時刻
+        self.posted = 0
+        self.failed = 0
+        self._heap = []                   # (時刻, guild_id) 古いエントリは取り出す時に捨てる
+        self._wake = asyncio.Event()
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._tasks = set()
+        self._dirty = False
+
+    def load(self):
+        """保存したスケジュールを読み込む。ファイルがなければ False"""
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        for guild_id, entry in data.items():
+            if entry.get('off'):
+                self.disabled.add(guild_id)
+                continue
+            spec = {k: entry.get(k) for k in ('time', 'interval_minutes', 'timezone')}
+            if spec['interval_minutes']:
+                # 起点のない古いファイルは、保存されている次の投稿時刻を起点にする
+                spec['anchor'] = entry.get('anchor') or entry.get('next_fire')
+            self.schedules[guild_id] = spec
+            # 停止中に過ぎた投稿は起動後に1回だけ行う
+            self._push(guild_id, entry.get('next_fire') or next_fire_time(spec, time.time()))
+        return True
+
+    def _serialize(self):
+        data = {guild_id: {'off': True} for guild_id in self.disabled}
+        data.update(
+            (guild_id, dict(spec, next_fire=self.next_fire.get(guild_id)))
+            for guild_id, spec in self.schedules.items()
+        )
+        return json.dumps(data, ensure_ascii=False)
+
+    async def save(self):
+        if not self._dirty:
+            return
+        self._dirty = False
+        data = self._serialize()
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, atomic_write, self.path, data)
+
+    def save_sync(self, force=False):
+        """force なら変更がなくても書き込む (空のスケジュールも保存して初回扱いを終える)"""
+        if self._dirty or force:
+            atomic_write(self.path, self._serialize())
+            self._dirty = False
+
+    def _push(self, guild_id, when):
+        self.next_fire[guild_id] = when
+        heapq.heappush(self._heap, (when, guild_id))
+        self._dirty = True
+
+    def set_schedule(self, guild_id, spec):
+        """スケジュールを設定し、次の投稿時刻を返す"""
+        self.schedules[guild_id] = spec
+        self.disabled.discard(guild_id)
+        when = next_fire_time(spec, time.time())
+        self._push(guild_id, when)
+        self._wake.set()
+        return when
+
+    def _forget(self, guild_id):
+        self.schedules.pop(guild_id, None)
+        self.next_fire.pop(guild_id, None)
+        self._dirty = True
+
+    def remove(self, guild_id):
+        """投稿を停止する (ensure() や起動時の登録では再開しない)"""
+        self._forget(guild_id)
+        self.disabled.add(guild_id)
+        self._wake.set()   # 次の投稿を待たずに保存させる
+
+    def ensure(self, guild_id, spec):
+        """登録も停止もされていなければ spec で登録し、登録したら True"""
+        if guild_id in self.schedules or guild_id in self.disabled:
+            return False
+        self.set_schedule(guild_id, spec)
+        return True
+
+    def reconcile(self, owns, guild_ids, spec):
+        """担当するサーバーに合わせる (シャード数が変わると担当が入れ替わる)
+
+        owns(guild_id) が偽のサーバーを外し、guild_ids (投稿チャンネルのあるサーバー) のうち
+        担当していて未登録のものを spec で登録する。(外した数, 登録した数) を返す。
+        """
+        dropped = [guild_id for guild_id in self.schedules.keys() | self.disabled if not owns(guild_id)]
+        for guild_id in dropped:
+            self._forget(guild_id)
+            self.disabled.discard(guild_id)
+        added = sum(1 for guild_id in guild_ids if owns(guild_id) and self.ensure(guild_id, spec))
+        return len(dropped), added
+
+    def pending(self):
+        return len(self.next_fire)
+
+    def _pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            when, guild_id = heapq.heappop(self._heap)
+            if self.next_fire.get(guild_id) != when:
+                continue  # 変更・削除された古いエントリ
+            due.append(guild_id)
+            # 送信前に次の時刻へ進めて保存する (再起動時の二重投稿を防ぐ)
+            self._push(guild_id, next_fire_time(self.schedules[guild_id], now))
+        return due
+
+    async def _post_one(self, guild_id):
+        async with self._semaphore:
+            try:
+                await self.post(guild_id)
+                self.posted += 1
+            except Exception as e:
+                self.failed += 1
+                log.error('定期投稿に失敗しました: %s', e, extra={'guild_id': guild_id})
+
+    async def run(self):
+        """時刻になったサーバーだけを起こして、同時実行数を制限しつつ投稿する"""
+        while True:
+            now = time.time()
+            due = self._pop_due(now)
+            if due:
+                await self.save()
+                for guild_id in due:
+                    task = asyncio.create_task(self._post_one(guild_id))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+            await self.save()
+
+            timeout = self._heap[0][0] - time.time() if self._heap else None
+            self._wake.clear()
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
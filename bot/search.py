@@ -0,0 +1,130 @@
+"""語録の全文検索 (文字バイグラムの転置インデックス)
+
+日本語は空白で単語に分けられないので、隣り合う2文字を単位に索引を作る。
+"""
+import heapq
+import re
+import unicodedata
+
+_SPACE = re.compile(r'\s')
+
+
+def normalize(text):
+    """全角・半角や大文字・小文字の違いをならす"""
+    return unicodedata.normalize('NFKC', text).casefold()
+
+
+def bigrams(text, normalized=False):
+    """空白を含まない2文字の組の集合 (1文字だけならその文字)"""
+    if not normalized:
+        text = normalize(text)
+    grams = set(map(str.__add__, text, text[1:]))
+    if _SPACE.search(text):
+        grams = {g for g in grams if not g[0].isspace() and not g[1].isspace()}
+    if not grams:
+        stripped = text.strip()
+        if len(stripped) == 1:
+            grams = {stripped}
+    return grams
+
+
+class BigramIndex:
+    """ID -> テキストの転置インデックス。追加・削除はその文書の分だけ更新する"""
+
+    def __init__(self):
+        self._postings = {}   # バイグラム -> {doc_id}
+        self._docs = {}       # doc_id -> (正規化したテキスト, バイグラム)
+        self._chars = {}      # 1文字 -> {その文字を含むバイグラム} (1文字の検索用)
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __contains__(self, doc_id):
+        return doc_id in self._docs
+
+    def ids(self):
+        return list(self._docs)
+
+    def add(self, doc_id, text):
+        if doc_id in self._docs:
+            self.remove(doc_id)
+        text = normalize(text)
+        grams = bigrams(text, normalized=True)
+        self._docs[doc_id] = (text, grams)
+        all_postings = self._postings
+        for gram in grams:
+            postings = all_postings.get(gram)
+            if postings is None:
+                postings = all_postings[gram] = set()
+                for char in set(gram):
+                    self._chars.setdefault(char, set()).add(gram)
+            postings.add(doc_id)
+
+    def remove(self, doc_id):
+        entry = self._docs.pop(doc_id, None)
+        if entry is None:
+            return
+        for gram in entry[1]:
+            postings = self._postings[gram]
+            postings.discard(doc_id)
+            if not postings:
+                del self._postings[gram]
+                for char in set(gram):
+                    chars = self._chars.get(char)
+                    if chars is not None:
+                        chars.discard(gram)
+                        if not chars:
+                            del self._chars[char]
+
+    def _candidates(self, grams):
+        """{doc_id: 一致したバイグラム数}"""
+        if len(grams) == 1 and len(next(iter(grams))) == 1:
+            # 1文字の検索はその文字を含むバイグラムの和集合
+            char = next(iter(grams))
+            docs = set(self._postings.get(char, ()))
+            for gram in self._chars.get(char, ()):
+                docs |= self._postings[gram]
+            return dict.fromkeys(docs, 1)
+
+        lists = sorted((self._postings.get(g, set()) for g in grams), key=len)
+        if lists and lists[0]:
+            # まずは全バイグラムを含む文書 (小さい集合から順に絞る)
+            docs = set(lists[0])
+            for postings in lists[1:]:
+                docs &= postings
+                if not docs:
+                    break
+            if docs:
+                return dict.fromkeys(docs, len(grams))
+
+        # 全部を含む文書がなければ、半分以上一致する文書
+        counts = {}
+        for postings in lists:
+            for doc_id in postings:
+                counts[doc_id] = counts.get(doc_id, 0) + 1
+        need = max(1, (len(grams) + 1) // 2)
+        return {doc_id: n for doc_id, n in counts.items() if n >= need}
+
+    def search(self, query, limit=10, offset=0):
+        """(ヒット数, [(doc_id, スコア)]) を返す。スコアが高い順、同点は短い文書・古い順"""
+        grams = bigrams(query)
+        if not grams:
+            return 0, []
+        needle = normalize(query).strip()
+        ranked = []
+        for doc_id, matched in self._candidates(grams).items():
+            text = self._docs[doc_id][0]
+            score = matched / len(grams)
+            if needle in text:
+                score += 1.0  # 語句がそのまま含まれるものを優先
+            ranked.append((-score, len(text), doc_id))
+        page = heapq.nsmallest(offset + limit, ranked)[offset:]
+        return len(ranked), [(doc_id, -neg_score) for neg_score, _, doc_id in page]
+
+
+def build_index(items):
+    """[(doc_id, text)] からインデックスを作る (スレッドで呼べるようにスナップショットを渡す)"""
+    index = BigramIndex()
+    for doc_id, text in items:
+        index.add(doc_id, text)
+    return index
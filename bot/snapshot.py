@@ -0,0 +1,66 @@
+"""起動を速くするための、サーバーごとの派生データ (照合器・検索インデックス) のスナップショット
+
+終了時にメモリ上の GuildState を照合器ごと保存し、次の起動で設定ファイルが
+その時から変わっていなければ、読み込み・正規化・照合器の構築を省いてそのまま使う。
+起動時はサーバーごとのバイト列を読むだけにし、復元 (thaw) はそのサーバーが
+最初に使われた時に行う。自分で書いたファイルだけを読む前提で pickle を使う。
+"""
+import logging
+import os
+import pickle
+import time
+
+from persistence import atomic_write
+
+log = logging.getLogger('pp_angel.snapshot')
+
+# GuildState・Quote・Matcher などの持ち方を変えたら上げる (古いスナップショットは使わない)
+SNAPSHOT_VERSION = 3
+
+
+class Snapshot:
+    __slots__ = ('guild_ids', 'frozen')
+
+    def __init__(self, guild_ids, frozen):
+        self.guild_ids = guild_ids   # 設定が存在するサーバー
+        self.frozen = frozen         # guild_id -> freeze() したバイト列 (保存時にメモリ上にあったもの)
+
+
+def freeze(state):
+    return pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def thaw(data):
+    return pickle.loads(data)
+
+
+def save_snapshot(path, fingerprint, guild_ids, frozen):
+    """スナップショットを書き込み、書き込んだバイト数を返す"""
+    data = pickle.dumps({
+        'version': SNAPSHOT_VERSION,
+        'fingerprint': fingerprint,
+        'saved_at': time.time(),
+        'guild_ids': list(guild_ids),
+        'frozen': frozen,
+    }, protocol=pickle.HIGHEST_PROTOCOL)
+    atomic_write(path, data)
+    return len(data)
+
+
+def load_snapshot(path, fingerprint):
+    """設定ファイルが保存時と同じなら Snapshot を返す。使えなければ None"""
+    if fingerprint is None or not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'rb') as f:
+            data = pickle.load(f)
+    except Exception as e:
+        log.warning('スナップショットを読み込めませんでした: %s', e)
+        return None
+    if not isinstance(data, dict) or data.get('version') != SNAPSHOT_VERSION:
+        log.info('スナップショットの形式が古いため使いません')
+        return None
+    if data.get('fingerprint') != fingerprint:
+        log.info('設定ファイルがスナップショットの保存後に変更されたため使いません')
+        return None
+    return Snapshot(data['guild_ids'], data['frozen'])
@@ -0,0 +1,556 @@
+"""サーバー設定の保存先 (JSON / SQLite) と遅延読み込みキャッシュ"""
+import asyncio
+import copy
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+import time
+
+from persistence import atomic_write
+
+log = logging.getLogger('pp_angel.storage')
+
+
+class JsonStore:
+    """従来の config.json にまとめて保存する形式 (1プロセス専用)
+
+    外のエディタなどで書き換えられたら reload() で読み直せる。
+    ファイルは最初に必要になった時に読む (スナップショットから起動した場合は後回しになる)。
+    """
+
+    shared = False
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._stat = self._file_stat()   # 最後に読み書きした時のファイルの状態
+        self._doc = None
+        self._stale = False              # 読み込む前に外で書き換えられていた
+
+    def _document(self):
+        """ファイルの内容 (ロックを取ってから呼ぶ)"""
+        if self._doc is None:
+            stat = self._file_stat()
+            if stat is not None:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    self._doc = json.load(f)
+            else:
+                self._doc = {}
+            self._doc.setdefault('servers', {})
+            if stat != self._stat:
+                self._stale = True
+        return self._doc
+
+    def fingerprint(self):
+        """スナップショットがこのファイルの内容から作られたかを確かめる値"""
+        with self._lock:
+            return None if self._stale else ('json', self._stat)
+
+    def _file_stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size, stat.st_ino
+
+    def changed_on_disk(self):
+        """最後に読み書きした後に外でファイルが書き換えられたか (stat だけなのでループ上で呼べる)"""
+        stat = self._file_stat()
+        return self._stale or (stat is not None and stat != self._stat)
+
+    def reload(self):
+        """書き換えられたファイルを読み直し、内容が変わったサーバーのIDを返す (スレッドで呼ぶ)
+
+        まだ読み込んでいなかった場合など、どのサーバーが変わったか分からなければ None。
+        読み込めない場合 (編集途中など) は ValueError。次に書き換えられた時にまた読む。
+        """
+        with self._lock:
+            stat = self._file_stat()
+            if not self._stale and (stat is None or stat == self._stat):
+                return []
+            self._stat = stat
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    doc = json.load(f)
+            except (OSError, ValueError) as e:
+                raise ValueError(f'{self.path} を読み込めません ({e})') from e
+            if not isinstance(doc, dict) or not isinstance(doc.setdefault('servers', {}), dict):
+                raise ValueError(f'{self.path} の形式が正しくありません')
+            unknown = self._doc is None or self._stale
+            old, new = (self._doc or {}).get('servers', {}), doc['servers']
+            self._doc = doc
+            self._stale = False
+            if unknown:
+                return None
+            return [guild_id for guild_id in old.keys() | new.keys() if old.get(guild_id) != new.get(guild_id)]
+
+    def guild_ids(self):
+        with self._lock:
+            return list(self._document()['servers'])
+
+    def channel_guild_ids(self):
+        """投稿チャンネルが設定されたサーバーのID"""
+        with self._lock:
+            return [guild_id for guild_id, data in self._document()['servers'].items()
+                    if data.get('quote_channel_id') is not None]
+
+    def load_guild(self, guild_id):
+        with self._lock:
+            data = self._document()['servers'].get(guild_id)
+            return copy.deepcopy(data) if data is not None else None
+
+    def save_guilds(self, guilds):
+        """{guild_id: 設定 or None(削除)} を反映してファイル全体を書き直す"""
+        with self._lock:
+            doc = self._document()
+            for guild_id, data in guilds.items():
+                if data is None:
+                    doc['servers'].pop(guild_id, None)
+                else:
+                    doc['servers'][guild_id] = data
+            atomic_write(self.path, json.dumps(doc, ensure_ascii=False, indent=2))
+            self._stat = self._file_stat()   # 自分の書き込みは読み直さない
+
+    def latest_change(self):
+        return 0
+
+    def changes_since(self, seq):
+        return []
+
+    def forget(self, guild_id):
+        pass
+
+    def close(self):
+        pass
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS guilds (
+    guild_id TEXT PRIMARY KEY,
+    quote_channel_id INTEGER,
+    extra TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS triggers (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    guild_id TEXT NOT NULL,
+    word TEXT NOT NULL,
+    response TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_triggers_guild ON triggers (guild_id, id);
+CREATE TABLE IF NOT EXISTS quotes (
+    guild_id TEXT NOT NULL,
+    id INTEGER NOT NULL,
+    text TEXT NOT NULL,
+    image TEXT,
+    media TEXT,
+    weight INTEGER NOT NULL DEFAULT 1,
+    PRIMARY KEY (guild_id, id)
+);
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    guild_id TEXT NOT NULL,
+    origin TEXT NOT NULL,
+    changed_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS shard_status (
+    shard_id INTEGER PRIMARY KEY,
+    cluster_id TEXT,
+    latency REAL,
+    guild_count INTEGER,
+    updated_at REAL NOT NULL
+);
+"""
+
+
+class SQLiteStore:
+    """サーバー・反応ワード・語録をテーブルに分けて保存する形式
+
+    変更はサーバー単位で書き込むので、1件の変更で全サーバー分を書き直さない。
+    サーバーの中でも、最後に読み書きした行を覚えておき、変わった反応ワード・語録の行だけを書く。
+    複数プロセス (シャード構成) で同じファイルを共有でき、変更履歴 (changes) から
+    他のプロセスが書き込んだサーバーを知ることができる。
+    """
+
+    shared = True
+
+    def __init__(self, path, origin=None):
+        self.path = path
+        self.origin = origin or str(os.getpid())   # 変更履歴に記録する書き込み元
+        self._lock = threading.Lock()
+        # guild_id -> [変更履歴の番号, {語録ID: 行}, {ワード: (行ID, 応答)}] (最後に読み書きした内容)
+        self._saved = {}
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.executescript(SCHEMA)
+        columns = [row[1] for row in self._conn.execute('PRAGMA table_info(quotes)')]
+        if 'media' not in columns:
+            # 画像の保存名 (media列) がない古いファイル
+            self._conn.execute('ALTER TABLE quotes ADD COLUMN media TEXT')
+        if 'weight' not in columns:
+            # ランダムに選ぶ時の重み (weight列) がない古いファイル
+            self._conn.execute('ALTER TABLE quotes ADD COLUMN weight INTEGER NOT NULL DEFAULT 1')
+
+    def guild_ids(self):
+        with self._lock:
+            return [row[0] for row in self._conn.execute('SELECT guild_id FROM guilds')]
+
+    def channel_guild_ids(self):
+        """投稿チャンネルが設定されたサーバーのID"""
+        with self._lock:
+            return [row[0] for row in self._conn.execute(
+                'SELECT guild_id FROM guilds WHERE quote_channel_id IS NOT NULL')]
+
+    def _read_rows(self, guild_id):
+        """保存されている反応ワード・語録の行を読み、覚えておく (ロックを取ってから呼ぶ)"""
+        conn = self._conn
+        # 番号を先に読む (行を読む間に書き込まれても、次の書き込みで読み直すことになるだけ)
+        seq = conn.execute('SELECT COALESCE(MAX(seq), 0) FROM changes').fetchone()[0]
+        triggers = {word: (row_id, response) for row_id, word, response in conn.execute(
+            'SELECT id, word, response FROM triggers WHERE guild_id = ? ORDER BY id', (guild_id,))}
+        quotes = {row[0]: row for row in conn.execute(
+            'SELECT id, text, image, media, weight FROM quotes WHERE guild_id = ? ORDER BY id', (guild_id,))}
+        saved = self._saved[guild_id] = [seq, quotes, triggers]
+        return saved
+
+    def _saved_rows(self, guild_id):
+        """覚えている行。他のプロセスが書き込んだ (または履歴が消えて分からない) 場合は読み直す"""
+        saved = self._saved.get(guild_id)
+        if saved is not None:
+            seq = saved[0]
+            oldest = self._conn.execute('SELECT MIN(seq) FROM changes').fetchone()[0]
+            foreign = self._conn.execute(
+                'SELECT 1 FROM changes WHERE seq > ? AND guild_id = ? AND origin != ? LIMIT 1',
+                (seq, guild_id, self.origin)
+            ).fetchone()
+            if oldest is not None and oldest <= seq + 1 and foreign is None:
+                return saved
+        return self._read_rows(guild_id)
+
+    def load_guild(self, guild_id):
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT quote_channel_id, extra FROM guilds WHERE guild_id = ?', (guild_id,)
+            ).fetchone()
+            if row is None:
+                self._saved.pop(guild_id, None)
+                return None
+            data = json.loads(row[1])
+            if row[0] is not None:
+                data['quote_channel_id'] = row[0]
+            _, quotes, triggers = self._read_rows(guild_id)
+            if triggers:
+                data['triggers'] = [{'word': w, 'response': r} for w, (_, r) in triggers.items()]
+            if quotes:
+                data['quotes'] = [{'id': q, 'text': t, 'image': i, 'media': m, 'weight': w}
+                                  for q, t, i, m, w in quotes.values()]
+            return data
+
+    def _save_guild(self, guild_id, data):
+        """サーバー1つ分を書き込み、書き込んだ後の [番号, 語録の行, 反応ワード] を返す (削除は None)
+
+        反応ワード・語録は覚えている行と比べ、変わった行だけを (guild_id, id) / ワードで書き換える。
+        """
+        conn = self._conn
+        if data is None:
+            conn.execute('DELETE FROM triggers WHERE guild_id = ?', (guild_id,))
+            conn.execute('DELETE FROM quotes WHERE guild_id = ?', (guild_id,))
+            conn.execute('DELETE FROM guilds WHERE guild_id = ?', (guild_id,))
+            return None
+        extra = {k: v for k, v in data.items() if k not in ('quote_channel_id', 'triggers', 'quotes')}
+        conn.execute(
+            'INSERT OR REPLACE INTO guilds (guild_id, quote_channel_id, extra) VALUES (?, ?, ?)',
+            (guild_id, data.get('quote_channel_id'), json.dumps(extra, ensure_ascii=False))
+        )
+        # 書き込みを始めてから比べる (他のプロセスの書き込みと入れ違わない)
+        _, saved_quotes, saved_triggers = self._saved_rows(guild_id)
+
+        # 反応ワードは行IDが登録順なので、残るワードの行はそのままにする
+        triggers = {}
+        last_id = 0
+        for t in data.get('triggers', []):
+            word, response = t['word'], t['response']
+            if word in triggers:
+                continue
+            saved = saved_triggers.get(word)
+            if saved is not None and saved[0] < last_id:
+                # 削除して追加し直されたワードは末尾の行として書き直す
+                conn.execute('DELETE FROM triggers WHERE id = ?', (saved[0],))
+                saved = None
+            if saved is None:
+                row_id = conn.execute('INSERT INTO triggers (guild_id, word, response) VALUES (?, ?, ?)',
+                                      (guild_id, word, response)).lastrowid
+            else:
+                row_id = saved[0]
+                if saved[1] != response:
+                    conn.execute('UPDATE triggers SET response = ? WHERE id = ?', (response, row_id))
+            triggers[word] = (row_id, response)
+            last_id = row_id
+        conn.executemany('DELETE FROM triggers WHERE id = ?',
+                         [(row_id,) for word, (row_id, _) in saved_triggers.items() if word not in triggers])
+
+        raw_quotes = data.get('quotes', [])
+        next_id = max([q.get('id') or 0 for q in raw_quotes if isinstance(q, dict)] + [0]) + 1
+        quotes = {}
+        for q in raw_quotes:
+            # 文字列の場合と辞書の場合の両方に対応 (IDがなければ振る)
+            if isinstance(q, str):
+                q = {'text': q}
+            quote_id = q.get('id')
+            if quote_id is None:
+                quote_id = next_id
+                next_id += 1
+            quotes[quote_id] = (quote_id, q.get('text', ''), q.get('image'), q.get('media'), q.get('weight') or 1)
+        conn.executemany('DELETE FROM quotes WHERE guild_id = ? AND id = ?',
+                         [(guild_id, quote_id) for quote_id in saved_quotes if quote_id not in quotes])
+        conn.executemany(
+            'INSERT OR REPLACE INTO quotes (guild_id, id, text, image, media, weight) VALUES (?, ?, ?, ?, ?, ?)',
+            [(guild_id,) + row for quote_id, row in quotes.items() if saved_quotes.get(quote_id) != row]
+        )
+        return [None, quotes, triggers]
+
+    def save_guilds(self, guilds):
+        """{guild_id: 設定 or None(削除)} を1トランザクションで反映"""
+        now = time.time()
+        with self._lock:
+            with self._conn:
+                written = {guild_id: self._save_guild(guild_id, data) for guild_id, data in guilds.items()}
+                self._conn.executemany(
+                    'INSERT INTO changes (guild_id, origin, changed_at) VALUES (?, ?, ?)',
+                    [(guild_id, self.origin, now) for guild_id in guilds]
+                )
+                seq = self._conn.execute('SELECT MAX(seq) FROM changes').fetchone()[0]
+            # 書き込めた時だけ、書いた内容を覚えておく
+            for guild_id, saved in written.items():
+                if saved is None:
+                    self._saved.pop(guild_id, None)
+                else:
+                    saved[0] = seq
+                    self._saved[guild_id] = saved
+
+    def latest_change(self):
+        with self._lock:
+            return self._conn.execute('SELECT COALESCE(MAX(seq), 0) FROM changes').fetchone()[0]
+
+    def fingerprint(self):
+        """スナップショットがこの内容から作られたかを確かめる値 (変更履歴に振った最後の番号)
+
+        古い変更履歴は prune_changes() で消えるので、消えても戻らない AUTOINCREMENT の番号を使う。
+        """
+        with self._lock:
+            row = self._conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+        return 'sqlite', row[0] if row else 0
+
+    def changes_since(self, seq):
+        """他のプロセスによる seq より後の変更 [(seq, guild_id)] を返す"""
+        with self._lock:
+            return self._conn.execute(
+                'SELECT seq, guild_id FROM changes WHERE seq > ? AND origin != ? ORDER BY seq',
+                (seq, self.origin)
+            ).fetchall()
+
+    def forget(self, guild_id):
+        """メモリから解放したサーバーの覚えている行を捨てる (ロックは取らない)"""
+        self._saved.pop(guild_id, None)
+
+    def prune_changes(self, older_than):
+        with self._lock, self._conn:
+            self._conn.execute('DELETE FROM changes WHERE changed_at < ?', (older_than,))
+
+    def publish_shard_status(self, rows):
+        """[(shard_id, cluster_id, latency, guild_count)] を記録"""
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.executemany(
+                'INSERT OR REPLACE INTO shard_status '
+                '(shard_id, cluster_id, latency, guild_count, updated_at) VALUES (?, ?, ?, ?, ?)',
+                [row + (now,) for row in rows]
+            )
+
+    def shard_status(self):
+        with self._lock:
+            return self._conn.execute(
+                'SELECT shard_id, cluster_id, latency, guild_count, updated_at '
+                'FROM shard_status ORDER BY shard_id'
+            ).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+def migrate_json_to_sqlite(json_path, db_path):
+    """config.json の内容をSQLiteに移行し、移行したサーバー数を返す"""
+    source = JsonStore(json_path)
+    target = SQLiteStore(db_path)
+    try:
+        guilds = {guild_id: source.load_guild(guild_id) for guild_id in source.guild_ids()}
+        target.save_guilds(guilds)
+    finally:
+        target.close()
+    return len(guilds)
+
+
+# 保存先を指定しなかった場合のファイル
+DEFAULT_PATHS = {'json': 'config.json', 'sqlite': 'bot.db'}
+
+
+def open_store(backend='json', path=None, legacy_path='config.json', origin=None):
+    """設定に応じた保存先を開く（SQLiteの初回起動時はconfig.jsonから移行）"""
+    if backend not in DEFAULT_PATHS:
+        raise ValueError(f'storage.backend は {" / ".join(DEFAULT_PATHS)} のどちらかにしてください ({backend})')
+    path = path or DEFAULT_PATHS[backend]
+    if backend == 'sqlite':
+        if os.path.abspath(path) == os.path.abspath(legacy_path):
+            # config.json をデータベースとして開くと壊れたファイルとして扱われる
+            raise ValueError(f'{legacy_path} はJSON形式の設定です。storage.path には bot.db などを指定してください')
+        if not os.path.exists(path) and os.path.exists(legacy_path):
+            count = migrate_json_to_sqlite(legacy_path, path)
+            log.info('%s から %d サーバー分の設定を %s に移行しました', legacy_path, count, path,
+                     extra={'guilds': count})
+        return SQLiteStore(path, origin=origin)
+    return JsonStore(path)
+
+
+class GuildCache:
+    """サーバー設定を必要になった時に読み込み、しばらく使われなければ解放する
+
+    読み込んだ設定は wrap() で変換して保持する (models.GuildState など)。
+    イベントループ上では load() でスレッドに読み込ませ、get() は読み込み済みの時に使う。
+    """
+
+    def __init__(self, store, idle_seconds=1800, wrap=dict, known=None):
+        self.store = store
+        self.idle_seconds = idle_seconds
+        self.wrap = wrap
+        # 設定が存在するサーバー (スナップショットから起動する場合は渡される)
+        self._known = set(known) if known is not None else set(store.guild_ids())
+        self._loaded = {}
+        self._last_used = {}
+        self._frozen = {}                      # スナップショットから復元できるサーバー
+        self._thaw = None
+        self._loading = {}                     # guild_id -> スレッドでの読み込み (Future)
+        self.on_evict = []                     # 解放時に呼ぶ関数 (guild_id)
+
+    def __contains__(self, guild_id):
+        return guild_id in self._known
+
+    def __len__(self):
+        return len(self._known)
+
+    def ids(self):
+        return list(self._known)
+
+    def get(self, guild_id, default=None):
+        if guild_id not in self._known:
+            return default
+        self._last_used[guild_id] = time.monotonic()
+        data = self._loaded.get(guild_id)
+        if data is None:
+            data = self._read(guild_id, self._frozen.pop(guild_id, None))
+            self._loaded[guild_id] = data
+        return data
+
+    def _read(self, guild_id, frozen):
+        if frozen is not None:
+            return self._thaw(frozen)
+        return self.wrap(self.store.load_guild(guild_id) or {})
+
+    async def load(self, guild_id):
+        """設定を返す。メモリ上になければスレッドで読み込む (同時に呼ばれたら同じ読み込みを待つ)
+
+        設定が存在しなければ None。
+        """
+        while guild_id in self._known and guild_id not in self._loaded:
+            future = self._loading.get(guild_id)
+            if future is None:
+                loop = asyncio.get_running_loop()
+                future = loop.run_in_executor(None, self._read, guild_id, self._frozen.pop(guild_id, None))
+                self._loading[guild_id] = future
+            data = await asyncio.shield(future)
+            # 読み込んでいる間に invalidate() されていたら読み直す
+            if self._loading.get(guild_id) is future:
+                del self._loading[guild_id]
+                if guild_id in self._known and guild_id not in self._loaded:
+                    self._loaded[guild_id] = data
+        return self.get(guild_id)
+
+    def __getitem__(self, guild_id):
+        if guild_id not in self._known:
+            raise KeyError(guild_id)
+        return self.get(guild_id)
+
+    def create(self, guild_id):
+        """設定がなければ空の設定を作って返す"""
+        if guild_id not in self._known:
+            self[guild_id] = self.wrap({})
+        return self.get(guild_id)
+
+    def __setitem__(self, guild_id, data):
+        self._known.add(guild_id)
+        self._frozen.pop(guild_id, None)
+        self._loading.pop(guild_id, None)
+        self._loaded[guild_id] = data
+        self._last_used[guild_id] = time.monotonic()
+
+    def loaded_count(self):
+        return len(self._loaded)
+
+    def loaded(self):
+        """メモリ上にある {guild_id: 設定}"""
+        return dict(self._loaded)
+
+    def frozen(self):
+        """スナップショットから読んだまま、まだ使われていない {guild_id: 保存データ}"""
+        return dict(self._frozen)
+
+    def preload(self, frozen, thaw):
+        """スナップショットの {guild_id: 保存データ} を、最初に使われた時に thaw() で復元する"""
+        self._frozen = {guild_id: data for guild_id, data in frozen.items() if guild_id in self._known}
+        self._thaw = thaw
+
+    def is_loaded(self, guild_id):
+        return guild_id in self._loaded
+
+    def invalidate(self, guild_id, exists=True):
+        """他のプロセスで変更されたサーバーを捨て、次に使う時に読み直す"""
+        if exists:
+            self._known.add(guild_id)
+        else:
+            self._known.discard(guild_id)
+        self._frozen.pop(guild_id, None)
+        self._loading.pop(guild_id, None)
+        self.store.forget(guild_id)
+        if self._loaded.pop(guild_id, None) is not None:
+            self._last_used.pop(guild_id, None)
+            for callback in self.on_evict:
+                callback(guild_id)
+
+    def evict_idle(self, keep=None):
+        """一定時間使われていないサーバーをメモリから解放する (keep(guild_id)が真なら残す)"""
+        deadline = time.monotonic() - self.idle_seconds
+        evicted = [
+            guild_id for guild_id in self._loaded
+            if self._last_used.get(guild_id, 0) < deadline and not (keep and keep(guild_id))
+        ]
+        for guild_id in evicted:
+            del self._loaded[guild_id]
+            self._last_used.pop(guild_id, None)
+            self.store.forget(guild_id)
+            for callback in self.on_evict:
+                callback(guild_id)
+        return evicted
+
+
+if __name__ == '__main__':
+    # 使い方: python storage.py migrate [config.json] [bot.db]
+    if len(sys.argv) >= 2 and sys.argv[1] == 'migrate':
+        json_path = sys.argv[2] if len(sys.argv) > 2 else 'config.json'
+        db_path = sys.argv[3] if len(sys.argv) > 3 else 'bot.db'
+        count = migrate_json_to_sqlite(json_path, db_path)
+        print(f'{count} サーバー分の設定を {db_path} に移行しました')
+    else:
+        print('使い方: python storage.py migrate [config.json] [bot.db]')
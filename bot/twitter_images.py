@@ -0,0 +1,307 @@
+"""ハッシュタグの画像付きツイート取得とキャッシュ (イベントループを止めない)"""
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from persistence import atomic_write
+from twitter_quota import QuotaExceeded, SEARCH_RECENT
+
+log = logging.getLogger('pp_angel.twitter')
+
+
+def search_hashtag_images(client, hashtag, next_token=None):
+    """ハッシュタグで画像付きツイートを検索し、(画像のリスト, 次ページのトークン) を返す
+
+    同期・ブロッキングなので TwitterImageFetcher からスレッドで呼ぶ。
+    """
+    params = {}
+    if next_token:
+        params['next_token'] = next_token
+    tweets = client.search_recent_tweets(
+        query=f'#{hashtag} has:images -is:retweet',
+        max_results=100,
+        tweet_fields=['attachments', 'author_id'],
+        expansions=['attachments.media_keys'],
+        media_fields=['url', 'preview_image_url'],
+        **params
+    )
+    next_token = (tweets.meta or {}).get('next_token')
+    if not tweets.data:
+        return [], next_token
+
+    # メディア情報を取得
+    media_dict = {}
+    if tweets.includes and 'media' in tweets.includes:
+        for media in tweets.includes['media']:
+            media_dict[media.media_key] = media
+
+    # 画像付きツイートを収集
+    image_tweets = []
+    for tweet in tweets.data:
+        if hasattr(tweet, 'attachments') and tweet.attachments and 'media_keys' in tweet.attachments:
+            for media_key in tweet.attachments['media_keys']:
+                media = media_dict.get(media_key)
+                if media is not None and media.type == 'photo':
+                    image_tweets.append({
+                        'text': tweet.text,
+                        'image_url': media.url,
+                        'tweet_id': tweet.id
+                    })
+    return image_tweets, next_token
+
+
+class SingleFlight:
+    """同じキーの処理が実行中なら、新しく始めずにその結果を待つ"""
+
+    def __init__(self):
+        self._inflight = {}
+
+    def is_running(self, key):
+        return key in self._inflight
+
+    async def do(self, key, coro_factory):
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(coro_factory())
+            self._inflight[key] = future
+            future.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # 待っている側がキャンセルされても共有中の処理は止めない
+        return await asyncio.shield(future)
+
+
+class TwitterImageFetcher:
+    """Twitter APIの呼び出しを専用スレッドで行い、同時の取得を1回にまとめる"""
+
+    def __init__(self, client, max_workers=2):
+        self.client = client
+        self.quota = getattr(client, 'quota', None)  # QuotaTrackingClient なら残り回数を見る
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='twitter')
+        self._flights = SingleFlight()
+
+    def is_fetching(self, hashtag):
+        return self._flights.is_running((hashtag, None))
+
+    async def fetch(self, hashtag, next_token=None, background=False):
+        """1ページ分の (画像, 次ページのトークン) を取得 (同じページの同時リクエストは共有)
+
+        レート制限中は API を呼ばずに QuotaExceeded を送出する。
+        """
+        if self.quota is not None:
+            self.quota.check(SEARCH_RECENT, background=background)
+        loop = asyncio.get_running_loop()
+        return await self._flights.do(
+            (hashtag, next_token),
+            lambda: loop.run_in_executor(
+                self._executor, search_hashtag_images, self.client, hashtag, next_token
+            )
+        )
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+
+class CacheEntry:
+    """1ハッシュタグ分の画像プール"""
+    __slots__ = ('images', 'urls', 'updated_at', 'next_token')
+
+    def __init__(self, images=(), updated_at=0.0, next_token=None):
+        self.images = []
+        self.urls = set()
+        self.updated_at = updated_at
+        self.next_token = next_token  # まだ取得していない古いページ
+        self.merge(images, limit=None)
+
+    def merge(self, images, limit, newest=True):
+        """重複を除いて追加し、上限を超えた分は古い方から捨てる"""
+        fresh = [img for img in images if img['image_url'] not in self.urls]
+        for img in fresh:
+            self.urls.add(img['image_url'])
+        self.images = fresh + self.images if newest else self.images + fresh
+        if limit is not None and len(self.images) > limit:
+            for img in self.images[limit:]:
+                self.urls.discard(img['image_url'])
+            del self.images[limit:]
+        return len(fresh)
+
+    def to_dict(self):
+        return {'images': self.images, 'updated_at': self.updated_at, 'next_token': self.next_token}
+
+
+class TwitterImageCache:
+    """ハッシュタグごとの画像キャッシュ
+
+    - 期限が近づいたらバックグラウンドで更新し、その間は古い画像を返し続ける
+    - 更新のたびに古いページも少しずつ取得して、重複なしの画像プールを育てる
+    - ディスクに保存し、再起動後も読み込む
+    - ハッシュタグ数はLRUで上限を設ける
+    """
+
+    def __init__(self, fetcher, path='twitter_cache.json', refresh_after=25 * 60,
+                 max_hashtags=16, max_images=1000, pages_per_refresh=2):
+        self.fetcher = fetcher
+        self.path = path
+        self.refresh_after = refresh_after
+        self.max_hashtags = max_hashtags
+        self.max_images = max_images
+        self.pages_per_refresh = pages_per_refresh
+        self.last_refresh_ms = None
+        self.last_error = None
+        self.on_refresh = []          # 更新後に呼ぶ関数 (hashtag, 秒数, 成功したか)
+        self._entries = OrderedDict()
+        self._flights = SingleFlight()
+        self._background = set()
+        self._loaded_mtime = None
+
+    async def reload_if_changed(self):
+        """他のプロセスがファイルを更新していれば読み直す (ファイルはスレッドで読む)"""
+        loop = asyncio.get_running_loop()
+        loaded = await loop.run_in_executor(None, self._read, self._loaded_mtime)
+        if loaded is not None:
+            self._apply(*loaded)
+
+    def load(self):
+        """保存したキャッシュを読み込む（起動時）"""
+        loaded = self._read()
+        if loaded is not None:
+            self._apply(*loaded)
+
+    def _read(self, known_mtime=None):
+        """ファイルが known_mtime から変わっていれば (mtime, 内容) を返す (読めなければ内容は None)"""
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return None
+        if mtime == known_mtime:
+            return None
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                return mtime, json.load(f)
+        except (OSError, ValueError) as e:
+            log.warning('Twitterキャッシュの読み込みに失敗しました: %s', e)
+            return mtime, None
+
+    def _apply(self, mtime, data):
+        self._loaded_mtime = mtime
+        if data is None:
+            return
+        for hashtag, entry in data.items():
+            self._entries[hashtag] = CacheEntry(
+                entry.get('images', []), entry.get('updated_at', 0.0), entry.get('next_token')
+            )
+        self._evict()
+
+    async def save(self):
+        data = json.dumps({h: e.to_dict() for h, e in self._entries.items()}, ensure_ascii=False)
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, atomic_write, self.path, data)
+
+    def _evict(self, keep=()):
+        while len(self._entries) > self.max_hashtags:
+            hashtag = next(h for h in self._entries if h not in keep)
+            del self._entries[hashtag]
+
+    def hashtags(self):
+        return list(self._entries)
+
+    def is_refreshing(self, hashtag):
+        return self._flights.is_running(hashtag)
+
+    def age(self, hashtag):
+        entry = self._entries.get(hashtag)
+        return time.time() - entry.updated_at if entry else None
+
+    def is_stale(self, hashtag):
+        age = self.age(hashtag)
+        return age is None or age >= self.refresh_after
+
+    async def get_images(self, hashtag):
+        """(画像のリスト, キャッシュから返したか) を返す
+
+        キャッシュがあれば古くてもすぐ返し、必要なら裏で更新する。
+        レート制限中もキャッシュがあればそれを返す。
+        """
+        entry = self._entries.get(hashtag)
+        if entry and entry.images:
+            self._entries.move_to_end(hashtag)
+            if self.is_stale(hashtag):
+                self.refresh_in_background(hashtag)
+            return entry.images, True
+        await self.refresh(hashtag)
+        entry = self._entries.get(hashtag)
+        return (entry.images if entry else []), False
+
+    def refresh_in_background(self, hashtag):
+        if self.is_refreshing(hashtag):
+            return
+        task = asyncio.ensure_future(self._refresh_quietly(hashtag, background=True))
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _refresh_quietly(self, hashtag, background=False):
+        try:
+            await self.refresh(hashtag, background)
+        except QuotaExceeded:
+            pass  # 制限が解除されたら次の更新で取得する
+        except Exception as e:
+            # 失敗しても古いキャッシュはそのまま使い続ける
+            self.last_error = str(e)
+            log.warning('Twitterキャッシュの更新に失敗しました: %s', e, extra={'hashtag': hashtag})
+
+    async def refresh(self, hashtag, background=False):
+        """APIから取得してキャッシュを更新 (同じハッシュタグの更新は1回にまとめる)"""
+        return await self._flights.do(hashtag, lambda: self._refresh(hashtag, background))
+
+    async def _refresh(self, hashtag, background):
+        start = time.perf_counter()
+        try:
+            images = await self._fetch_pages(hashtag, background)
+        except QuotaExceeded:
+            raise  # APIを呼んでいないので記録しない
+        except Exception:
+            self._notify_refresh(hashtag, start, False)
+            raise
+        self._notify_refresh(hashtag, start, True)
+        await self.save()
+        return images
+
+    def _notify_refresh(self, hashtag, start, ok):
+        elapsed = time.perf_counter() - start
+        if ok:
+            self.last_refresh_ms = elapsed * 1000
+        for callback in self.on_refresh:
+            callback(hashtag, elapsed, ok)
+
+    async def _fetch_pages(self, hashtag, background):
+        entry = self._entries.get(hashtag) or CacheEntry()
+
+        # 最新のページ
+        images, first_token = await self.fetcher.fetch(hashtag, background=background)
+        entry.merge(images, self.max_images)
+        if entry.next_token is None:
+            entry.next_token = first_token
+
+        # 前回の続きから古いページを取得してプールを広げる
+        for _ in range(self.pages_per_refresh - 1):
+            if not entry.next_token or len(entry.images) >= self.max_images:
+                break
+            try:
+                older, entry.next_token = await self.fetcher.fetch(
+                    hashtag, entry.next_token, background=True
+                )
+            except QuotaExceeded:
+                break  # 古いページは残り回数に余裕がある時だけ
+            except Exception:
+                entry.next_token = None  # トークンが期限切れなら次回最新から辿り直す
+                break
+            entry.merge(older, self.max_images, newest=False)
+
+        entry.updated_at = time.time()
+        self._entries[hashtag] = entry
+        self._entries.move_to_end(hashtag)
+        self._evict(keep=(hashtag,))
+        self.last_error = None
+        return entry.images
@@ -0,0 +1,148 @@
+"""Twitter APIのレート制限 (残り回数・リセット時刻) の管理"""
+import threading
+import time
+
+import tweepy
+
+SEARCH_RECENT = '/2/tweets/search/recent'
+
+
+class QuotaExceeded(Exception):
+    """レート制限中のためAPIを呼ばなかった"""
+
+    def __init__(self, route, retry_in):
+        super().__init__(f'{route} はレート制限中です ({retry_in:.0f}秒後に再試行可能)')
+        self.route = route
+        self.retry_in = retry_in
+
+
+class RouteQuota:
+    __slots__ = ('limit', 'remaining', 'reset_at', 'blocked_until', 'failures', 'requests')
+
+    def __init__(self):
+        self.limit = None
+        self.remaining = None
+        self.reset_at = None        # x-rate-limit-reset (UNIX時刻)
+        self.blocked_until = 0.0    # 429後のバックオフ終了時刻
+        self.failures = 0           # 連続した429の回数
+        self.requests = 0
+
+
+class QuotaManager:
+    """レスポンスヘッダーからエンドポイントごとの残り回数を追跡する
+
+    - 残り回数が reserve 以下になったら、裏での更新は止めてユーザーの操作用に残す
+    - 429 を受けたら Retry-After / リセット時刻、なければ指数バックオフで待つ
+    """
+
+    def __init__(self, reserve=5, base_backoff=60, max_backoff=15 * 60):
+        self.reserve = reserve
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self._routes = {}
+        self._lock = threading.Lock()  # ヘッダーはAPIスレッドから記録される
+
+    def _route(self, route):
+        quota = self._routes.get(route)
+        if quota is None:
+            quota = self._routes[route] = RouteQuota()
+        return quota
+
+    @staticmethod
+    def _header(headers, name):
+        value = headers.get(name)
+        try:
+            return int(float(value)) if value is not None else None
+        except ValueError:
+            return None
+
+    def record(self, route, headers):
+        """成功したレスポンスのヘッダーを記録"""
+        with self._lock:
+            quota = self._route(route)
+            quota.requests += 1
+            quota.failures = 0
+            limit = self._header(headers, 'x-rate-limit-limit')
+            remaining = self._header(headers, 'x-rate-limit-remaining')
+            reset_at = self._header(headers, 'x-rate-limit-reset')
+            if limit is not None:
+                quota.limit = limit
+            if remaining is not None:
+                quota.remaining = remaining
+            if reset_at is not None:
+                quota.reset_at = reset_at
+
+    def record_limited(self, route, headers):
+        """429 を受けた時のバックオフを設定"""
+        now = time.time()
+        with self._lock:
+            quota = self._route(route)
+            quota.requests += 1
+            quota.failures += 1
+            quota.remaining = 0
+            retry_after = self._header(headers, 'retry-after')
+            reset_at = self._header(headers, 'x-rate-limit-reset')
+            if reset_at is not None:
+                quota.reset_at = reset_at
+            if retry_after is not None:
+                wait = retry_after
+            elif reset_at is not None and reset_at > now:
+                wait = reset_at - now
+            else:
+                # ヘッダーがなければ連続失敗回数に応じて指数バックオフ
+                wait = min(self.base_backoff * 2 ** (quota.failures - 1), self.max_backoff)
+            quota.blocked_until = now + wait
+
+    def wait_seconds(self, route, background=False):
+        """APIを呼べるまでの秒数 (0なら呼んでよい)"""
+        now = time.time()
+        with self._lock:
+            quota = self._routes.get(route)
+            if quota is None:
+                return 0.0
+            if quota.blocked_until > now:
+                return quota.blocked_until - now
+            if quota.reset_at is not None and quota.reset_at <= now:
+                quota.remaining = quota.limit  # ウィンドウが切り替わった
+                return 0.0
+            floor = self.reserve if background else 0
+            if quota.remaining is not None and quota.remaining <= floor and quota.reset_at:
+                return max(quota.reset_at - now, 0.0)
+            return 0.0
+
+    def check(self, route, background=False):
+        """制限中なら QuotaExceeded を送出"""
+        wait = self.wait_seconds(route, background)
+        if wait > 0:
+            raise QuotaExceeded(route, wait)
+
+    def snapshot(self):
+        now = time.time()
+        with self._lock:
+            return {
+                route: {
+                    'limit': q.limit,
+                    'remaining': q.remaining,
+                    'reset_in': max(q.reset_at - now, 0) if q.reset_at else None,
+                    'blocked_for': max(q.blocked_until - now, 0),
+                    'requests': q.requests,
+                }
+                for route, q in self._routes.items()
+            }
+
+
+class QuotaTrackingClient(tweepy.Client):
+    """レスポンスごとにレート制限ヘッダーを QuotaManager に記録するクライアント"""
+
+    def __init__(self, *args, quota=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.quota = quota or QuotaManager()
+
+    def request(self, method, route, params=None, json=None, user_auth=False):
+        try:
+            response = super().request(method, route, params=params, json=json, user_auth=user_auth)
+        except tweepy.TooManyRequests as e:
+            self.quota.record_limited(route, e.response.headers)
+            raise
+        self.quota.record(route, response.headers)
+        return response